@@ -2,7 +2,12 @@ import os
 
 from flask import Flask, url_for, render_template
 from blueprints.api import app as api_app
+from services.analytics import refresh_rollups, refresh_rollups_in_background
+from services.firing_tables import build_tables, build_tables_in_background
+from services.profiles import prune as prune_profiles, warm_up, warm_up_in_background
+from services.results import prune
 from models.conn import db
+from models.persistence import history_writer
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 
@@ -11,10 +16,59 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db.init_app(app)  # added to avoid circular import
+history_writer.init_app(app)
 # Flask-Migrate configuration
 migrate = Migrate(app, db)
 
 app.register_blueprint(api_app, url_prefix='/api')
 
+# Terrain profiles of the configured firing positions and the firing tables are prepared while the first
+# requests are served
+warm_up_in_background()
+build_tables_in_background()
+# New shots are folded into the analytics rollups off the request path
+refresh_rollups_in_background(app)
+
+
+@app.cli.command('build-firing-tables')
+def build_firing_tables():
+    """
+    Builds the firing tables listed in FIRING_TABLES, refreshing the ones computed with other drag constants
+    """
+    for m, v0 in build_tables():
+        print(f"Firing table ready: {m} kg at {v0} m/s")
+
+
+@app.cli.command('warm-ground-profiles')
+def warm_ground_profiles():
+    """
+    Stores the terrain profiles of GROUND_PROFILE_POSITIONS and deletes those of other elevation datasets
+    """
+    print(f"{warm_up()} ground profiles ready")
+
+
+@app.cli.command('prune-ground-profiles')
+def prune_ground_profiles():
+    """
+    Deletes the terrain profiles stored for other elevation datasets
+    """
+    print(f"Deleted the profiles of {prune_profiles()} other datasets")
+
+
+@app.cli.command('prune-result-cache')
+def prune_result_cache():
+    """
+    Deletes the cached results whose weather epoch is over
+    """
+    print(f"Deleted {prune()} cached results")
+
+
+@app.cli.command('refresh-rollups')
+def refresh_analytics_rollups():
+    """
+    Folds the shots saved since the last refresh into the hourly analytics rollups
+    """
+    print(f"Folded {refresh_rollups()} shots into the rollups")
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,137 @@
+"""
+End-to-end benchmark of the Flask application against the fake elevation and weather services:
+requests per second and latency percentiles under concurrent load.
+
+    python benchmarks/bench_api.py --requests 500 --concurrency 8 --latency 20 --output api.json
+"""
+import argparse
+import random
+import threading
+import time
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from common import configure_environment, summarize, write_results
+from fake_services import FakeServices
+
+ORIGIN = {'latitude': "45°58'25.068\"N", 'longitude': "8°52'35.1552\"E"}
+
+
+def random_shot(rng, identical=False):
+    if identical:
+        return dict(ORIGIN, muzzle_speed=300, vertical_angle=45, horizontal_angle=30, projectile_weight=5)
+    return dict(ORIGIN, muzzle_speed=rng.uniform(100, 400), vertical_angle=rng.uniform(10, 70),
+                horizontal_angle=rng.uniform(0, 360), projectile_weight=rng.choice((1, 5, 10)))
+
+
+# name -> (path, function building the JSON body from a random generator)
+SCENARIOS = {
+    'projectile': ('/api/calculate/projectile_ballistics', lambda rng: random_shot(rng)),
+    'projectile_repeated': ('/api/calculate/projectile_ballistics', lambda rng: random_shot(rng, identical=True)),
+    'projectile_adaptive': ('/api/calculate/projectile_ballistics',
+                            lambda rng: dict(random_shot(rng), integrator='adaptive')),
+    'batch20': ('/api/calculate/projectile_ballistics/batch',
+                lambda rng: {'shots': [random_shot(rng) for _ in range(20)]}),
+    'firing_solution': ('/api/calculate/firing_solution', lambda rng: dict(
+        ORIGIN, target_latitude=f"45°58'{rng.uniform(30, 59):.3f}\"N",
+        target_longitude=f"8°53'{rng.uniform(0, 20):.3f}\"E",
+        muzzle_speed=300, projectile_weight=5)),
+}
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+def run_load(base_url, path, make_body, total, concurrency, seed):
+    """
+    Sends requests from several client threads, each on its own keep-alive connection
+
+    @return: The latencies of the successful requests, the number of errors and the wall-clock duration
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [total]
+
+    def client(index):
+        rng = random.Random(seed + index)
+        session = requests.Session()
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            body = make_body(rng)
+            start = time.perf_counter()
+            try:
+                ok = session.post(base_url + path, json=body, timeout=60).status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds added by the fake services')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random milliseconds added on top')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run (repeatable, all by default)')
+    parser.add_argument('--persistence', choices=('sync', 'write_behind'), default='sync')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='path of the JSON results')
+    arguments = parser.parse_args()
+
+    services = FakeServices(latency=arguments.latency, jitter=arguments.jitter).start()
+    configure_environment(services.url, PERSISTENCE_MODE=arguments.persistence)
+
+    from app import app
+    from models.conn import db
+
+    with app.app_context():
+        db.create_all()
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    results = []
+    for name in arguments.scenario or list(SCENARIOS):
+        path, make_body = SCENARIOS[name]
+        # Warm-up: connection pools, worker processes, firing tables
+        run_load(base_url, path, make_body, arguments.concurrency, arguments.concurrency, arguments.seed - 1000)
+        upstream_before = dict(services.requests)
+        latencies, errors, duration = run_load(base_url, path, make_body, arguments.requests,
+                                               arguments.concurrency, arguments.seed)
+        results.append({
+            'name': name,
+            'requests_per_second': len(latencies) / duration,
+            'errors': errors,
+            'upstream_requests': {service: count - upstream_before[service]
+                                  for service, count in services.requests.items()},
+            **summarize(latencies),
+        })
+
+    server.shutdown()
+    services.stop()
+    write_results('api', vars(arguments), results, arguments.output)
+
+
+if __name__ == '__main__':
+    main()
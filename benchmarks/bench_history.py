@@ -0,0 +1,158 @@
+"""
+Benchmark of the history endpoints on a large seeded database: pages at various depths and with each filter,
+single-request lookups and the streamed export.
+
+    python benchmarks/bench_history.py --rows 200000 --output history.json
+    python benchmarks/bench_history.py --database sqlite:////tmp/history.db --rows 1000000   # seeded once, reused
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from common import configure_environment, summarize, write_results
+
+SENDERS = [f'10.0.{i // 256}.{i % 256}' for i in range(200)]
+
+# Origins are spread over northern Italy
+AREA = (44.0, 7.0, 46.5, 12.0)
+
+
+def dms(value, positive, negative):
+    degrees = int(abs(value))
+    minutes = int((abs(value) - degrees) * 60)
+    seconds = (abs(value) - degrees - minutes / 60) * 3600
+    return f"{degrees}°{minutes}'{seconds:.3f}\"{positive if value >= 0 else negative}"
+
+
+def seed(db, Request, Response, geohash, rows, batch_size=10000):
+    """
+    Inserts synthetic requests with their responses, spread over the last 30 days, with bulk inserts
+
+    @return: The number of rows inserted
+    """
+    rng = random.Random(42)
+    start = datetime.now() - timedelta(days=30)
+    step = timedelta(days=30) / rows
+    for first in range(0, rows, batch_size):
+        requests, responses = [], []
+        for i in range(first, min(rows, first + batch_size)):
+            lat = rng.uniform(AREA[0], AREA[2])
+            lon = rng.uniform(AREA[1], AREA[3])
+            requests.append({
+                'id': i + 1,
+                'latitude': dms(lat, 'N', 'S'),
+                'longitude': dms(lon, 'E', 'W'),
+                'latitude_decimal': lat,
+                'longitude_decimal': lon,
+                'geohash': geohash(lat, lon, 9),
+                'muzzle_speed': rng.uniform(100, 800),
+                'vertical_angle': rng.uniform(5, 80),
+                'horizontal_angle': rng.uniform(0, 360),
+                'projectile_weight': rng.choice((1.0, 5.0, 10.0, 40.0)),
+                'timestamp': start + step * i,
+                'sender': rng.choice(SENDERS),
+            })
+            responses.append({
+                'request_id': i + 1,
+                'final_position_lat': lat + 0.01,
+                'final_position_lon': lon + 0.01,
+                'final_position_alt': rng.uniform(0, 2000),
+                'horizontal_distance': rng.uniform(100, 20000),
+                'max_height': rng.uniform(100, 5000),
+                'max_height_relative': rng.uniform(10, 3000),
+                'flight_time': rng.randint(1, 120),
+            })
+        db.session.execute(db.insert(Request), requests)
+        db.session.execute(db.insert(Response), responses)
+        db.session.commit()
+    return rows
+
+
+def measure(client, url, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url)
+        body = response.get_json()
+        samples.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url}: {response.status_code} {body}")
+    return samples, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000, help='requests in the seeded database')
+    parser.add_argument('--database', help='database URI (a new SQLite file by default); seeded only if empty')
+    parser.add_argument('--repeat', type=int, default=20, help='runs of each query')
+    parser.add_argument('--limit', type=int, default=100, help='page size')
+    parser.add_argument('--output', help='path of the JSON results')
+    arguments = parser.parse_args()
+
+    configure_environment('http://127.0.0.1:9', arguments.database)
+
+    from app import app
+    from models.conn import db
+    from models.models import Request, Response
+    from services.weather import geohash
+
+    client = app.test_client()
+    results = []
+    with app.app_context():
+        db.create_all()
+        existing = db.session.query(Request.id).count()
+        if existing == 0:
+            start = time.perf_counter()
+            seed(db, Request, Response, geohash, arguments.rows)
+            duration = time.perf_counter() - start
+            results.append({'name': 'seed', 'rows': arguments.rows, 'rows_per_second': arguments.rows / duration})
+        rows = existing or arguments.rows
+
+    limit = arguments.limit
+    middle = datetime.now() - timedelta(days=15)
+    queries = {
+        'first_page': f'/api/get/requests?limit={limit}',
+        'last_page_desc': f'/api/get/requests?limit={limit}&order=desc',
+        'deep_cursor': f'/api/get/requests?limit={limit}&cursor={rows // 2}',
+        'sender': f'/api/get/requests?limit={limit}&sender={SENDERS[7]}',
+        'sender_since': f'/api/get/requests?limit={limit}&sender={SENDERS[7]}&since={middle.isoformat()}',
+        'time_range': f'/api/get/requests?limit={limit}&since={middle.isoformat()}'
+                      f'&until={(middle + timedelta(hours=1)).isoformat()}',
+        'bbox': f'/api/get/requests?limit={limit}&bbox=45.40,9.10,45.55,9.30',
+        'geohash': f'/api/get/requests?limit={limit}&geohash=u0nd',
+        'single_request': f'/api/get/request/{rows // 3}',
+    }
+    for name, url in queries.items():
+        samples, body = measure(client, url, arguments.repeat)
+        returned = len(body['requests']) if 'requests' in body else 1
+        results.append({'name': name, 'returned': returned, **summarize(samples)})
+
+    # Walk the whole history page by page, as a client synchronising it would
+    pages = 0
+    cursor = None
+    start = time.perf_counter()
+    while pages < 200:
+        url = f'/api/get/requests?limit=1000' + (f'&cursor={cursor}' if cursor else '')
+        cursor = client.get(url).get_json()['next_cursor']
+        pages += 1
+        if cursor is None:
+            break
+    duration = time.perf_counter() - start
+    results.append({'name': 'page_walk', 'pages': pages, 'pages_per_second': pages / duration})
+
+    for export_format in ('ndjson', 'csv'):
+        start = time.perf_counter()
+        size = 0
+        response = client.get(f'/api/export/requests?format={export_format}')
+        for chunk in response.response:
+            size += len(chunk)
+        duration = time.perf_counter() - start
+        results.append({'name': f'export_{export_format}', 'bytes': size, 'seconds': duration,
+                        'rows_per_second': rows / duration})
+
+    write_results('history', vars(arguments), results, arguments.output)
+
+
+if __name__ == '__main__':
+    main()
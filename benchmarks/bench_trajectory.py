@@ -0,0 +1,89 @@
+"""
+Micro-benchmarks of the drag integrators, over time steps and flight lengths, on synthetic terrain
+without any network access.
+
+    python benchmarks/bench_trajectory.py --repeat 5 --output trajectory.json
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+
+from common import summarize, write_results
+from fake_services import synthetic_elevation
+
+from blueprints.api import calculate_with_drag
+from services.firing_tables import FlatTerrain
+from services.geodesy import LocalFrame
+from services.trajectory import simulate_batch
+
+ORIGIN = (45.97363, 8.876432)
+AIR_DATA = {'density': 1.2, 'wind_speed': 4.0, 'wind_deg': 45.0}
+
+# (name, muzzle speed, mass): short, medium and long flights
+FLIGHTS = (('short', 100.0, 5.0), ('medium', 300.0, 5.0), ('long', 800.0, 40.0))
+TIME_STEPS = (0.05, 0.01, 0.001)
+
+
+class SyntheticProfile:
+    """
+    The synthetic terrain sampled along the firing azimuth, like a fully fetched GroundProfile
+    """
+
+    def __init__(self, angle_horizontal, distance=200000.0, step=231.9):
+        self.step = step
+        self.distances = np.arange(0.0, distance + step, step)
+        latitudes, longitudes = LocalFrame(*ORIGIN).along(self.distances, angle_horizontal)
+        self.altitudes = np.array([synthetic_elevation(lat, lon) for lat, lon in zip(latitudes, longitudes)])
+
+    def altitude_at(self, distance):
+        return np.interp(distance, self.distances, self.altitudes)
+
+
+def measure(function, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - start)
+    return samples, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each case')
+    parser.add_argument('--batch-size', type=int, default=1000, help='shots of the vectorized batch case')
+    parser.add_argument('--output', help='path of the JSON results')
+    arguments = parser.parse_args()
+
+    angle_vertical = math.radians(45)
+    angle_horizontal = math.radians(30)
+    profile = SyntheticProfile(angle_horizontal)
+    start_alt = float(profile.altitude_at(0.0))
+    results = []
+
+    for flight, v0, m in FLIGHTS:
+        cases = [(f'euler_dt{dt:g}', {'dt': dt}) for dt in TIME_STEPS] + [('adaptive', {'integrator': 'adaptive'})]
+        for name, options in cases:
+            samples, (_, _, distance, flight_time) = measure(lambda: calculate_with_drag(
+                *ORIGIN, m, v0, angle_vertical, angle_horizontal, start_alt, AIR_DATA, profile=profile, **options
+            ), arguments.repeat)
+            results.append({'name': f'{flight}/{name}', 'range': distance, 'flight_time': flight_time,
+                            **summarize(samples)})
+
+    # Vectorized engine: many shots at once on flat terrain
+    angles = np.radians(np.linspace(5, 85, arguments.batch_size))
+    terrain = FlatTerrain(start_alt)
+    samples, _ = measure(lambda: simulate_batch(5.0, 300.0, angles, angle_horizontal, start_alt, AIR_DATA, terrain),
+                         arguments.repeat)
+    summary = summarize(samples)
+    results.append({'name': f'batch{arguments.batch_size}/euler_dt0.01',
+                    'shots_per_second': arguments.batch_size / summary['mean'], **summary})
+
+    write_results('trajectory', vars(arguments), results, arguments.output)
+
+
+if __name__ == '__main__':
+    main()
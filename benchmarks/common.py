@@ -0,0 +1,104 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def configure_environment(fake_url, database_uri=None, **overrides):
+    """
+    Points the application at the fake services and at a scratch database.
+    Must be called before the application modules are imported, since they read their settings on import.
+
+    @param fake_url: The base URL of the fake services (see fake_services.py)
+    @param database_uri: The database to use (defaults to a new SQLite file in the temporary directory)
+    @param overrides: Further environment variables
+    @return: The database URI
+    """
+    if database_uri is None:
+        database_uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='ballistics-bench-'), 'bench.db')
+    os.environ.update({
+        'SQLALCHEMY_DATABASE_URI': database_uri,
+        'ELEVATION_API_URL': f'{fake_url}/v1',
+        'ELEVATION_DATASET': 'synthetic',
+        'ELEVATION_BACKEND': 'http',
+        'OPENWEATHER_URL': fake_url,
+        'OPENWEATHER_VERSION': '2.5',
+        'OPENWEATHER_API_KEY': 'benchmark',
+        'FIRING_TABLES_DIR': os.path.join(tempfile.mkdtemp(prefix='ballistics-tables-'), 'firing_tables'),
+    })
+    os.environ.update({name: str(value) for name, value in overrides.items()})
+    return database_uri
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """
+    @param samples: A list of measurements
+    @param points: The percentiles to compute
+    @return: A dictionary mapping 'p50', 'p90'... to the percentiles of the samples (nearest rank)
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {f'p{point}': None for point in points}
+    return {f'p{point}': ordered[min(len(ordered) - 1, max(0, round(point / 100 * len(ordered)) - 1))]
+            for point in points}
+
+
+def summarize(samples):
+    """
+    @param samples: A list of durations in seconds
+    @return: Their count, mean, standard deviation, minimum and percentiles
+    """
+    return {
+        'count': len(samples),
+        'mean': statistics.fmean(samples) if samples else None,
+        'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        'min': min(samples) if samples else None,
+        **percentiles(samples),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(suite, parameters, results, output=None):
+    """
+    Prints the results of a suite and, if requested, writes them as JSON, with the commit and the machine they
+    were measured on, so that runs of different commits can be compared
+
+    @param suite: The name of the suite
+    @param parameters: The parameters of the run
+    @param results: A list of result dictionaries, each with a 'name'
+    @param output: The path of the JSON file, or None
+    """
+    report = {
+        'suite': suite,
+        'timestamp': datetime.now().isoformat(),
+        'commit': git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': parameters,
+        'results': results,
+    }
+    for result in results:
+        fields = ', '.join(f'{name}={value:.6g}' if isinstance(value, float) else f'{name}={value}'
+                           for name, value in result.items() if name != 'name' and not isinstance(value, dict))
+        print(f"{suite}/{result['name']}: {fields}")
+    if output:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {output}")
+    return report
@@ -0,0 +1,54 @@
+"""
+Compares two result files of the same suite, e.g. measured on two commits, and flags the regressions.
+
+    python benchmarks/compare.py before.json after.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+# Metrics where a larger value is better; for every other timing a smaller value is better
+HIGHER_IS_BETTER = ('requests_per_second', 'rows_per_second', 'pages_per_second', 'shots_per_second')
+LOWER_IS_BETTER = ('mean', 'p50', 'p90', 'p99', 'seconds')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as a regression')
+    arguments = parser.parse_args()
+
+    with open(arguments.before) as file:
+        before = json.load(file)
+    with open(arguments.after) as file:
+        after = json.load(file)
+    if before['suite'] != after['suite']:
+        sys.exit(f"Different suites: {before['suite']} and {after['suite']}")
+
+    print(f"{before['suite']}: {before.get('commit')} -> {after.get('commit')}")
+    previous = {result['name']: result for result in before['results']}
+    regressions = 0
+    for result in after['results']:
+        old = previous.get(result['name'])
+        if old is None:
+            continue
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            if not old.get(metric) or result.get(metric) is None:
+                continue
+            change = (result[metric] - old[metric]) / old[metric]
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ''
+            if worse > arguments.threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            elif worse < -arguments.threshold:
+                flag = '  improvement'
+            print(f"  {result['name']:<32} {metric:<20} {old[metric]:>12.6g} -> {result[metric]:>12.6g} "
+                  f"({change:+.1%}){flag}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
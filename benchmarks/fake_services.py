@@ -0,0 +1,136 @@
+"""
+Local stand-ins for the OpenTopodata elevation API and the OpenWeatherMap API, serving synthetic
+terrain and weather with an optional injected latency.
+
+    python benchmarks/fake_services.py --port 5055 --latency 20 --jitter 5
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def synthetic_elevation(latitude, longitude):
+    """
+    A smooth, deterministic terrain: rolling hills of a few hundred metres with ridges every few kilometres
+
+    @param latitude: The latitude of the position
+    @param longitude: The longitude of the position
+    @return: The altitude in metres
+    """
+    return (400
+            + 250 * math.sin(math.radians(latitude) * 600) * math.cos(math.radians(longitude) * 450)
+            + 60 * math.sin(math.radians(latitude + longitude) * 3000))
+
+
+def synthetic_weather(latitude, longitude):
+    """
+    @param latitude: The latitude of the position
+    @param longitude: The longitude of the position
+    @return: An OpenWeatherMap-like body with temperature, pressure and wind
+    """
+    return {
+        'main': {'temp': 15 + 10 * math.cos(math.radians(latitude)), 'pressure': 1013},
+        'wind': {'speed': 4 + 2 * math.sin(math.radians(longitude) * 50), 'deg': (latitude * 100) % 360},
+    }
+
+
+class FakeServices:
+    """
+    A threaded HTTP server answering both elevation and weather requests
+    """
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0):
+        """
+        @param port: The port to listen on (0 picks a free one)
+        @param latency: The delay added to every response, in milliseconds
+        @param jitter: The maximum random delay added on top of the latency, in milliseconds
+        @param error_rate: The share of requests answered with a 503
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = {'elevation': 0, 'weather': 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def _handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                service = 'weather' if url.path.endswith('/weather') else 'elevation'
+                with services._lock:
+                    services.requests[service] += 1
+
+                delay = services.latency + random.uniform(0, services.jitter)
+                if delay:
+                    time.sleep(delay / 1000)
+
+                if random.random() < services.error_rate:
+                    status, body = 503, {'error': 'injected failure'}
+                elif service == 'weather':
+                    status, body = 200, synthetic_weather(float(query['lat'][0]), float(query['lon'][0]))
+                else:
+                    results = []
+                    for location in query['locations'][0].split('|'):
+                        latitude, longitude = (float(value) for value in location.split(','))
+                        results.append({'elevation': synthetic_elevation(latitude, longitude),
+                                        'location': {'lat': latitude, 'lng': longitude}})
+                    status, body = 200, {'results': results, 'status': 'OK'}
+
+                encoded = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+        return Handler
+
+    def start(self):
+        """
+        Serves in a background thread
+
+        @return: The services, for chaining
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-services', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='maximum random milliseconds added on top')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 503')
+    arguments = parser.parse_args()
+
+    services = FakeServices(arguments.port, arguments.latency, arguments.jitter, arguments.error_rate)
+    print(f"Fake elevation API on {services.url}/v1/<dataset>, fake weather API on {services.url}/<version>/weather")
+    try:
+        services._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
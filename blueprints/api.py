@@ -1,74 +1,115 @@
+import csv
+import io
+import json
 import math
 import re
 import os
-from time import sleep
+from datetime import datetime
+from functools import partial
+from time import perf_counter
 
-import requests
-from flask import render_template, url_for, Blueprint, request, jsonify
+import numpy as np
+from flask import url_for, Blueprint, request, jsonify, current_app, stream_with_context
+from sqlalchemy import select
+from sqlalchemy.orm import contains_eager
 
 from models.conn import db
 from models.models import Request, Response
+from models.persistence import history_writer
+from services import analytics, profiles, results
+from services.archive import TRAJECTORY_ARCHIVE, archive_row, read_index, read_points
+from services.dispersion import DISPERSION_MAX_SAMPLES, confidence_scale, draw, ellipse, \
+    summarize as summarize_dispersion
+from services.elevation import AltitudeUnavailable, elevation_cache, get_altitude, get_altitudes
+from services.firing_tables import get_table
+from services.geodesy import LocalFrame, destination, to_geographic
+from services.jobs import QueueFull, job_queue
+from services.metrics import INTEGRATION_STEPS, PROFILER_ENABLED, REQUEST_SECONDS, SERVER_TIMING, \
+    UPSTREAM_CALLS_PER_REQUEST, current_trace, profiler, registry, start_trace, timed
+from services.polyline import TRAJECTORY_MAX_POINTS, TrajectoryRecorder, to_polyline
+from services.solver import MAX_ANGLE, MIN_ANGLE, refine_azimuth, solution_cache, solution_key, solve_elevations
+from services.trajectory import DEFAULT_AIR_DENSITY, DRAG_COEFFICIENT, FRONTAL_AREA, GRAVITY, simulate_adaptive, \
+    simulate_batch
+from services.upstream import UPSTREAM_BREAKER_COOLDOWN, breaker_stats, degradations, run_concurrently
+from services.weather import geohash, get_weather_and_density, weather_cache
+from services.workers import SIMULATION_WORKERS, map_in_processes
 
 app = Blueprint('api', __name__)
 
-
-def get_weather_data(lat, lon):
-    """
-    Gets weather data from the OpenWeatherMap API
-
-    @param lat: latitude of the position
-    @param lon: longitude of the position
-    @return: a JSON object containing the weather data
-    """
-
-    api_key = os.getenv('OPENWEATHER_API_KEY')
-    url = f"{os.getenv('OPENWEATHER_URL')}/{os.getenv('OPENWEATHER_VERSION')}/weather?lat={lat}&lon={lon}&appid={api_key}&units=metric"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise Exception(f"Errore nell'API: {response.status_code}, {response.text}")
-
-
-def get_weather_and_density(lat, lon):
+# Integration schemes accepted by calculate_with_drag
+INTEGRATORS = ('euler', 'adaptive')
+
+# Maximum number of shots accepted by the batch endpoint
+BATCH_MAX_SHOTS = int(os.getenv('BATCH_MAX_SHOTS', 500))
+
+# Default and maximum number of requests in a page of the history
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 100))
+HISTORY_PAGE_SIZE_MAX = int(os.getenv('HISTORY_PAGE_SIZE_MAX', 1000))
+
+# Minimum number of dispersion samples worth a chunk of their own on the process pool
+DISPERSION_CHUNK_SIZE = int(os.getenv('DISPERSION_CHUNK_SIZE', 2000))
+
+# Precision of the geohash stored with each request, used to filter the history by area
+REQUEST_GEOHASH_PRECISION = 9
+
+# Rows fetched from the database cursor at a time while exporting the history
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+# Columns of the history export
+EXPORT_COLUMNS = {
+    'id': Request.id,
+    'latitude': Request.latitude,
+    'longitude': Request.longitude,
+    'muzzle_speed': Request.muzzle_speed,
+    'vertical_angle': Request.vertical_angle,
+    'horizontal_angle': Request.horizontal_angle,
+    'projectile_weight': Request.projectile_weight,
+    'timestamp': Request.timestamp,
+    'sender': Request.sender,
+    'response_id': Response.id,
+    'final_position_lat': Response.final_position_lat,
+    'final_position_lon': Response.final_position_lon,
+    'final_position_alt': Response.final_position_alt,
+    'horizontal_distance': Response.horizontal_distance,
+    'max_height': Response.max_height,
+    'max_height_relative': Response.max_height_relative,
+    'flight_time': Response.flight_time,
+}
+
+
+def estimate_max_range(v0, angle_vertical, alt):
     """
-    Gets weather data from the OpenWeatherMap API and calculates the air density
+    Estimates the horizontal distance covered by a projectile in a vacuum, falling down to sea level.
+    Drag only shortens the flight, so this is used to size the terrain profile fetched before a simulation.
 
-    @param lat: latitude of the position
-    @param lon: longitude of the position
-    @return: a dictionary containing the weather data and the calculated air density
+    @param v0: The muzzle speed of the projectile
+    @param angle_vertical: The angle of departure (relative to the horizontal)
+    @param alt: The starting altitude
+    @return: The estimated horizontal distance in metres
     """
-    weather_data = get_weather_data(lat, lon)
-    temperature = weather_data['main']['temp']
-    pressure = weather_data['main']['pressure'] * 100
-    wind_speed = weather_data['wind']['speed']
-    wind_deg = weather_data['wind']['deg']
-
-    density = calculate_air_density(pressure, temperature)
-
-    return {
-        'temperature': temperature,
-        'pressure': pressure,
-        'wind_speed': wind_speed,
-        'wind_deg': wind_deg,
-        'density': density,
-    }
+    g = GRAVITY  # Gravitational acceleration
+    vx = v0 * math.cos(angle_vertical)
+    vy = v0 * math.sin(angle_vertical)
+    flight_time = (vy + math.sqrt(vy ** 2 + 2 * g * max(alt, 0))) / g
+    return abs(vx) * flight_time
 
 
-def calculate_air_density(pressure, temperature):
+def get_ground_profile(lat, lon, angle_horizontal, distance):
     """
-    Calculates the air density using the ideal gas law
+    Fetches the terrain profile along the firing azimuth in a few batched calls to the Elevation API,
+    or reads it from the ground profile store
 
-    @param pressure: atmospheric pressure in pascals
-    @param temperature: air temperature in degrees Celsius
-    @return: air density in kg/m^3
+    @param lat: The latitude of the starting position
+    @param lon: The longitude of the starting position
+    @param angle_horizontal: The angle of departure (relative to the North)
+    @param distance: The distance in metres the profile must cover
+    @return: A GroundProfile along the ground track of the shot
     """
-    R = 287.05  # Specific gas constant for dry air in J/(kg·K)
-    temperature_kelvin = temperature + 273.15  # Convert temperature from Celsius to Kelvin
-    return pressure / (R * temperature_kelvin)  # Apply the ideal gas law to calculate density
+    return profiles.get_profile(lat, lon, angle_horizontal, distance)
 
 
-def calculate_with_drag(lat, lon, m, v0, angle_vertical, angle_horizontal, alt, air_data, dt=0.01):
+def calculate_with_drag(lat, lon, m, v0, angle_vertical, angle_horizontal, alt, air_data, dt=0.01, profile=None,
+                        integrator='euler', recorder=None):
     """
     Calculates the trajectory of a projectile considering atmospheric drag
 
@@ -82,13 +123,26 @@ def calculate_with_drag(lat, lon, m, v0, angle_vertical, angle_horizontal, alt,
     @param alt: The starting altitude
     @param air_data: A dictionary containing the air density, wind speed and direction
     @param dt: The time step for the simulation
+    @param profile: The terrain profile along the firing azimuth (fetched if not given)
+    @param integrator: 'euler' for fixed steps of dt, or 'adaptive' for an error-controlled
+                       Runge-Kutta scheme with exact ground-impact detection (dt is then ignored)
+    @param recorder: A TrajectoryRecorder receiving the position after every step
     @return: The final position of the projectile, the maximum height reached,
              the horizontal distance traveled, and the flight time.
     """
-    g = 9.81  # Gravitational acceleration
-    air_density = float(air_data.get("density") or 1.225)  # Air density (kg/m^3)
-    C_r = 0.47  # Resistance coefficient for a sphere
-    A = 0.01  # Area frontale del proiettile (m^2)
+    if integrator not in INTEGRATORS:
+        raise ValueError(f"Unknown integrator: {integrator}")
+
+    if profile is None:
+        profile = get_ground_profile(lat, lon, angle_horizontal, estimate_max_range(v0, angle_vertical, alt))
+
+    if integrator == 'adaptive':
+        return simulate_adaptive(m, v0, angle_vertical, angle_horizontal, alt, air_data, profile, recorder=recorder)
+
+    g = GRAVITY  # Gravitational acceleration
+    air_density = float(air_data.get("density") or DEFAULT_AIR_DENSITY)  # Air density (kg/m^3)
+    C_r = DRAG_COEFFICIENT  # Resistance coefficient for a sphere
+    A = FRONTAL_AREA  # Area frontale del proiettile (m^2)
 
     # Wind components
     wind_speed = air_data['wind_speed']
@@ -107,15 +161,15 @@ def calculate_with_drag(lat, lon, m, v0, angle_vertical, angle_horizontal, alt,
     z = 0
     t = 0
     max_height = y
+    steps = 0
+    if recorder is not None:
+        recorder.append(t, x, y, z)
 
     while y > 0:
-        print(f"X: {x:.2f} | Y: {x:.2f} | Z: {x:.2f}")
-
+        steps += 1
         # Obtain terrain altitude
         horizontal_distance = math.sqrt(x ** 2 + z ** 2)
-        current_lat, current_lon = calculate_new_coordinates(lat, lon, horizontal_distance,
-                                                             math.degrees(angle_horizontal))
-        terrain_altitude = float(get_altitude(current_lat, current_lon))
+        terrain_altitude = float(profile.altitude_at(horizontal_distance))
 
         # Velocity relative to the fluid (wind)
         rel_vx = vx - wind_vx
@@ -144,6 +198,9 @@ def calculate_with_drag(lat, lon, m, v0, angle_vertical, angle_horizontal, alt,
         # Update maximum height
         max_height = max(max_height, y)
 
+        if recorder is not None:
+            recorder.append(t + dt, x, y, z)
+
         # Check if the bullet hit the ground
         if y <= terrain_altitude:
             break
@@ -151,6 +208,8 @@ def calculate_with_drag(lat, lon, m, v0, angle_vertical, angle_horizontal, alt,
         # Time increment
         t += dt
 
+    INTEGRATION_STEPS.observe(steps, integrator='euler')
+
     # Calculate horizontal distance
     horizontal_distance = math.sqrt(x ** 2 + z ** 2)
 
@@ -195,56 +254,66 @@ def dms_to_decimal(dms_str):
     return (float(deg) + float(minutes) / 60 + float(seconds) / (60 * 60)) * (-1 if direction in ['W', 'S'] else 1)
 
 
-def get_altitude(latitude, longitude):
-    """
-    Gets the altitude of a given position from the Elevation API
-
-    @param latitude: The latitude of the position
-    @param longitude: The longitude of the position
-    @return: The altitude of the position
-    """
-    url = f"{os.getenv('ELEVATION_API_URL')}/{os.getenv('ELEVATION_DATASET')}"
-    params = {'locations': f"{latitude},{longitude}"}
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        return str(data['results'][0]['elevation'])
-    else:
-        raise Exception(f"Errore nell'API: {response.status_code}, {response.text}")
-
-
 def calculate_new_coordinates(lat, lon, distance, angle):
     """Calculates the new latitude and longitude given an initial position, a distance, and an angle.
 
     @param lat: The initial latitude
     @param lon: The initial longitude
     @param distance: The distance to move
-    @param angle: The angle to move in
+    @param angle: The angle to move in, in radians clockwise from the North
     @return: The new latitude and longitude
     """
+    new_lat, new_lon = destination(lat, lon, distance, angle)
+    return float(new_lat), float(new_lon)
+
+
+def great_circle_distance(lat1, lon1, lat2, lon2):
+    """
+    Calculates the distance between two positions along the surface of the Earth (haversine formula).
+
+    @param lat1: The latitude of the first position
+    @param lon1: The longitude of the first position
+    @param lat2: The latitude of the second position
+    @param lon2: The longitude of the second position
+    @return: The distance in metres
+    """
     R = 6371000  # Earth's radius in meters
+    lat1_rad, lat2_rad = math.radians(lat1), math.radians(lat2)
+    d_lat = lat2_rad - lat1_rad
+    d_lon = math.radians(lon2 - lon1)
+    a = math.sin(d_lat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(d_lon / 2) ** 2
+    return 2 * R * math.asin(math.sqrt(a))
 
-    # Convert initial latitude and longitude to radians
-    lat_rad = math.radians(lat)
-    lon_rad = math.radians(lon)
 
-    # Compute new latitude in radians
-    new_lat_rad = math.asin(
-        math.sin(lat_rad) * math.cos(distance / R) +
-        math.cos(lat_rad) * math.sin(distance / R) * math.cos(angle)
-    )
+def initial_bearing(lat1, lon1, lat2, lon2):
+    """
+    Calculates the initial bearing of the great circle from a position to another.
 
-    # Compute new longitude in radians
-    new_lon_rad = lon_rad + math.atan2(
-        math.sin(angle) * math.sin(distance / R) * math.cos(lat_rad),
-        math.cos(distance / R) - math.sin(lat_rad) * math.sin(new_lat_rad)
-    )
+    @param lat1: The latitude of the first position
+    @param lon1: The longitude of the first position
+    @param lat2: The latitude of the second position
+    @param lon2: The longitude of the second position
+    @return: The bearing in radians, clockwise from the North
+    """
+    lat1_rad, lat2_rad = math.radians(lat1), math.radians(lat2)
+    d_lon = math.radians(lon2 - lon1)
+    return math.atan2(
+        math.sin(d_lon) * math.cos(lat2_rad),
+        math.cos(lat1_rad) * math.sin(lat2_rad) - math.sin(lat1_rad) * math.cos(lat2_rad) * math.cos(d_lon)
+    ) % (2 * math.pi)
 
-    # Convert the new latitude and longitude back to degrees
-    new_lat = math.degrees(new_lat_rad)
-    new_lon = math.degrees(new_lon_rad)
 
-    return new_lat, new_lon
+def horizontal_angle_to(lat, lon, target_lat, target_lon):
+    """
+    Calculates the horizontal angle of departure whose ground track passes through a target.
+
+    @param lat: The latitude of the starting position
+    @param lon: The longitude of the starting position
+    @param target_lat: The latitude of the target
+    @param target_lon: The longitude of the target
+    @return: The horizontal angle in radians, as expected by calculate_with_drag
+    """
+    return initial_bearing(lat, lon, target_lat, target_lon)
 
 
 def calculate_horizontal_distance(x1, z1, x2, z2):
@@ -260,41 +329,44 @@ def calculate_horizontal_distance(x1, z1, x2, z2):
     return math.sqrt((x2 - x1) ** 2 + (z2 - z1) ** 2)
 
 
-def save_request(data):
+def new_request_row(data):
     """
-    Saves a new request to the database.
+    Builds the row of a new request.
 
     @param data: A dictionary containing request details such as latitude,
                  longitude, muzzle speed, vertical angle, horizontal angle,
                  projectile weight, and sender.
-    @return: The ID of the newly created request.
+    @return: The Request, not yet added to the session.
     """
-    new_request = Request(
+    lat = dms_to_decimal(data['latitude'])
+    lon = dms_to_decimal(data['longitude'])
+    return Request(
         latitude=data['latitude'],
         longitude=data['longitude'],
+        latitude_decimal=lat,
+        longitude_decimal=lon,
+        geohash=geohash(lat, lon, REQUEST_GEOHASH_PRECISION),
         muzzle_speed=data['muzzle_speed'],
         vertical_angle=data['vertical_angle'],
         horizontal_angle=data['horizontal_angle'],
         projectile_weight=data['projectile_weight'],
+        # Set here rather than by the column default, since a buffered row may be written later
+        timestamp=datetime.now(),
         sender=data['sender']
     )
-    db.session.add(new_request)
-    db.session.commit()
-    return new_request.id
 
 
-def save_response(request_id, response_data):
+def new_response_row(response_data):
     """
-    Saves a new response to the database.
+    Builds the row of a new response.
 
-    @param request_id: The ID of the request that the response belongs to.
     @param response_data: A dictionary containing response details such as
                           final position, horizontal distance, maximum height,
                           maximum height relative to the starting altitude,
                           and flight time.
+    @return: The Response, not yet added to the session.
     """
-    new_response = Response(
-        request_id=request_id,
+    return Response(
         final_position_lat=response_data['final_position']['latitude'],
         final_position_lon=response_data['final_position']['longitude'],
         final_position_alt=response_data['final_position']['altitude'],
@@ -303,8 +375,266 @@ def save_response(request_id, response_data):
         max_height_relative=response_data['max_height_relative'],
         flight_time=response_data['flight_time']
     )
-    db.session.add(new_response)
-    db.session.commit()
+
+
+def save_shots(shots, extra_rows=(), archives=()):
+    """
+    Saves the requests with their responses, each pair in the same transaction.
+
+    @param shots: A list of (request data, response data) pairs
+    @param extra_rows: Other rows saved in the same transaction
+    @param archives: The TrajectoryArchive of each shot, or None for the shots without one
+    @return: The IDs of the new requests, or None if the history is written behind
+    """
+    pairs = [(new_request_row(data), new_response_row(response_data)) for data, response_data in shots]
+    for (_, response_row), archive in zip(pairs, archives):
+        response_row.archive = archive
+    return history_writer.save(pairs, extra_rows)
+
+
+def parse_shot(spec):
+    """
+    Reads the parameters of a shot from a JSON request body.
+
+    @param spec: A dictionary with latitude and longitude in DMS format, muzzle speed,
+                 vertical and horizontal angles in degrees, projectile weight and,
+                 optionally, the integrator, the number of trajectory points to return and whether
+                 the shot must follow the terrain.
+    @return: A dictionary with decimal coordinates and angles in radians.
+    @raise ValueError: If a parameter is missing or malformed.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("A shot must be a JSON object")
+
+    integrator = spec.get('integrator', 'euler')
+    if integrator not in INTEGRATORS:
+        raise ValueError(f"integrator must be one of {', '.join(INTEGRATORS)}")
+
+    trajectory_points = spec.get('trajectory_points', 0)
+    if not isinstance(trajectory_points, int) or isinstance(trajectory_points, bool) \
+            or trajectory_points != 0 and not 2 <= trajectory_points <= TRAJECTORY_MAX_POINTS:
+        raise ValueError(f"trajectory_points must be 0 or an integer between 2 and {TRAJECTORY_MAX_POINTS}")
+
+    terrain_accurate = spec.get('terrain_accurate', True)
+    if not isinstance(terrain_accurate, bool):
+        raise ValueError("terrain_accurate must be true or false")
+
+    try:
+        return {
+            'lat': dms_to_decimal(spec['latitude']),
+            'lon': dms_to_decimal(spec['longitude']),
+            'v0': float(spec['muzzle_speed']),
+            'vertical_angle': math.radians(spec['vertical_angle']),
+            'horizontal_angle': math.radians(spec['horizontal_angle']),
+            'm': float(spec['projectile_weight']),
+            'integrator': integrator,
+            'trajectory_points': trajectory_points,
+            'terrain_accurate': terrain_accurate,
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid shot parameters: {e}")
+
+
+def request_data(spec, sender):
+    """
+    Builds the data of the Request row recording a shot.
+
+    @param spec: The shot as received in the JSON request body
+    @param sender: The address of the client
+    @return: A dictionary for new_request_row
+    """
+    return {
+        'latitude': spec.get('latitude'),
+        'longitude': spec.get('longitude'),
+        'muzzle_speed': spec.get('muzzle_speed'),
+        'vertical_angle': spec.get('vertical_angle'),
+        'horizontal_angle': spec.get('horizontal_angle'),
+        'projectile_weight': spec.get('projectile_weight'),
+        'sender': sender
+    }
+
+
+def final_coordinates(lat, lon, final_position):
+    """
+    Converts the final position of a shot in its local frame into the geographic coordinates of its impact.
+
+    @param lat: The latitude of the starting position
+    @param lon: The longitude of the starting position
+    @param final_position: The (x, y, z) position of the impact, with x pointing North and z pointing East
+    @return: The latitude and longitude of the impact
+    """
+    latf, lonf = LocalFrame(lat, lon).to_geographic(final_position[0], final_position[2])
+    return float(latf), float(lonf)
+
+
+def trajectory_polyline(lat, lon, recorder, max_points):
+    """
+    Builds the downsampled trajectory of a shot.
+
+    @param lat: The latitude of the starting position
+    @param lon: The longitude of the starting position
+    @param recorder: The TrajectoryRecorder of the simulation
+    @param max_points: The maximum number of points returned
+    @return: A list of [latitude, longitude, altitude, time] points, laid out like final_coordinates
+    """
+    return to_polyline(recorder.points(), LocalFrame(lat, lon), max_points)
+
+
+def build_response(shot, start_alt, max_height, horizontal_distance, latf, lonf, alt):
+    """
+    Builds the response body of a shot.
+
+    @param shot: The shot, as returned by parse_shot
+    @param start_alt: The starting altitude
+    @param max_height: The maximum height reached
+    @param horizontal_distance: The horizontal distance traveled
+    @param latf: The latitude of the impact
+    @param lonf: The longitude of the impact
+    @param alt: The terrain altitude at the impact
+    @return: A dictionary with the final position, the distance, the heights and the flight time
+    """
+    flight_time = int(horizontal_distance / (shot['v0'] * math.cos(shot['vertical_angle'])))
+
+    return {
+        'final_position': {
+            'latitude': latf,
+            'longitude': lonf,
+            'altitude': alt,
+            'formatted': f"{decimal_to_dms(latf, 'latitude')}, {decimal_to_dms(lonf, 'longitude')}"
+        },
+        'horizontal_distance': horizontal_distance,
+        'max_height': max_height,
+        'max_height_relative': max_height - start_alt,
+        'flight_time': flight_time,
+    }
+
+
+def run_simulation(arguments):
+    """
+    Runs calculate_with_drag on a worker process.
+
+    @param arguments: A dictionary of keyword arguments for calculate_with_drag, and 'record' to also
+                      return the states of the flight
+    @return: The result of calculate_with_drag, and the recorded (t, x, y, z) states or None
+    """
+    arguments = dict(arguments)
+    recorder = TrajectoryRecorder() if arguments.pop('record', False) else None
+    result = calculate_with_drag(**arguments, recorder=recorder)
+    return result, None if recorder is None else recorder.points().copy()
+
+
+def solve_projectile(shot, spec, sender):
+    """
+    Simulates a shot and saves its request and response.
+
+    @param shot: The shot, as returned by parse_shot
+    @param spec: The shot as received in the JSON request body
+    @param sender: The address of the client
+    @return: The final position of the projectile, the maximum height reached, the horizontal distance traveled, and the flight time.
+    """
+    lat, lon = shot['lat'], shot['lon']
+    v0 = shot['v0']
+    vertical_angle = shot['vertical_angle']
+    horizontal_angle = shot['horizontal_angle']
+    m = shot['m']
+    terrain_accurate = shot['terrain_accurate']
+
+    # Identical shots within the same weather epoch share their result, but are still recorded in the history
+    key = results.result_key(shot, terrain_accurate)
+    cached = results.lookup(key)
+    if cached is not None:
+        save_shots([(request_data(spec, sender), cached)])
+        cached['cached'] = True
+        return cached
+
+    # Upstream data replaced by stale or fallback values is reported with the answer
+    with degradations() as degraded:
+        # Fast path: interpolate a precomputed firing table (flat terrain, no wind) when the caller allows it
+        approximation = None
+        recorder = TrajectoryRecorder() if shot['trajectory_points'] else None
+        if not terrain_accurate and recorder is None and (table := get_table(m, v0)) is not None:
+            alt, air_data = run_concurrently(
+                partial(get_altitude, lat, lon, default=None),
+                partial(get_weather_and_density, lat, lon),
+            )
+            approximation = table.lookup(vertical_angle, float(air_data.get('density') or DEFAULT_AIR_DENSITY))
+
+        if approximation is not None:
+            alt = float(alt)
+            start_alt = alt
+            horizontal_distance, apex, _ = approximation
+            max_height = alt + apex
+            # Without wind the impact lies on the firing azimuth
+            final_position = (horizontal_distance * math.cos(horizontal_angle), 0.0,
+                              horizontal_distance * math.sin(horizontal_angle))
+        else:
+            if recorder is None and TRAJECTORY_ARCHIVE:
+                # The full path of every simulated shot is archived
+                recorder = TrajectoryRecorder()
+            # The starting altitude, the weather and the terrain profile do not depend on each other
+            alt, air_data, profile = run_concurrently(
+                partial(get_altitude, lat, lon, default=None),
+                partial(get_weather_and_density, lat, lon),
+                partial(get_ground_profile, lat, lon, horizontal_angle, estimate_max_range(v0, vertical_angle, 0)),
+            )
+            alt = float(alt)
+            start_alt = alt
+
+            # Calcolo con attrito
+            with timed('simulation'):
+                final_position, max_height, horizontal_distance, flight_time = calculate_with_drag(
+                    lat, lon, m, v0, vertical_angle, horizontal_angle, alt, air_data, profile=profile,
+                    integrator=shot['integrator'], recorder=recorder
+                )
+
+        # Posizione finale (convertita in coordinate geografiche)
+        latf, lonf = final_coordinates(lat, lon, final_position)
+
+        alt = float(get_altitude(latf, lonf, default=start_alt))
+
+        response = build_response(shot, start_alt, max_height, horizontal_distance, latf, lonf, alt)
+
+        if approximation is not None:
+            response['approximate'] = True
+        if shot['trajectory_points']:
+            response['trajectory'] = trajectory_polyline(lat, lon, recorder, shot['trajectory_points'])
+
+    archives = [archive_row(recorder.points()) if TRAJECTORY_ARCHIVE and recorder is not None else None]
+    if degraded:
+        # A degraded result is not worth reusing: the next identical shot tries the upstreams again
+        response['degraded'] = sorted(degraded)
+        save_shots([(request_data(spec, sender), response)], archives=archives)
+    else:
+        save_shots([(request_data(spec, sender), response)], [results.remember(key, response)], archives)
+
+    return response
+
+
+@app.errorhandler(AltitudeUnavailable)
+def altitude_unavailable(error):
+    """
+    Refuses the shots whose firing position has no known altitude: starting them at a fallback altitude
+    would put them under the terrain, and they would land before leaving the muzzle.
+    Nothing is saved for such shots.
+
+    @param error: The AltitudeUnavailable raised while fetching the altitude of the firing position
+    @return: A JSON error with status 503
+    """
+    return jsonify({'error': f"The altitude of the firing position is unavailable: {error}"}), 503, \
+        {'Retry-After': str(round(UPSTREAM_BREAKER_COOLDOWN))}
+
+
+def run_job(flask_app, function, *args):
+    """
+    Runs a function inside an application context, for jobs executed outside of a request.
+
+    @param flask_app: The Flask application
+    @param function: The function to run
+    @param args: The arguments of the function
+    @return: The result of the function
+    """
+    with flask_app.app_context():
+        return function(*args)
 
 
 @app.route('/calculate/projectile_ballistics', methods=['POST'])
@@ -322,67 +652,741 @@ def calculate_projectile_ballistics():
     @param air_data: A dictionary containing air density, wind speed and direction
     @return: The final position of the projectile, the maximum height reached, the horizontal distance traveled, and the flight time.
     """
-    lat = dms_to_decimal(request.json.get('latitude'))
-    lon = dms_to_decimal(request.json.get('longitude'))
-    alt = float(get_altitude(lat, lon))
-    start_alt = alt
+    try:
+        shot = parse_shot(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    v0 = request.json.get('muzzle_speed')
-    vertical_angle = math.radians(request.json.get('vertical_angle'))
-    horizontal_angle = math.radians(request.json.get('horizontal_angle'))
-    m = request.json.get('projectile_weight')
+    return jsonify(solve_projectile(shot, request.json, request.remote_addr)), 200
 
-    air_data = get_weather_and_density(lat, lon)
 
-    # Calcolo con attrito
-    final_position, max_height, horizontal_distance, flight_time = calculate_with_drag(
-        lat, lon, m, v0, vertical_angle, horizontal_angle, alt, air_data
-    )
+@app.route('/calculate/projectile_ballistics/jobs', methods=['POST'])
+def submit_projectile_ballistics_job():
+    """
+    Queues the calculation of a trajectory and returns at once with the ID of the job.
 
-    request_id = save_request({
-        'latitude': request.json.get('latitude'),
-        'longitude': request.json.get('longitude'),
-        'muzzle_speed': v0,
-        'vertical_angle': request.json.get('vertical_angle'),
-        'horizontal_angle': request.json.get('horizontal_angle'),
-        'projectile_weight': m,
-        'sender': request.remote_addr
-    })
+    @return: The ID of the job and the URL to poll for its result, or 503 if the queue is full.
+    """
+    try:
+        shot = parse_shot(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        job = job_queue.submit(run_job, current_app._get_current_object(), solve_projectile,
+                               shot, request.json, request.remote_addr)
+    except QueueFull as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('api.get_job', job_id=job.id),
+    }), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Retrieves the status of a job and, once it is done, its result.
 
-    flight_time = int(horizontal_distance / (v0 * math.cos(vertical_angle)))
+    @param job_id: The ID of the job
+    @return: A JSON response with the status, the result or the error of the job.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': f"Unknown job: {job_id}"}), 404
+    return jsonify(job.to_dict()), 200
 
-    # Posizione finale (convertita in coordinate geografiche)
-    latf, lonf = calculate_new_coordinates(lat, lon, horizontal_distance, math.degrees(horizontal_angle))
 
-    alt = float(get_altitude(latf, lonf))
+@app.route('/jobs/stats', methods=['GET'])
+def get_job_stats():
+    """
+    Retrieves the depth of the job queue, the number of jobs by outcome and their waiting times.
 
-    response = {
-        'final_position': {
-            'latitude': latf,
-            'longitude': lonf,
-            'altitude': alt,
-            'formatted': f"{decimal_to_dms(latf, 'latitude')}, {decimal_to_dms(lonf, 'longitude')}"
+    @return: A JSON response with the queue statistics.
+    """
+    return jsonify(job_queue.stats()), 200
+
+
+@app.route('/persistence/stats', methods=['GET'])
+def get_persistence_stats():
+    """
+    Retrieves the state of the history writer.
+
+    @return: A JSON response with the persistence mode, the buffered and written rows and the flushes.
+    """
+    return jsonify(history_writer.stats()), 200
+
+
+@app.route('/upstream/stats', methods=['GET'])
+def get_upstream_stats():
+    """
+    Retrieves the state of the circuit breaker of every upstream service.
+
+    @return: A JSON response with the state, the consecutive failures and the trips of each circuit.
+    """
+    return jsonify(breaker_stats()), 200
+
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """
+    Retrieves the size, the hits and the misses of every cache.
+
+    @return: A JSON response with the statistics of each cache.
+    """
+    return jsonify({
+        'results': results.stats(),
+        'elevation': elevation_cache.stats(),
+        'weather': weather_cache.stats(),
+        'solutions': solution_cache.stats(),
+        'ground_profiles': profiles.stats(),
+    }), 200
+
+
+@app.before_request
+def trace_request():
+    """
+    Starts timing the stages of the request.
+    """
+    start_trace()
+
+
+@app.after_request
+def record_request(response):
+    """
+    Records the duration and the upstream calls of the request and, if enabled, adds its Server-Timing header.
+
+    @param response: The response of the request
+    @return: The response
+    """
+    trace = current_trace()
+    if trace is not None:
+        REQUEST_SECONDS.observe(perf_counter() - trace.started, endpoint=request.endpoint)
+        UPSTREAM_CALLS_PER_REQUEST.observe(trace.counts['upstream_calls'], endpoint=request.endpoint)
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
+
+@registry.collector
+def collect_state():
+    """
+    Reports the state of the caches, of the job queue, of the history writer and of the circuit breakers
+    at scrape time.
+
+    @return: A list of gauges
+    """
+    caches = {
+        'results': results.result_cache.stats(),
+        'elevation': elevation_cache.stats(),
+        'weather': weather_cache.stats(),
+        'solutions': solution_cache.stats(),
+    }
+    jobs = job_queue.stats()
+    persistence = history_writer.stats()
+    breakers = breaker_stats()
+    return [
+        (f'ballistics_cache_{field}', f'Cache {field.replace("_", " ")}',
+         [({'cache': name}, stats[field]) for name, stats in caches.items()])
+        for field in ('size', 'hits', 'stale_hits', 'misses', 'evictions', 'hit_ratio')
+    ] + [
+        ('ballistics_jobs_depth', 'Jobs waiting in the queue', [({}, jobs['depth'])]),
+        ('ballistics_jobs_running', 'Jobs running', [({}, jobs['running'])]),
+        ('ballistics_history_pending', 'Rows waiting to be written to the history', [({}, persistence['pending'])]),
+        ('ballistics_upstream_circuit_open', 'Whether the circuit of an upstream service is open (0.5 half open)',
+         [({'service': name}, {'closed': 0, 'half_open': 0.5, 'open': 1}[stats['state']])
+          for name, stats in breakers.items()]),
+        ('ballistics_upstream_circuit_trips', 'Times the circuit of an upstream service opened',
+         [({'service': name}, stats['trips']) for name, stats in breakers.items()]),
+    ]
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Exposes the stage timings, the upstream calls, the integration steps and the cache statistics.
+
+    @return: The metrics in the Prometheus text format.
+    """
+    return current_app.response_class(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/profiler', methods=['GET', 'POST', 'DELETE'])
+def sampling_profiler():
+    """
+    Controls the sampling profiler: POST starts it, DELETE stops it and GET returns the samples
+    as collapsed stacks. Only available when PROFILER_ENABLED is set.
+
+    @param interval: The time between two samples in seconds (POST, default 0.005)
+    @param limit: The maximum number of stacks returned (GET)
+    @return: The state of the profiler, or its samples.
+    """
+    if not PROFILER_ENABLED:
+        return jsonify({'error': "The profiler is disabled (set PROFILER_ENABLED)"}), 403
+
+    try:
+        if request.method == 'POST':
+            interval = float(request.args.get('interval', 0.005))
+            if not 0.0005 <= interval <= 1:
+                raise ValueError("interval must be between 0.0005 and 1 second")
+            if not profiler.start(interval):
+                return jsonify({'error': "The profiler is already running"}), 409
+        elif request.method == 'DELETE':
+            profiler.stop()
+        else:
+            limit = int(request.args['limit']) if request.args.get('limit') else None
+            return current_app.response_class(profiler.report(limit), mimetype='text/plain')
+    except ValueError as e:
+        return jsonify({'error': f"Invalid profiler parameters: {e}"}), 400
+
+    return jsonify(profiler.state()), 200
+
+
+@app.route('/calculate/projectile_ballistics/batch', methods=['POST'])
+def calculate_projectile_ballistics_batch():
+    """
+    Calculates the trajectories of several projectiles in one call. Lookups are shared between
+    shots fired from the same position (altitude, weather) and along the same azimuth (terrain
+    profile), the simulations run on a process pool and all rows are saved in one transaction.
+
+    @return: The results of the shots, in the same order as the request.
+    """
+    body = request.json
+    specs = body.get('shots') if isinstance(body, dict) else body
+    if not isinstance(specs, list) or not specs:
+        return jsonify({'error': "The body must contain a non-empty list of shots"}), 400
+    if len(specs) > BATCH_MAX_SHOTS:
+        return jsonify({'error': f"A batch may contain at most {BATCH_MAX_SHOTS} shots"}), 400
+
+    shots = []
+    for i, spec in enumerate(specs):
+        try:
+            shots.append(parse_shot(spec))
+        except (AttributeError, ValueError) as e:
+            return jsonify({'error': f"Shot {i}: {e}"}), 400
+
+    # Shots allowed to interpolate a ready firing table (flat terrain, no wind) need no terrain profile
+    tables = {}
+    for i, shot in enumerate(shots):
+        if not shot['terrain_accurate'] and not shot['trajectory_points']:
+            table = get_table(shot['m'], shot['v0'])
+            if table is not None:
+                tables[i] = table
+
+    # Lookups shared by the shots with the same origin, and profiles shared along the same azimuth
+    origins = list(dict.fromkeys((shot['lat'], shot['lon']) for shot in shots))
+    tracks = {}
+    for i, shot in enumerate(shots):
+        if i not in tables:
+            key = (shot['lat'], shot['lon'], shot['horizontal_angle'])
+            tracks[key] = max(tracks.get(key, 0), estimate_max_range(shot['v0'], shot['vertical_angle'], 0))
+
+    # Upstream data replaced by stale or fallback values is reported with the answers
+    with degradations() as degraded:
+        results = run_concurrently(
+            *(partial(get_altitude, lat, lon, default=None) for lat, lon in origins),
+            *(partial(get_weather_and_density, lat, lon) for lat, lon in origins),
+            *(partial(get_ground_profile, *key, distance) for key, distance in tracks.items()),
+        )
+        altitudes = {origin: float(alt) for origin, alt in zip(origins, results[:len(origins)])}
+        weather = dict(zip(origins, results[len(origins):2 * len(origins)]))
+        profiles = dict(zip(tracks, results[2 * len(origins):]))
+
+        approximations = {}
+        for i, table in tables.items():
+            air_data = weather[(shots[i]['lat'], shots[i]['lon'])]
+            approximation = table.lookup(shots[i]['vertical_angle'],
+                                         float(air_data.get('density') or DEFAULT_AIR_DENSITY))
+            if approximation is not None:
+                approximations[i] = approximation
+
+        # Shots outside the grid of their table are simulated after all
+        missing = {}
+        for i, shot in enumerate(shots):
+            key = (shot['lat'], shot['lon'], shot['horizontal_angle'])
+            if i not in approximations and key not in profiles:
+                missing[key] = max(missing.get(key, 0), estimate_max_range(shot['v0'], shot['vertical_angle'], 0))
+        if missing:
+            profiles.update(zip(missing, run_concurrently(
+                *(partial(get_ground_profile, *key, distance) for key, distance in missing.items())
+            )))
+
+        simulated = [i for i in range(len(shots)) if i not in approximations]
+        with timed('simulation'):
+            outcomes = map_in_processes(run_simulation, [{
+                'lat': shots[i]['lat'],
+                'lon': shots[i]['lon'],
+                'm': shots[i]['m'],
+                'v0': shots[i]['v0'],
+                'angle_vertical': shots[i]['vertical_angle'],
+                'angle_horizontal': shots[i]['horizontal_angle'],
+                'alt': altitudes[(shots[i]['lat'], shots[i]['lon'])],
+                'air_data': weather[(shots[i]['lat'], shots[i]['lon'])],
+                'profile': profiles[(shots[i]['lat'], shots[i]['lon'], shots[i]['horizontal_angle'])],
+                'integrator': shots[i]['integrator'],
+                # The full path of every simulated shot is archived
+                'record': bool(shots[i]['trajectory_points']) or TRAJECTORY_ARCHIVE,
+            } for i in simulated])
+
+        simulations = [None] * len(shots)
+        paths = [None] * len(shots)
+        for i, (simulation, points) in zip(simulated, outcomes):
+            simulations[i] = simulation
+            paths[i] = points
+        for i, (horizontal_distance, apex, flight_time) in approximations.items():
+            # Without wind the impact lies on the firing azimuth
+            horizontal_angle = shots[i]['horizontal_angle']
+            simulations[i] = ((horizontal_distance * math.cos(horizontal_angle), 0.0,
+                               horizontal_distance * math.sin(horizontal_angle)),
+                              altitudes[(shots[i]['lat'], shots[i]['lon'])] + apex, horizontal_distance, flight_time)
+
+        # Impact positions, converted in one pass, with their altitudes fetched in batches
+        latitudes, longitudes = to_geographic([shot['lat'] for shot in shots], [shot['lon'] for shot in shots],
+                                              [final_position[0] for final_position, _, _, _ in simulations],
+                                              [final_position[2] for final_position, _, _, _ in simulations])
+        impacts = list(zip(latitudes.tolist(), longitudes.tolist()))
+        impact_altitudes = get_altitudes(impacts)
+
+    responses = []
+    for i, (shot, (_, max_height, horizontal_distance, _), (latf, lonf), alt) in enumerate(zip(
+            shots, simulations, impacts, impact_altitudes)):
+        response = build_response(shot, altitudes[(shot['lat'], shot['lon'])], max_height,
+                                  horizontal_distance, latf, lonf, float(alt))
+        if i in approximations:
+            response['approximate'] = True
+        if shot['trajectory_points']:
+            response['trajectory'] = to_polyline(paths[i], LocalFrame(shot['lat'], shot['lon']),
+                                                 shot['trajectory_points'])
+        responses.append(response)
+    archives = [archive_row(points) if TRAJECTORY_ARCHIVE and points is not None else None for points in paths]
+    save_shots([(request_data(spec, request.remote_addr), response) for spec, response in zip(specs, responses)],
+               archives=archives)
+
+    body = {'results': responses}
+    if degraded:
+        body['degraded'] = sorted(degraded)
+    return jsonify(body), 200
+
+
+@app.route('/calculate/firing_solution', methods=['POST'])
+def calculate_firing_solution():
+    """
+    Calculates the vertical and horizontal angles needed to hit a target with a given projectile.
+    The terrain profile and the weather are fetched once, the elevations are bracketed and refined
+    by regula falsi over calculate_with_drag, and solutions for nearby targets are used as starting points.
+    The azimuth of each solution is then corrected for the drift of its impact.
+
+    @return: The low-angle and high-angle firing solutions.
+    """
+    body = request.json
+    try:
+        lat = dms_to_decimal(body['latitude'])
+        lon = dms_to_decimal(body['longitude'])
+        target_lat = dms_to_decimal(body['target_latitude'])
+        target_lon = dms_to_decimal(body['target_longitude'])
+        v0 = float(body['muzzle_speed'])
+        m = float(body['projectile_weight'])
+        tolerance = float(body.get('tolerance', 1.0))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f"Invalid firing solution parameters: {e}"}), 400
+    integrator = body.get('integrator', 'euler')
+    if integrator not in INTEGRATORS:
+        return jsonify({'error': f"integrator must be one of {', '.join(INTEGRATORS)}"}), 400
+
+    distance = great_circle_distance(lat, lon, target_lat, target_lon)
+    bearing = horizontal_angle_to(lat, lon, target_lat, target_lon)
+
+    # Upstream data replaced by stale or fallback values is reported with the solutions
+    with degradations() as degraded:
+        alt, air_data, profile = run_concurrently(
+            partial(get_altitude, lat, lon, default=None),
+            partial(get_weather_and_density, lat, lon),
+            partial(get_ground_profile, lat, lon, bearing, distance * 1.1),
+        )
+        alt = float(alt)
+
+        def evaluate(vertical_angle):
+            return calculate_with_drag(lat, lon, m, v0, vertical_angle, bearing, alt, air_data,
+                                       profile=profile, integrator=integrator)
+
+        def scan(vertical_angles):
+            if integrator == 'euler':
+                return list(zip(*simulate_batch(m, v0, vertical_angles, bearing, alt, air_data, profile)))
+            return [evaluate(vertical_angle) for vertical_angle in vertical_angles]
+
+        def evaluate_at(azimuth):
+            # The terrain is sampled again along the corrected azimuth
+            turned_profile = get_ground_profile(lat, lon, azimuth, distance * 1.1)
+
+            def evaluate_turned(vertical_angle):
+                return calculate_with_drag(lat, lon, m, v0, vertical_angle, azimuth, alt, air_data,
+                                           profile=turned_profile, integrator=integrator)
+            return evaluate_turned
+
+        key = solution_key(lat, lon, target_lat, target_lon, v0, m, integrator)
+        aimed = {'low': None, 'high': None}
+        with timed('simulation'):
+            solutions = solve_elevations(evaluate, scan, distance, warm=solution_cache.get(key), tolerance=tolerance)
+            apex_angle = solutions['apex_angle']
+            branches = {'low': (True, MIN_ANGLE, apex_angle), 'high': (False, apex_angle, MAX_ANGLE)}
+            for name, (rising, lower, upper) in branches.items():
+                if solutions[name] is not None:
+                    # The crosswind drifts the impact off the bearing of the target
+                    azimuth, vertical_angle, result, count = refine_azimuth(
+                        evaluate_at, distance, bearing, solutions[name], rising, lower, upper, tolerance)
+                    aimed[name] = (azimuth, vertical_angle, result)
+                    solutions['simulations'] += count
+
+    if solutions['low'] is None and solutions['high'] is None:
+        return jsonify({'error': "Target out of range", 'distance': distance}), 422
+
+    if not degraded:
+        solution_cache.set(key, {
+            'apex_angle': solutions['apex_angle'],
+            'low': solutions['low'][0] if solutions['low'] else None,
+            'high': solutions['high'][0] if solutions['high'] else None,
+        })
+
+    def describe(solution):
+        if solution is None:
+            return None
+        azimuth, vertical_angle, (final_position, max_height, horizontal_distance, flight_time) = solution
+        impact_lat, impact_lon = final_coordinates(lat, lon, final_position)
+        return {
+            'vertical_angle': math.degrees(vertical_angle),
+            'horizontal_angle': math.degrees(azimuth),
+            'horizontal_distance': float(horizontal_distance),
+            # Distance between the simulated impact and the target
+            'miss_distance': great_circle_distance(impact_lat, impact_lon, target_lat, target_lon),
+            'max_height': float(max_height),
+            'max_height_relative': float(max_height) - alt,
+            'flight_time': float(flight_time),
+        }
+
+    body = {
+        'target': {
+            'distance': distance,
+            'bearing': math.degrees(bearing),
         },
-        'horizontal_distance': horizontal_distance,
-        'max_height': max_height,
-        'max_height_relative': max_height - start_alt,
-        'flight_time': flight_time,
+        'low': describe(aimed['low']),
+        'high': describe(aimed['high']),
+        'simulations': solutions['simulations'],
+    }
+    if degraded:
+        body['degraded'] = sorted(degraded)
+    return jsonify(body), 200
+
+
+def run_dispersion_chunk(arguments):
+    """
+    Runs a chunk of the samples of a dispersion analysis on a worker process.
+
+    @param arguments: A dictionary of keyword arguments for simulate_batch
+    @return: The final positions, the maximum heights, the horizontal distances and the flight times
+    """
+    return simulate_batch(**arguments)
+
+
+@app.route('/calculate/dispersion', methods=['POST'])
+def calculate_dispersion():
+    """
+    Estimates the spread of the impacts of a shot by Monte Carlo simulation: the muzzle speed, the angles,
+    the mass and the wind are drawn from the distributions given by the caller, and all the samples are
+    integrated together by the vectorized engine over the terrain profile of the nominal shot.
+
+    @return: The nominal and mean impacts, the covariance and ellipses of the impacts, the CEP and,
+             optionally, the contours enclosing given percentages of the impacts.
+    """
+    body = request.json
+    try:
+        shot = parse_shot(body)
+        samples = int(body.get('samples', 1000))
+        if not 1 < samples <= DISPERSION_MAX_SAMPLES:
+            raise ValueError(f"samples must be between 2 and {DISPERSION_MAX_SAMPLES}")
+        dt = float(body.get('dt', 0.01))
+        if not 0.001 <= dt <= 0.1:
+            raise ValueError("dt must be between 0.001 and 0.1")
+        confidence = float(body.get('confidence', 0.95))
+        if not 0 < confidence < 1:
+            raise ValueError("confidence must be between 0 and 1")
+        percentiles = [float(p) for p in body.get('percentiles', [])]
+        if any(not 0 < p < 100 for p in percentiles):
+            raise ValueError("percentiles must be between 0 and 100")
+        perturbations = body.get('dispersion', {})
+        if not isinstance(perturbations, dict):
+            raise ValueError("dispersion must be an object")
+        rng = np.random.default_rng(body.get('seed'))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    lat, lon = shot['lat'], shot['lon']
+    # Upstream data replaced by stale or fallback values is reported with the analysis
+    with degradations() as degraded:
+        alt, air_data = run_concurrently(
+            partial(get_altitude, lat, lon, default=None),
+            partial(get_weather_and_density, lat, lon),
+        )
+    alt = float(alt)
+
+    try:
+        # The nominal shot comes first, followed by the perturbed samples
+        n = samples + 1
+        v0 = np.abs(draw(rng, shot['v0'], perturbations.get('muzzle_speed'), n))
+        vertical_angles = np.radians(draw(rng, body['vertical_angle'], perturbations.get('vertical_angle'), n))
+        horizontal_angles = np.radians(draw(rng, body['horizontal_angle'], perturbations.get('horizontal_angle'), n))
+        masses = draw(rng, shot['m'], perturbations.get('projectile_weight'), n)
+        wind_speed = np.abs(draw(rng, air_data['wind_speed'], perturbations.get('wind_speed'), n))
+        wind_deg = draw(rng, air_data['wind_deg'], perturbations.get('wind_deg'), n)
+        if np.any(masses <= 0):
+            raise ValueError("the projectile_weight dispersion produces non-positive masses")
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f"Invalid dispersion: {e}"}), 400
+    v0[0], vertical_angles[0], horizontal_angles[0] = shot['v0'], shot['vertical_angle'], shot['horizontal_angle']
+    masses[0], wind_speed[0], wind_deg[0] = shot['m'], air_data['wind_speed'], air_data['wind_deg']
+
+    # One profile along the nominal azimuth, long enough for the fastest sample
+    with degradations() as profile_degraded:
+        profile = get_ground_profile(lat, lon, shot['horizontal_angle'],
+                                     estimate_max_range(float(v0.max()), math.radians(45), 0))
+    degraded |= profile_degraded
+
+    # The samples are split in chunks integrated on the process pool
+    chunks = np.array_split(np.arange(n), max(1, min(SIMULATION_WORKERS, n // DISPERSION_CHUNK_SIZE)))
+    with timed('simulation'):
+        outcomes = map_in_processes(run_dispersion_chunk, [{
+            'm': masses[chunk],
+            'v0': v0[chunk],
+            'angle_vertical': vertical_angles[chunk],
+            'angle_horizontal': horizontal_angles[chunk],
+            'alt': alt,
+            'air_data': {'density': air_data.get('density'), 'wind_speed': wind_speed[chunk],
+                         'wind_deg': wind_deg[chunk]},
+            'profile': profile,
+            'dt': dt,
+        } for chunk in chunks])
+    final = np.concatenate([outcome[0] for outcome in outcomes])
+    max_heights = np.concatenate([outcome[1] for outcome in outcomes])
+    distances = np.concatenate([outcome[2] for outcome in outcomes])
+    times = np.concatenate([outcome[3] for outcome in outcomes])
+
+    # The simulation frame has x pointing North and z pointing East
+    frame = LocalFrame(lat, lon)
+    north, east = final[:, 0], final[:, 2]
+    spread = summarize_dispersion(north[1:], east[1:], percentiles)
+    mean_north, mean_east = spread['mean']
+    nominal_lat, nominal_lon = frame.to_geographic(north[0], east[0])
+    mean_lat, mean_lon = frame.to_geographic(mean_north, mean_east)
+
+    contours = {}
+    for percentile, vertices in spread['contours'].items():
+        latitudes, longitudes = frame.to_geographic(vertices[:, 0], vertices[:, 1])
+        contours[f'{percentile:g}'] = np.column_stack((latitudes, longitudes)).tolist()
+
+    body = {
+        'samples': samples,
+        'nominal_impact': {
+            'latitude': float(nominal_lat),
+            'longitude': float(nominal_lon),
+            'north': float(north[0]),
+            'east': float(east[0]),
+            'horizontal_distance': float(distances[0]),
+            'max_height': float(max_heights[0]),
+            'flight_time': float(times[0]),
+        },
+        'mean_impact': {
+            'latitude': float(mean_lat),
+            'longitude': float(mean_lon),
+            'altitude': float(profile.altitude_at(math.hypot(mean_north, mean_east))),
+            'north': float(mean_north),
+            'east': float(mean_east),
+        },
+        'covariance': spread['covariance'].tolist(),
+        'ellipse': ellipse(spread['covariance']),
+        'confidence_ellipse': dict(ellipse(spread['covariance'], confidence_scale(confidence)),
+                                   confidence=confidence),
+        'cep': spread['cep'],
+        'horizontal_distance': {'mean': float(distances[1:].mean()), 'std': float(distances[1:].std(ddof=1))},
+        'flight_time': {'mean': float(times[1:].mean()), 'std': float(times[1:].std(ddof=1))},
+        'contours': contours,
     }
+    if degraded:
+        body['degraded'] = sorted(degraded)
+    return jsonify(body), 200
+
+
+def parse_history_filters(args):
+    """
+    Reads the filters of the history endpoints from the query string.
+
+    @param args: The query string arguments
+    @return: A dictionary with the sender, the time range (since, until), the bounding box of the origin
+             and the geohash prefix of the origin
+    @raise ValueError: If a filter is malformed
+    """
+    filters = {'sender': args.get('sender'), 'since': None, 'until': None, 'bbox': None,
+               'geohash': args.get('geohash')}
+    if filters['geohash'] and not re.fullmatch(r'[0-9b-hjkmnp-z]{1,12}', filters['geohash']):
+        raise ValueError("geohash must be a geohash prefix of 1 to 12 characters")
+    for name in ('since', 'until'):
+        if args.get(name):
+            filters[name] = datetime.fromisoformat(args[name])
+    if args.get('bbox'):
+        min_lat, min_lon, max_lat, max_lon = (float(value) for value in args['bbox'].split(','))
+        filters['bbox'] = (min_lat, min_lon, max_lat, max_lon)
+    return filters
+
+
+def history_conditions(filters):
+    """
+    Translates the history filters into SQL conditions on the indexed columns of Request.
 
-    save_response(request_id, response)
+    @param filters: The filters returned by parse_history_filters
+    @return: A list of SQLAlchemy conditions
+    """
+    conditions = []
+    if filters['sender']:
+        conditions.append(Request.sender == filters['sender'])
+    if filters['since']:
+        conditions.append(Request.timestamp >= filters['since'])
+    if filters['until']:
+        conditions.append(Request.timestamp < filters['until'])
+    if filters['bbox'] is not None:
+        min_lat, min_lon, max_lat, max_lon = filters['bbox']
+        conditions.append(Request.latitude_decimal.between(min_lat, max_lat))
+        conditions.append(Request.longitude_decimal.between(min_lon, max_lon))
+    if filters['geohash']:
+        # A prefix match written as a range, so that it can use the index on every backend
+        prefix = filters['geohash']
+        conditions.append(Request.geohash >= prefix)
+        conditions.append(Request.geohash < prefix + '~')
+    return conditions
+
+
+def history_query(filters):
+    """
+    Builds the query of the requests matching the history filters, with their responses loaded by the same join.
 
-    return jsonify(response), 200
+    @param filters: The filters returned by parse_history_filters
+    @return: A SQLAlchemy query of Request
+    """
+    query = Request.query.outerjoin(Request.response).options(contains_eager(Request.response))
+    return query.filter(*history_conditions(filters))
 
 
 @app.route('/get/requests', methods=['GET'])
 def get_requests():
     """
-    Retrieves all requests from the database.
+    Retrieves a page of requests from the database, with keyset pagination on the request ID.
 
-    @return: A JSON response containing a list of all requests.
+    @param limit: The maximum number of requests returned (capped by HISTORY_PAGE_SIZE_MAX)
+    @param cursor: The next_cursor of the previous page
+    @param order: 'asc' (oldest first, default) or 'desc' (newest first)
+    @param sender, since, until, bbox, geohash: Optional filters on the sender, the time range and the origin
+    @return: A JSON response containing the page of requests and the cursor of the next page.
     """
-    api_requests = Request.query.all()
-    return jsonify([r.to_dict() for r in api_requests]), 200
+    try:
+        limit = min(int(request.args.get('limit', HISTORY_PAGE_SIZE)), HISTORY_PAGE_SIZE_MAX)
+        cursor = int(request.args['cursor']) if request.args.get('cursor') else None
+        order = request.args.get('order', 'asc')
+        if order not in ('asc', 'desc') or limit < 1:
+            raise ValueError("order must be 'asc' or 'desc' and limit must be positive")
+        filters = parse_history_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid history parameters: {e}"}), 400
+
+    query = history_query(filters)
+    descending = order == 'desc'
+    query = query.order_by(Request.id.desc() if descending else Request.id.asc())
+    if cursor is not None:
+        query = query.filter(Request.id < cursor if descending else Request.id > cursor)
+
+    # One extra row tells whether there is a next page
+    page = query.limit(limit + 1).all()
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    return jsonify({
+        'requests': [r.to_dict() for r in page],
+        'next_cursor': page[-1].id if has_more else None,
+    }), 200
+
+
+def export_rows(filters, after_id):
+    """
+    Streams the flattened request/response rows matching the history filters, fetching them in batches
+    through a server-side cursor.
+
+    @param filters: The filters returned by parse_history_filters
+    @param after_id: Only the requests with a greater ID are exported (to resume an interrupted export)
+    @return: A generator of dictionaries, one per request, ordered by request ID
+    """
+    query = (
+        select(*EXPORT_COLUMNS.values())
+        .select_from(Request)
+        .outerjoin(Response, Response.request_id == Request.id)
+        .order_by(Request.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    if after_id is not None:
+        query = query.where(Request.id > after_id)
+    query = query.where(*history_conditions(filters))
+
+    for row in db.session.execute(query):
+        data = dict(zip(EXPORT_COLUMNS, row))
+        if data['timestamp'] is not None:
+            data['timestamp'] = data['timestamp'].isoformat()
+        yield data
+
+
+@app.route('/export/requests', methods=['GET'])
+def export_requests():
+    """
+    Exports the whole history of requests and responses as NDJSON or CSV, streamed with constant memory.
+
+    @param format: 'ndjson' (default) or 'csv'
+    @param after_id: Resume the export after this request ID
+    @param sender, since, until, bbox, geohash: Optional filters, as for /get/requests
+    @return: A streamed response with one line per request.
+    """
+    try:
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            raise ValueError("format must be 'ndjson' or 'csv'")
+        after_id = int(request.args['after_id']) if request.args.get('after_id') else None
+        filters = parse_history_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid export parameters: {e}"}), 400
+
+    rows = export_rows(filters, after_id)
+
+    if export_format == 'ndjson':
+        def generate():
+            for data in rows:
+                yield json.dumps(data, ensure_ascii=False) + '\n'
+        mimetype = 'application/x-ndjson'
+    else:
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=list(EXPORT_COLUMNS))
+            writer.writeheader()
+            # The header is sent before the first batch is read, so that the download starts at once
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            for i, data in enumerate(rows, 1):
+                writer.writerow(data)
+                if i % EXPORT_BATCH_SIZE == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        mimetype = 'text/csv'
+
+    return current_app.response_class(stream_with_context(generate()), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=requests.{export_format}'
+    })
 
 
 @app.route('/get/request/<request_id>', methods=['GET'])
@@ -393,5 +1397,191 @@ def get_request_by_id(request_id):
     @param request_id: The ID of the request to retrieve.
     @return: A JSON response containing the request details.
     """
-    api_requests = Request.query.filter_by(id=request_id).all()
+    api_requests = (Request.query.outerjoin(Request.response).options(contains_eager(Request.response))
+                    .filter(Request.id == request_id).all())
     return jsonify([r.to_dict() for r in api_requests]), 200
+
+
+@app.route('/get/request/<int:request_id>/trajectory', methods=['GET'])
+def get_trajectory(request_id):
+    """
+    Streams the archived trajectory of a shot, or a time slice of it. Only the blocks of the archive
+    overlapping the slice are read and decoded.
+
+    @param request_id: The ID of the request of the shot
+    @param format: 'ndjson' (default) or 'csv'
+    @param since, until: Optional bounds of the slice, in seconds since the shot
+    @return: A streamed response with one line per state: the time, the geographic position and altitude,
+             and the offsets towards the North and the East from the firing position.
+    """
+    try:
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            raise ValueError("format must be 'ndjson' or 'csv'")
+        since = float(request.args['since']) if request.args.get('since') else None
+        until = float(request.args['until']) if request.args.get('until') else None
+    except ValueError as e:
+        return jsonify({'error': f"Invalid trajectory parameters: {e}"}), 400
+
+    shot = db.session.execute(
+        select(Response.id, Request.latitude, Request.longitude, Request.latitude_decimal, Request.longitude_decimal)
+        .join(Response, Response.request_id == Request.id)
+        .where(Request.id == request_id)
+    ).first()
+    archive = read_index(shot.id) if shot is not None else None
+    if archive is None:
+        return jsonify({'error': "No archived trajectory for this request"}), 404
+
+    lat = shot.latitude_decimal if shot.latitude_decimal is not None else dms_to_decimal(shot.latitude)
+    lon = shot.longitude_decimal if shot.longitude_decimal is not None else dms_to_decimal(shot.longitude)
+    frame = LocalFrame(lat, lon)
+    columns = ('time', 'latitude', 'longitude', 'altitude', 'north', 'east')
+
+    def states():
+        for points in read_points(*archive, since=since, until=until):
+            # Rounded to the precision of the float32 archive, so that no spurious digits are printed
+            times = np.round(points[:, 0].astype(float), 4)
+            x, y, z = (np.round(points[:, i].astype(float), 3) for i in (1, 2, 3))
+            latitudes, longitudes = frame.to_geographic(x, z)
+            yield from zip(times.tolist(), latitudes.tolist(), longitudes.tolist(), y.tolist(), x.tolist(), z.tolist())
+
+    if export_format == 'ndjson':
+        def generate():
+            for state in states():
+                yield json.dumps(dict(zip(columns, state))) + '\n'
+        mimetype = 'application/x-ndjson'
+    else:
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+            for i, state in enumerate(states(), 1):
+                writer.writerow(state)
+                if i % EXPORT_BATCH_SIZE == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        mimetype = 'text/csv'
+
+    return current_app.response_class(stream_with_context(generate()), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=trajectory_{request_id}.{export_format}'
+    })
+
+
+def parse_analytics_source(args, filters, bucket=None):
+    """
+    Chooses between the rollups and the history for an analytics query.
+
+    @param args: The query string arguments, where source is 'auto' (default) or 'raw'
+    @param filters: The filters returned by parse_history_filters
+    @param bucket: The time bucket of the query, if any
+    @return: True if the query is served from the rollups
+    @raise ValueError: If the source is unknown
+    """
+    source = args.get('source', 'auto')
+    if source not in ('auto', 'raw'):
+        raise ValueError("source must be 'auto' or 'raw'")
+    return source == 'auto' and analytics.rollup_eligible(filters, bucket)
+
+
+def parse_bucket(args, default=None):
+    """
+    @param args: The query string arguments
+    @param default: The bucket used when none is given
+    @return: The time bucket of an analytics query
+    @raise ValueError: If the bucket is unknown
+    """
+    bucket = args.get('bucket', default)
+    if bucket is not None and bucket not in analytics.BUCKETS:
+        raise ValueError(f"bucket must be one of {', '.join(analytics.BUCKETS)}")
+    return bucket
+
+
+@app.route('/analytics/senders', methods=['GET'])
+def analytics_senders():
+    """
+    Aggregates the history per sender in SQL: number of shots, mean and maximum range and apex.
+
+    @param limit: The maximum number of senders returned, busiest first (capped by HISTORY_PAGE_SIZE_MAX)
+    @param source: 'auto' to use the rollups when enabled and exact, 'raw' to always aggregate the history
+    @param sender, since, until, bbox, geohash: Optional filters, as for /get/requests
+    @return: A JSON response with the aggregates of each sender and the source they were computed from.
+    """
+    try:
+        limit = min(int(request.args.get('limit', HISTORY_PAGE_SIZE)), HISTORY_PAGE_SIZE_MAX)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        filters = parse_history_filters(request.args)
+        rollup = parse_analytics_source(request.args, filters)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid analytics parameters: {e}"}), 400
+
+    with timed('db'):
+        if rollup:
+            conditions = analytics.rollup_conditions(filters)
+        else:
+            conditions = history_conditions(filters)
+        senders = analytics.summarize_senders(conditions, limit, rollup=rollup)
+    return jsonify({'source': 'rollup' if rollup else 'raw', 'senders': senders}), 200
+
+
+@app.route('/analytics/timeseries', methods=['GET'])
+def analytics_timeseries():
+    """
+    Aggregates the history per time bucket in SQL: number of shots, mean and maximum range and apex.
+
+    @param bucket: 'minute', 'hour' (default) or 'day'
+    @param by_sender: 'true' to split every bucket by sender
+    @param source: 'auto' to use the rollups when enabled and exact, 'raw' to always aggregate the history
+    @param sender, since, until, bbox, geohash: Optional filters, as for /get/requests
+    @return: A JSON response with the series in chronological order and the source it was computed from.
+    """
+    try:
+        bucket = parse_bucket(request.args, 'hour')
+        by_sender = request.args.get('by_sender', 'false').lower() in ('1', 'true')
+        filters = parse_history_filters(request.args)
+        rollup = parse_analytics_source(request.args, filters, bucket)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid analytics parameters: {e}"}), 400
+
+    with timed('db'):
+        if rollup:
+            conditions = analytics.rollup_conditions(filters)
+        else:
+            conditions = history_conditions(filters)
+        series = analytics.time_series(conditions, bucket, by_sender=by_sender, rollup=rollup)
+    return jsonify({'source': 'rollup' if rollup else 'raw', 'bucket': bucket, 'series': series}), 200
+
+
+@app.route('/analytics/distribution', methods=['GET'])
+def analytics_distribution():
+    """
+    Computes the quantiles of a metric of the history in SQL, overall or per time bucket.
+
+    @param metric: 'horizontal_distance', 'max_height', 'max_height_relative' (default) or 'flight_time'
+    @param quantiles: The number of equal groups the shots are ranked into (default 4, at most 100)
+    @param bucket: Optional time bucket: 'minute', 'hour' or 'day'
+    @param sender, since, until, bbox, geohash: Optional filters, as for /get/requests
+    @return: A JSON response with, for each bucket, the number of shots, the minimum and the upper bound of each group.
+    """
+    try:
+        metric = request.args.get('metric', 'max_height_relative')
+        if metric not in analytics.METRICS:
+            raise ValueError(f"metric must be one of {', '.join(analytics.METRICS)}")
+        quantiles = int(request.args.get('quantiles', 4))
+        if not 2 <= quantiles <= analytics.ANALYTICS_MAX_QUANTILES:
+            raise ValueError(f"quantiles must be between 2 and {analytics.ANALYTICS_MAX_QUANTILES}")
+        bucket = parse_bucket(request.args)
+        filters = parse_history_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid analytics parameters: {e}"}), 400
+
+    with timed('db'):
+        groups = analytics.distribution(history_conditions(filters), metric, quantiles, bucket)
+    body = {'metric': metric, 'quantiles': quantiles}
+    if bucket:
+        body.update(bucket=bucket, series=groups)
+    else:
+        body.update(groups[0] if groups else {'shots': 0, 'min': None, 'bounds': []})
+    return jsonify(body), 200
@@ -0,0 +1,134 @@
+"""Numeric coordinates and history indexes
+
+Revision ID: 5b0f3c9e7a21
+Revises: c337e229d453
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0f3c9e7a21'
+down_revision = 'c337e229d453'
+branch_labels = None
+depends_on = None
+
+# Precision of the geohash stored with each request
+GEOHASH_PRECISION = 9
+
+# Rows updated per statement while backfilling
+BATCH_SIZE = 1000
+
+# The conversions below are frozen copies of the application code at this revision, so that the migration
+# keeps producing the same values whatever happens to the application modules later
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def dms_to_decimal(dms_str):
+    """
+    Converts a string in the Degrees-Minutes-Seconds format to a decimal coordinate.
+
+    @param dms_str: The DMS string to be converted
+    @return: The decimal representation of the coordinate
+    """
+    deg, minutes, seconds, direction = re.split('[°\'"]', dms_str)
+    return (float(deg) + float(minutes) / 60 + float(seconds) / (60 * 60)) * (-1 if direction in ['W', 'S'] else 1)
+
+
+def geohash(lat, lon, precision):
+    """
+    Encodes a position as a geohash, whose prefixes identify nested grid cells
+
+    @param lat: latitude of the position
+    @param lon: longitude of the position
+    @param precision: number of characters of the geohash
+    @return: the geohash of the position
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # Bits alternate between longitude and latitude, starting with longitude
+    while len(chars) < precision:
+        value, interval = (lon, lon_range) if even else (lat, lat_range)
+        mid = (interval[0] + interval[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            interval[0] = mid
+        else:
+            bits = bits * 2
+            interval[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+def upgrade():
+    with op.batch_alter_table('request', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('latitude_decimal', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('longitude_decimal', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('geohash', sa.String(length=12), nullable=True))
+
+    # Backfill the numeric coordinates from the DMS strings
+    connection = op.get_bind()
+    request = sa.table('request',
+                       sa.column('id', sa.Integer), sa.column('latitude', sa.String), sa.column('longitude', sa.String),
+                       sa.column('latitude_decimal', sa.Float), sa.column('longitude_decimal', sa.Float),
+                       sa.column('geohash', sa.String))
+    update = (request.update()
+              .where(request.c.id == sa.bindparam('row_id'))
+              .values(latitude_decimal=sa.bindparam('lat'), longitude_decimal=sa.bindparam('lon'),
+                      geohash=sa.bindparam('cell')))
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(request.c.id, request.c.latitude, request.c.longitude)
+            .where(request.c.id > last_id).order_by(request.c.id).limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        values = []
+        for row_id, latitude, longitude in rows:
+            try:
+                lat, lon = dms_to_decimal(latitude), dms_to_decimal(longitude)
+            except (TypeError, ValueError):
+                continue  # Leave malformed coordinates empty rather than failing the migration
+            values.append({'row_id': row_id, 'lat': lat, 'lon': lon, 'cell': geohash(lat, lon, GEOHASH_PRECISION)})
+        if values:
+            connection.execute(update, values)
+        last_id = rows[-1][0]
+
+    with op.batch_alter_table('request', schema=None) as batch_op:
+        batch_op.create_index('ix_request_timestamp', ['timestamp'], unique=False)
+        batch_op.create_index('ix_request_sender', ['sender'], unique=False)
+        batch_op.create_index('ix_request_sender_timestamp', ['sender', 'timestamp'], unique=False)
+        batch_op.create_index('ix_request_geohash', ['geohash'], unique=False)
+        batch_op.create_index('ix_request_latitude_decimal_longitude_decimal',
+                              ['latitude_decimal', 'longitude_decimal'], unique=False)
+
+    with op.batch_alter_table('response', schema=None) as batch_op:
+        batch_op.create_index('ix_response_request_id', ['request_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('response', schema=None) as batch_op:
+        batch_op.drop_index('ix_response_request_id')
+
+    with op.batch_alter_table('request', schema=None) as batch_op:
+        batch_op.drop_index('ix_request_latitude_decimal_longitude_decimal')
+        batch_op.drop_index('ix_request_geohash')
+        batch_op.drop_index('ix_request_sender_timestamp')
+        batch_op.drop_index('ix_request_sender')
+        batch_op.drop_index('ix_request_timestamp')
+        batch_op.drop_column('geohash')
+        batch_op.drop_column('longitude_decimal')
+        batch_op.drop_column('latitude_decimal')
@@ -0,0 +1,36 @@
+"""Cached results
+
+Revision ID: 8d2e61a4f0b3
+Revises: 5b0f3c9e7a21
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e61a4f0b3'
+down_revision = '5b0f3c9e7a21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cached_result',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('key', sa.String(length=64), nullable=False),
+    sa.Column('response', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('cached_result', schema=None) as batch_op:
+        batch_op.create_index('ix_cached_result_key', ['key'], unique=False)
+        batch_op.create_index('ix_cached_result_created_at', ['created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('cached_result', schema=None) as batch_op:
+        batch_op.drop_index('ix_cached_result_created_at')
+        batch_op.drop_index('ix_cached_result_key')
+    op.drop_table('cached_result')
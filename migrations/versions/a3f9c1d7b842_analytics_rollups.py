@@ -0,0 +1,50 @@
+"""Analytics rollups
+
+Revision ID: a3f9c1d7b842
+Revises: 8d2e61a4f0b3
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f9c1d7b842'
+down_revision = '8d2e61a4f0b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('shot_rollup',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('bucket', sa.DateTime(), nullable=False),
+    sa.Column('sender', sa.String(), nullable=False),
+    sa.Column('shots', sa.Integer(), nullable=False),
+    sa.Column('distance_sum', sa.Float(), nullable=False),
+    sa.Column('distance_max', sa.Float(), nullable=False),
+    sa.Column('apex_sum', sa.Float(), nullable=False),
+    sa.Column('apex_max', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('bucket', 'sender', name='uq_shot_rollup_bucket_sender')
+    )
+    with op.batch_alter_table('shot_rollup', schema=None) as batch_op:
+        batch_op.create_index('ix_shot_rollup_bucket', ['bucket'], unique=False)
+        batch_op.create_index('ix_shot_rollup_sender', ['sender'], unique=False)
+
+    rollup_state = op.create_table('rollup_state',
+    sa.Column('name', sa.String(length=32), nullable=False),
+    sa.Column('last_request_id', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # The refreshes claim their range of shots by updating this row, so it must exist before the first one
+    op.bulk_insert(rollup_state, [{'name': 'shots', 'last_request_id': 0}])
+
+
+def downgrade():
+    op.drop_table('rollup_state')
+    with op.batch_alter_table('shot_rollup', schema=None) as batch_op:
+        batch_op.drop_index('ix_shot_rollup_sender')
+        batch_op.drop_index('ix_shot_rollup_bucket')
+    op.drop_table('shot_rollup')
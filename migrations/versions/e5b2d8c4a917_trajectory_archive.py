@@ -0,0 +1,34 @@
+"""Trajectory archive
+
+Revision ID: e5b2d8c4a917
+Revises: a3f9c1d7b842
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b2d8c4a917'
+down_revision = 'a3f9c1d7b842'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('trajectory_archive',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('response_id', sa.Integer(), nullable=False),
+    sa.Column('points', sa.Integer(), nullable=False),
+    sa.Column('duration', sa.Float(), nullable=False),
+    sa.Column('block_index', sa.LargeBinary(), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['response_id'], ['response.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('response_id')
+    )
+
+
+def downgrade():
+    op.drop_table('trajectory_archive')
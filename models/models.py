@@ -4,15 +4,24 @@ from models.conn import db
 
 
 class Request(db.Model):
+    __table_args__ = (
+        db.Index('ix_request_sender_timestamp', 'sender', 'timestamp'),
+        db.Index('ix_request_latitude_decimal_longitude_decimal', 'latitude_decimal', 'longitude_decimal'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     latitude = db.Column(db.String, nullable=False)
     longitude = db.Column(db.String, nullable=False)
+    # Origin in decimal degrees and its geohash, for range and spatial-bucket queries
+    latitude_decimal = db.Column(db.Float)
+    longitude_decimal = db.Column(db.Float)
+    geohash = db.Column(db.String(12), index=True)
     muzzle_speed = db.Column(db.Float, nullable=False)
     vertical_angle = db.Column(db.Float, nullable=False)
     horizontal_angle = db.Column(db.Float, nullable=False)
     projectile_weight = db.Column(db.Float, nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.now())
-    sender = db.Column(db.String, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.now, index=True)
+    sender = db.Column(db.String, nullable=False, index=True)
 
     response = db.relationship('Response', backref='request', uselist=False)
 
@@ -38,13 +47,13 @@ class Request(db.Model):
                 'timestamp': self.timestamp,
                 'sender': self.sender,
             },
-            'response': self.response.to_dict()
+            'response': self.response.to_dict() if self.response else None
         }
 
 
 class Response(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    request_id = db.Column(db.Integer, db.ForeignKey('request.id'), nullable=False)
+    request_id = db.Column(db.Integer, db.ForeignKey('request.id'), nullable=False, index=True)
     final_position_lat = db.Column(db.Float, nullable=False)
     final_position_lon = db.Column(db.Float, nullable=False)
     final_position_alt = db.Column(db.Float, nullable=False)
@@ -53,6 +62,8 @@ class Response(db.Model):
     max_height_relative = db.Column(db.Float, nullable=False)
     flight_time = db.Column(db.Integer, nullable=False)
 
+    archive = db.relationship('TrajectoryArchive', backref='response', uselist=False)
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -66,4 +77,52 @@ class Response(db.Model):
             'max_height': self.max_height,
             'max_height_relative': self.max_height_relative,
             'flight_time': self.flight_time
-        }
\ No newline at end of file
+        }
+
+
+class CachedResult(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # Hash of the normalized inputs of a shot and of the weather epoch it was computed in
+    key = db.Column(db.String(64), nullable=False, index=True)
+    # Response body, as JSON
+    response = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now, index=True)
+
+
+class ShotRollup(db.Model):
+    """
+    Hourly aggregates of the shots of each sender, maintained incrementally from the history
+    """
+    __table_args__ = (
+        db.UniqueConstraint('bucket', 'sender', name='uq_shot_rollup_bucket_sender'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    # Start of the hour
+    bucket = db.Column(db.DateTime, nullable=False, index=True)
+    sender = db.Column(db.String, nullable=False, index=True)
+    shots = db.Column(db.Integer, nullable=False)
+    distance_sum = db.Column(db.Float, nullable=False)
+    distance_max = db.Column(db.Float, nullable=False)
+    apex_sum = db.Column(db.Float, nullable=False)
+    apex_max = db.Column(db.Float, nullable=False)
+
+
+class RollupState(db.Model):
+    name = db.Column(db.String(32), primary_key=True)
+    # Highest request ID already folded into the rollups
+    last_request_id = db.Column(db.Integer, nullable=False)
+
+
+class TrajectoryArchive(db.Model):
+    """
+    The full simulated path of a shot, as compressed blocks of float32 (t, x, y, z) columns
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    response_id = db.Column(db.Integer, db.ForeignKey('response.id'), nullable=False, unique=True)
+    points = db.Column(db.Integer, nullable=False)
+    # Time of the impact in seconds
+    duration = db.Column(db.Float, nullable=False)
+    # Time span, offset and length of each block in data
+    block_index = db.Column(db.LargeBinary, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
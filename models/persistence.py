@@ -0,0 +1,267 @@
+import atexit
+import os
+import threading
+import time
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.orm import ONETOMANY
+
+from models.conn import db
+from services.metrics import timed
+
+# 'sync' writes each request with its response in one transaction before answering,
+# 'write_behind' buffers them and writes them in bulk from a background thread
+PERSISTENCE_MODE = os.getenv('PERSISTENCE_MODE', 'sync')
+
+# A flush starts when this many rows are buffered, or when the oldest one has waited this many seconds
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 500))
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', 1.0))
+
+# Beyond this many buffered rows the callers write synchronously, so that a stalled database cannot exhaust memory
+WRITE_BEHIND_MAX_PENDING = int(os.getenv('WRITE_BEHIND_MAX_PENDING', 10000))
+
+# Flushes a buffered save may fail (other than because the database is unreachable) before it is dropped
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv('WRITE_BEHIND_MAX_ATTEMPTS', 3))
+
+
+def rebuild(row):
+    """
+    Copies a row, and the rows it owns, into new transient objects without the keys assigned by the database,
+    so that the rows of a rolled back transaction can be added to a new one
+
+    @param row: A mapped object
+    @return: The copy
+    """
+    mapper = inspect(row).mapper
+    generated = {column.key for column in mapper.columns if column.foreign_keys
+                 or column is mapper.local_table.autoincrement_column}
+    copy = mapper.class_(**{attribute.key: getattr(row, attribute.key) for attribute in mapper.column_attrs
+                            if attribute.columns[0].key not in generated})
+    for relationship in mapper.relationships:
+        if relationship.direction is ONETOMANY and not relationship.uselist:
+            owned = getattr(row, relationship.key)
+            if owned is not None:
+                setattr(copy, relationship.key, rebuild(owned))
+    return copy
+
+
+def row_data(row):
+    """
+    @param row: A mapped object
+    @return: Its class and column values, and those of the rows it owns, for the log of dropped rows
+    """
+    mapper = inspect(row).mapper
+    data = {}
+    for attribute in mapper.column_attrs:
+        value = getattr(row, attribute.key)
+        data[attribute.key] = f'<{len(value)} bytes>' if isinstance(value, bytes) else value
+    for relationship in mapper.relationships:
+        if relationship.direction is ONETOMANY and not relationship.uselist:
+            owned = getattr(row, relationship.key)
+            if owned is not None:
+                data[relationship.key] = row_data(owned)
+    return {mapper.class_.__name__: data}
+
+
+class HistoryWriter:
+    """
+    Saves the Request/Response pairs of the history, either synchronously in one transaction per call
+    or through a write-behind buffer flushed in bulk on a size or time trigger and at shutdown
+    """
+
+    def __init__(self, mode=PERSISTENCE_MODE, batch_size=WRITE_BEHIND_BATCH_SIZE, interval=WRITE_BEHIND_INTERVAL,
+                 max_pending=WRITE_BEHIND_MAX_PENDING, max_attempts=WRITE_BEHIND_MAX_ATTEMPTS):
+        """
+        @param mode: 'sync' or 'write_behind'
+        @param batch_size: The number of buffered rows that triggers a flush
+        @param interval: The maximum number of seconds a pair stays in the buffer
+        @param max_pending: The number of buffered rows beyond which writes become synchronous
+        @param max_attempts: The number of failed flushes after which the rows of a save are dropped
+        """
+        if mode not in ('sync', 'write_behind'):
+            raise ValueError(f"Unknown persistence mode: {mode}")
+        self.mode = mode
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.app = None
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        # The rows of each buffered save, with the number of flushes it failed
+        self._pending = []
+        self._pending_rows = 0
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        """
+        Binds the writer to the application whose database it writes to, and registers the final flush
+
+        @param app: The Flask application
+        """
+        self.app = app
+        if self.mode == 'write_behind':
+            atexit.register(self.close)
+
+    def save(self, pairs, extra_rows=()):
+        """
+        Saves request/response pairs
+
+        @param pairs: A list of (Request, Response) rows, not yet added to a session
+        @param extra_rows: Other rows written in the same transaction
+        @return: The IDs of the new requests, or None if they were buffered
+        """
+        for request_row, response_row in pairs:
+            request_row.response = response_row
+        rows = [request_row for request_row, _ in pairs] + list(extra_rows)
+
+        if self.mode == 'write_behind' and not self._stopped.is_set():
+            with self._lock:
+                if self._pending_rows + len(rows) <= self.max_pending:
+                    if not self._pending:
+                        self._oldest = time.monotonic()
+                    self._pending.append((rows, 0))
+                    self._pending_rows += len(rows)
+                    full = self._pending_rows >= self.batch_size
+                    buffered = True
+                else:
+                    buffered = False
+            if buffered:
+                self._start()
+                if full:
+                    self._wakeup.set()
+                return None
+
+        with timed('db'):
+            db.session.add_all(rows)
+            db.session.flush()
+            ids = [request_row.id for request_row, _ in pairs]
+            db.session.commit()
+        with self._lock:
+            self.written += len(rows)
+        return ids
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                due = self._oldest + self.interval - time.monotonic() if self._pending else self.interval
+            if due > 0:
+                self._wakeup.wait(due)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows with one bulk insert per table, in a single transaction.
+        If the transaction fails, each save is written on its own so that a faulty row does not hold back the
+        others: the saves that fail again are rebuilt and put back in the buffer, and dropped (and logged) after
+        max_attempts failed flushes. While the database is unreachable nothing is dropped.
+
+        @return: The number of rows written
+        """
+        with self._flush_lock:
+            with self._lock:
+                groups, self._pending, self._pending_rows, self._oldest = self._pending, [], 0, None
+            if not groups:
+                return 0
+
+            with self.app.app_context():
+                rows = [row for group, _ in groups for row in group]
+                try:
+                    with timed('db_flush'):
+                        db.session.add_all(rows)
+                        db.session.commit()
+                    written, retried, failed = len(rows), [], False
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.exception("Could not write %d buffered rows", len(rows))
+                    written, retried = self._write_separately(groups, unreachable=isinstance(e, (
+                        OperationalError, InterfaceError)))
+                    failed = True
+
+            with self._lock:
+                self.failures += failed
+                if retried:
+                    self._pending[:0] = retried
+                    self._pending_rows += sum(len(group) for group, _ in retried)
+                    self._oldest = time.monotonic()
+                self.written += written
+                if written:
+                    self.flushes += 1
+            return written
+
+    def _write_separately(self, groups, unreachable):
+        """
+        Writes the saves of a failed flush one transaction each
+
+        @param groups: The (rows, failed flushes) of the buffered saves, whose rows were rolled back
+        @param unreachable: Whether the flush failed because the database could not be reached,
+                            in which case the saves are put back without trying them again
+        @return: The number of rows written, and the rebuilt saves to put back in the buffer
+        """
+        written = 0
+        retried = []
+        for group, attempts in groups:
+            group = [rebuild(row) for row in group]
+            if unreachable:
+                retried.append((group, attempts))
+                continue
+            try:
+                db.session.add_all(group)
+                db.session.commit()
+                written += len(group)
+            except Exception:
+                db.session.rollback()
+                if attempts + 1 < self.max_attempts:
+                    retried.append(([rebuild(row) for row in group], attempts + 1))
+                else:
+                    self.app.logger.exception("Dropping %d buffered rows after %d failed flushes: %r",
+                                              len(group), attempts + 1, [row_data(row) for row in group])
+                    with self._lock:
+                        self.dropped += len(group)
+        return written, retried
+
+    def close(self):
+        """
+        Stops the background thread and writes what is left in the buffer
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.app is not None:
+            self.flush()
+
+    def stats(self):
+        """
+        @return: A dictionary with the mode, the number of buffered, written and dropped rows, the flushes
+                 and the failures
+        """
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'pending': self._pending_rows,
+                'written': self.written,
+                'flushes': self.flushes,
+                'failures': self.failures,
+                'dropped': self.dropped,
+            }
+
+
+history_writer = HistoryWriter()
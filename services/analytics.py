@@ -0,0 +1,329 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, literal_column, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models.conn import db
+from models.models import Request, Response, RollupState, ShotRollup
+
+# Serve the per-sender and per-hour/day aggregates from the hourly rollup tables when the filters allow it
+ANALYTICS_ROLLUPS = os.getenv('ANALYTICS_ROLLUPS', '0') == '1'
+
+# Shots younger than this many seconds are left to the next refresh of the rollups, so that rows
+# committed out of ID order (concurrent transactions, write-behind buffers) are not skipped
+ROLLUP_DELAY = float(os.getenv('ROLLUP_DELAY', 60))
+
+# Seconds between two refreshes of the rollups by each server process (0 leaves them to flask refresh-rollups)
+ROLLUP_REFRESH_INTERVAL = float(os.getenv('ROLLUP_REFRESH_INTERVAL', 60))
+
+# Largest number of quantiles computed for a distribution
+ANALYTICS_MAX_QUANTILES = 100
+
+# Columns of Response that can be aggregated
+METRICS = {
+    'horizontal_distance': Response.horizontal_distance,
+    'max_height': Response.max_height,
+    'max_height_relative': Response.max_height_relative,
+    'flight_time': Response.flight_time,
+}
+
+# Time buckets, as formats of their start for the databases without date_trunc
+SQLITE_BUCKETS = {'minute': '%Y-%m-%d %H:%M:00', 'hour': '%Y-%m-%d %H:00:00', 'day': '%Y-%m-%d 00:00:00'}
+MYSQL_BUCKETS = {'minute': '%Y-%m-%d %H:%i:00', 'hour': '%Y-%m-%d %H:00:00', 'day': '%Y-%m-%d 00:00:00'}
+BUCKETS = tuple(SQLITE_BUCKETS)
+
+logger = logging.getLogger(__name__)
+
+
+def time_bucket(column, bucket):
+    """
+    Truncates a timestamp column to the start of its bucket, in the SQL dialect of the database.
+    The unit is inlined rather than bound, so that the same expression can appear in SELECT and GROUP BY.
+
+    @param column: A DateTime column
+    @param bucket: One of BUCKETS
+    @return: A SQL expression
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return func.date_trunc(literal_column(f"'{bucket}'"), column)
+    if dialect in ('mysql', 'mariadb'):
+        return func.date_format(column, literal_column(f"'{MYSQL_BUCKETS[bucket]}'"))
+    return func.strftime(literal_column(f"'{SQLITE_BUCKETS[bucket]}'"), column)
+
+
+def bucket_start(value):
+    """
+    @param value: A bucket as returned by the database (a datetime, or a string on SQLite and MySQL)
+    @return: The start of the bucket as a datetime
+    """
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+
+def shot_aggregates(rollup):
+    """
+    @param rollup: Whether to aggregate the rollups instead of the history
+    @return: The SQL aggregates of the number of shots, the mean and maximum range and the mean and maximum apex
+    """
+    if rollup:
+        shots = func.sum(ShotRollup.shots)
+        return [shots, func.sum(ShotRollup.distance_sum) / shots, func.max(ShotRollup.distance_max),
+                func.sum(ShotRollup.apex_sum) / shots, func.max(ShotRollup.apex_max)]
+    return [func.count(Response.id), func.avg(Response.horizontal_distance), func.max(Response.horizontal_distance),
+            func.avg(Response.max_height_relative), func.max(Response.max_height_relative)]
+
+
+def aggregate_query(columns, rollup):
+    """
+    @param columns: The grouping columns
+    @param rollup: Whether to aggregate the rollups instead of the history
+    @return: A SELECT of the grouping columns followed by the shot_aggregates
+    """
+    query = select(*columns, *shot_aggregates(rollup))
+    if not rollup:
+        query = query.select_from(Request).join(Response, Response.request_id == Request.id)
+    return query
+
+
+def describe(shots, mean_distance, max_distance, mean_apex, max_apex):
+    """
+    @return: The values of the shot_aggregates as a dictionary
+    """
+    return {
+        'shots': int(shots),
+        'mean_distance': float(mean_distance),
+        'max_distance': float(max_distance),
+        'mean_apex': float(mean_apex),
+        'max_apex': float(max_apex),
+    }
+
+
+def rollup_eligible(filters, bucket=None):
+    """
+    Tells whether the rollups can answer a query exactly: they keep neither the origin nor sub-hour timestamps
+
+    @param filters: The filters returned by parse_history_filters
+    @param bucket: The time bucket of the query, if any
+    @return: True if the query can be served from the rollups
+    """
+    if not ANALYTICS_ROLLUPS or bucket == 'minute':
+        return False
+    if filters['bbox'] is not None or filters['geohash']:
+        return False
+    return all(filters[name] is None or filters[name] == filters[name].replace(minute=0, second=0, microsecond=0)
+               for name in ('since', 'until'))
+
+
+def rollup_conditions(filters):
+    """
+    Translates the history filters accepted by rollup_eligible into SQL conditions on ShotRollup
+
+    @param filters: The filters returned by parse_history_filters
+    @return: A list of SQLAlchemy conditions
+    """
+    conditions = []
+    if filters['sender']:
+        conditions.append(ShotRollup.sender == filters['sender'])
+    if filters['since']:
+        conditions.append(ShotRollup.bucket >= filters['since'])
+    if filters['until']:
+        conditions.append(ShotRollup.bucket < filters['until'])
+    return conditions
+
+
+def summarize_senders(conditions, limit, rollup=False):
+    """
+    Counts the shots of each sender, with the mean and maximum range and apex, busiest senders first
+
+    @param conditions: SQL conditions on Request (on ShotRollup if rollup is set)
+    @param limit: The maximum number of senders returned
+    @param rollup: Whether to aggregate the rollups instead of the history
+    @return: A list of dictionaries, one per sender
+    """
+    sender = ShotRollup.sender if rollup else Request.sender
+    query = aggregate_query([sender], rollup).where(*conditions).group_by(sender)
+    query = query.order_by(shot_aggregates(rollup)[0].desc(), sender).limit(limit)
+    return [dict(sender=row[0], **describe(*row[1:])) for row in db.session.execute(query)]
+
+
+def time_series(conditions, bucket, by_sender=False, rollup=False):
+    """
+    Counts the shots of each time bucket, with the mean and maximum range and apex
+
+    @param conditions: SQL conditions on Request (on ShotRollup if rollup is set)
+    @param bucket: One of BUCKETS ('hour' or 'day' from the rollups)
+    @param by_sender: Whether to split every bucket by sender
+    @param rollup: Whether to aggregate the rollups instead of the history
+    @return: A list of dictionaries, one per bucket (and sender), in chronological order
+    """
+    if rollup:
+        groups = [ShotRollup.bucket if bucket == 'hour' else time_bucket(ShotRollup.bucket, bucket)]
+        if by_sender:
+            groups.append(ShotRollup.sender)
+    else:
+        groups = [time_bucket(Request.timestamp, bucket)]
+        if by_sender:
+            groups.append(Request.sender)
+    query = aggregate_query(groups, rollup).where(*conditions).group_by(*groups).order_by(*groups)
+
+    series = []
+    for row in db.session.execute(query):
+        point = {'bucket': bucket_start(row[0]).isoformat()}
+        if by_sender:
+            point['sender'] = row[1]
+        point.update(describe(*row[len(groups):]))
+        series.append(point)
+    return series
+
+
+def distribution(conditions, metric, quantiles, bucket=None):
+    """
+    Computes the quantiles of a metric, overall or per time bucket, with the NTILE window function:
+    the shots are ranked into equal groups inside the database and only the bounds of each group are returned.
+
+    @param conditions: SQL conditions on Request
+    @param metric: A key of METRICS
+    @param quantiles: The number of groups, e.g. 4 for quartiles or 100 for percentiles
+    @param bucket: One of BUCKETS, or None for the whole selection
+    @return: A list of dictionaries, one per bucket, with the number of shots, the minimum and the upper bound
+             of each group (the last one being the maximum)
+    """
+    value = METRICS[metric]
+    columns = [value.label('value')]
+    partition = None
+    if bucket:
+        partition = time_bucket(Request.timestamp, bucket)
+        columns.append(partition.label('bucket'))
+    ranked = (
+        select(*columns, func.ntile(quantiles).over(partition_by=partition, order_by=value).label('tile'))
+        .select_from(Request)
+        .join(Response, Response.request_id == Request.id)
+        .where(*conditions)
+        .subquery()
+    )
+    groups = ([ranked.c.bucket] if bucket else []) + [ranked.c.tile]
+    query = (
+        select(*groups, func.count(), func.min(ranked.c.value), func.max(ranked.c.value))
+        .group_by(*groups)
+        .order_by(*groups)
+    )
+
+    buckets = {}
+    for row in db.session.execute(query):
+        start = bucket_start(row[0]).isoformat() if bucket else None
+        count, low, high = row[-3:]
+        entry = buckets.get(start)
+        if entry is None:
+            entry = buckets[start] = {'bucket': start, 'shots': 0, 'min': float(low), 'bounds': []}
+        entry['shots'] += int(count)
+        entry['bounds'].append(float(high))
+    if not bucket:
+        for entry in buckets.values():
+            del entry['bucket']
+    return list(buckets.values())
+
+
+def refresh_rollups():
+    """
+    Folds the shots saved since the last refresh into the hourly rollups, in one transaction.
+    The range of new shots is claimed first with a conditional update of the state row, so that concurrent
+    refreshes (other workers, the CLI) never fold the same shots twice: the one that loses the claim gives up.
+    The new shots are grouped by hour and sender in SQL, and each group is added to its rollup row.
+
+    @return: The number of shots folded
+    """
+    last_id = db.session.execute(
+        select(RollupState.last_request_id).where(RollupState.name == 'shots')
+    ).scalar_one_or_none()
+    if last_id is None:
+        # Databases created without the migrations have no state row yet
+        try:
+            db.session.add(RollupState(name='shots', last_request_id=0))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+        return refresh_rollups()
+
+    until_id = db.session.execute(
+        select(func.max(Request.id)).where(
+            Request.id > last_id,
+            Request.timestamp < datetime.now() - timedelta(seconds=ROLLUP_DELAY),
+        )
+    ).scalar()
+    if until_id is None:
+        db.session.rollback()
+        return 0
+
+    claimed = db.session.execute(
+        update(RollupState)
+        .where(RollupState.name == 'shots', RollupState.last_request_id == last_id)
+        .values(last_request_id=until_id)
+    ).rowcount
+    if claimed == 0:
+        # Another refresh folded these shots in the meantime
+        db.session.rollback()
+        return 0
+
+    hour = time_bucket(Request.timestamp, 'hour')
+    groups = db.session.execute(
+        select(hour, Request.sender, func.count(Response.id),
+               func.sum(Response.horizontal_distance), func.max(Response.horizontal_distance),
+               func.sum(Response.max_height_relative), func.max(Response.max_height_relative))
+        .select_from(Request)
+        .join(Response, Response.request_id == Request.id)
+        .where(Request.id > last_id, Request.id <= until_id, Request.timestamp.isnot(None))
+        .group_by(hour, Request.sender)
+    ).all()
+
+    starts = {bucket_start(group[0]) for group in groups}
+    existing = {(row.bucket, row.sender): row for row in ShotRollup.query.filter(ShotRollup.bucket.in_(starts))}
+    folded = 0
+    new_rows = []
+    for start, sender, shots, distance_sum, distance_max, apex_sum, apex_max in groups:
+        start = bucket_start(start)
+        row = existing.get((start, sender))
+        if row is None:
+            new_rows.append({'bucket': start, 'sender': sender, 'shots': shots, 'distance_sum': distance_sum,
+                             'distance_max': distance_max, 'apex_sum': apex_sum, 'apex_max': apex_max})
+        else:
+            row.shots += shots
+            row.distance_sum += distance_sum
+            row.distance_max = max(row.distance_max, distance_max)
+            row.apex_sum += apex_sum
+            row.apex_max = max(row.apex_max, apex_max)
+        folded += shots
+    if new_rows:
+        # Inserted in bulk: the first refresh over a long history creates one row per hour and sender
+        db.session.execute(db.insert(ShotRollup), new_rows)
+
+    db.session.commit()
+    return folded
+
+
+def refresh_rollups_in_background(app):
+    """
+    Refreshes the rollups every ROLLUP_REFRESH_INTERVAL seconds on a daemon thread, so that the queries
+    served from the rollups never wait for a refresh
+
+    @param app: The Flask application whose database holds the rollups
+    """
+    if not (ANALYTICS_ROLLUPS and ROLLUP_REFRESH_INTERVAL > 0):
+        return
+
+    def run():
+        while True:
+            time.sleep(ROLLUP_REFRESH_INTERVAL)
+            with app.app_context():
+                try:
+                    refresh_rollups()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("The refresh of the analytics rollups failed")
+
+    threading.Thread(target=run, name='rollup-refresh', daemon=True).start()
@@ -0,0 +1,124 @@
+import os
+import zlib
+
+import numpy as np
+from sqlalchemy import func, select
+
+from models.conn import db
+from models.models import TrajectoryArchive
+
+# Whether the full trajectory of every simulated shot is archived with its response
+TRAJECTORY_ARCHIVE = os.getenv('TRAJECTORY_ARCHIVE', '0') == '1'
+
+# Points per compressed block: a time slice only reads and decodes the blocks it overlaps
+ARCHIVE_BLOCK_POINTS = int(os.getenv('ARCHIVE_BLOCK_POINTS', 512))
+
+# Blocks read from the database at a time while streaming
+ARCHIVE_READ_BLOCKS = 8
+
+# Columns of a block, as recorded by TrajectoryRecorder
+COLUMNS = ('t', 'x', 'y', 'z')
+
+# Entry of the block index: time span of the block and position of its bytes in the data
+INDEX_DTYPE = np.dtype([('start', '<f8'), ('end', '<f8'), ('offset', '<u4'), ('length', '<u4')])
+
+
+def encode_block(points):
+    """
+    Encodes states as float32 columns. The bit patterns of each column are delta-encoded twice, which
+    turns the smooth motion of a projectile into small integers, the bytes of equal weight are grouped
+    so that their zeroes are contiguous, and the result is compressed. Decoding gives back the float32
+    values exactly.
+
+    @param points: An array of (t, x, y, z) rows
+    @return: The compressed block
+    """
+    values = np.ascontiguousarray(points, dtype=np.float32).view(np.uint32)
+    for _ in range(2):
+        # Wrapping unsigned arithmetic, so that any bit pattern round-trips
+        values = np.diff(values, axis=0, prepend=np.zeros((1, len(COLUMNS)), dtype=np.uint32))
+    planes = np.ascontiguousarray(values.T).view(np.uint8).reshape(len(COLUMNS), -1, 4).transpose(0, 2, 1)
+    return zlib.compress(np.ascontiguousarray(planes).tobytes())
+
+
+def decode_block(data):
+    """
+    @param data: A block built by encode_block
+    @return: An array of float32 (t, x, y, z) rows
+    """
+    planes = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(len(COLUMNS), 4, -1)
+    values = np.ascontiguousarray(planes.transpose(0, 2, 1)).view(np.uint32).reshape(len(COLUMNS), -1).T
+    for _ in range(2):
+        values = np.cumsum(values, axis=0, dtype=np.uint32)
+    return values.view(np.float32)
+
+
+def archive_row(points, block_points=ARCHIVE_BLOCK_POINTS):
+    """
+    Builds the archive of a trajectory, split in independently compressed blocks
+
+    @param points: An array of (t, x, y, z) rows, in chronological order
+    @param block_points: The number of points per block
+    @return: The TrajectoryArchive, not yet linked to its response
+    """
+    blocks = []
+    index = np.empty((len(points) + block_points - 1) // block_points, dtype=INDEX_DTYPE)
+    offset = 0
+    for i, first in enumerate(range(0, len(points), block_points)):
+        chunk = points[first:first + block_points]
+        block = encode_block(chunk)
+        index[i] = (chunk[0, 0], chunk[-1, 0], offset, len(block))
+        blocks.append(block)
+        offset += len(block)
+    return TrajectoryArchive(points=len(points), duration=float(points[-1, 0]) if len(points) else 0.0,
+                             block_index=index.tobytes(), data=b''.join(blocks))
+
+
+def read_index(response_id):
+    """
+    @param response_id: The ID of the response of the shot
+    @return: The ID and the block index of the archive, or None if the trajectory was not archived
+    """
+    row = db.session.execute(
+        select(TrajectoryArchive.id, TrajectoryArchive.block_index).where(TrajectoryArchive.response_id == response_id)
+    ).first()
+    if row is None:
+        return None
+    return row.id, np.frombuffer(row.block_index, dtype=INDEX_DTYPE)
+
+
+def read_points(archive_id, index, since=None, until=None):
+    """
+    Reads the states of an archived trajectory within a time slice. Only the byte ranges of the blocks
+    overlapping the slice are read from the database, a few blocks at a time.
+
+    @param archive_id: The ID of the archive
+    @param index: Its block index, as returned by read_index
+    @param since: The start of the slice in seconds, or None for the start of the flight
+    @param until: The end of the slice in seconds, or None for the impact
+    @return: A generator of arrays of float32 (t, x, y, z) rows
+    """
+    selected = np.ones(len(index), dtype=bool)
+    if since is not None:
+        selected &= index['end'] >= since
+    if until is not None:
+        selected &= index['start'] <= until
+    blocks = index[selected]
+
+    for first in range(0, len(blocks), ARCHIVE_READ_BLOCKS):
+        group = blocks[first:first + ARCHIVE_READ_BLOCKS]
+        start = int(group[0]['offset'])
+        length = int(group[-1]['offset']) + int(group[-1]['length']) - start
+        # substr counts from 1; the selected blocks are contiguous in the data
+        data = db.session.execute(
+            select(func.substr(TrajectoryArchive.data, start + 1, length)).where(TrajectoryArchive.id == archive_id)
+        ).scalar_one()
+        for entry in group:
+            offset = int(entry['offset']) - start
+            points = decode_block(bytes(data[offset:offset + int(entry['length'])]))
+            if since is not None:
+                points = points[points[:, 0] >= since]
+            if until is not None:
+                points = points[points[:, 0] <= until]
+            if len(points):
+                yield points
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A thread-safe, bounded LRU cache whose entries also expire after a time-to-live.
+
+    Hit, miss and eviction counters are kept so that the effectiveness of the cache
+    can be inspected at runtime.
+
+    Expired entries can be kept for a while longer, so that get_stale can still serve them
+    while the caller refreshes them (stale-while-revalidate).
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, stale_ttl=None):
+        """
+        @param maxsize: The maximum number of entries kept before the least recently used one is evicted
+        @param ttl: The lifetime of an entry in seconds (None means entries never expire)
+        @param stale_ttl: The number of seconds an expired entry is still served by get_stale
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored under a key, refreshing its LRU position
+
+        @param key: The key to look up
+        @param default: The value returned on a miss or an expired entry
+        @return: The cached value or the default
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._expire(key, expires_at)
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """
+        Returns the fresh value stored under a key without counting the lookup or refreshing its LRU position
+
+        @param key: The key to look up
+        @param default: The value returned if the key is absent or expired
+        @return: The cached value or the default
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                return default
+            return value
+
+    def get_stale(self, key):
+        """
+        Returns the value stored under a key, even if it expired less than stale_ttl seconds ago
+
+        @param key: The key to look up
+        @return: A (value, fresh) pair, or None on a miss
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, value = entry
+            fresh = expires_at is None or expires_at > time.monotonic()
+            if not fresh and self._expire(key, expires_at):
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+            return value, fresh
+
+    def _expire(self, key, expires_at):
+        """
+        Removes an expired entry once it is too old to be served stale (the lock must be held)
+
+        @return: True if the entry was removed
+        """
+        if self.stale_ttl is None or expires_at + self.stale_ttl <= time.monotonic():
+            del self._data[key]
+            return True
+        return False
+
+    def set(self, key, value):
+        """
+        Stores a value, evicting the least recently used entries if the cache is full
+
+        @param key: The key to store the value under
+        @param value: The value to store
+        """
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Removes every entry and resets the counters
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = self.stale_hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Returns the current size of the cache and its hit/miss counters
+
+        @return: A dictionary with the cache statistics
+        """
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+    def __len__(self):
+        return len(self._data)
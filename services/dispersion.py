@@ -0,0 +1,104 @@
+import math
+import os
+
+import numpy as np
+
+# Largest number of samples accepted by the dispersion endpoint
+DISPERSION_MAX_SAMPLES = int(os.getenv('DISPERSION_MAX_SAMPLES', 50000))
+
+DISTRIBUTIONS = ('normal', 'uniform')
+
+
+def draw(rng, nominal, spec, n):
+    """
+    Draws perturbed values of a parameter around its nominal value
+
+    @param rng: A numpy random Generator
+    @param nominal: The nominal value
+    @param spec: None for no perturbation, or a dictionary with the 'distribution' ('normal' by default)
+                 and its width: 'sigma' for a normal distribution, 'half_width' for a uniform one
+    @param n: The number of samples
+    @return: An array of n values
+    @raise ValueError: If the distribution is unknown or its width is missing or negative
+    """
+    if spec is None:
+        return np.full(n, float(nominal))
+    if not isinstance(spec, dict):
+        raise ValueError("a perturbation must be an object with a distribution and its width")
+
+    distribution = spec.get('distribution', 'normal')
+    if distribution == 'normal':
+        sigma = float(spec['sigma'])
+        if sigma < 0:
+            raise ValueError("sigma must not be negative")
+        return rng.normal(nominal, sigma, n)
+    if distribution == 'uniform':
+        half_width = float(spec['half_width'])
+        if half_width < 0:
+            raise ValueError("half_width must not be negative")
+        return rng.uniform(nominal - half_width, nominal + half_width, n)
+    raise ValueError(f"distribution must be one of {', '.join(DISTRIBUTIONS)}")
+
+
+def ellipse(covariance, scale=1.0):
+    """
+    Computes the axes of the ellipse of a 2x2 covariance matrix
+
+    @param covariance: The covariance of the (north, east) impact offsets
+    @param scale: The number of standard deviations covered by the ellipse
+    @return: The semi-major and semi-minor axes in metres, and the orientation of the major axis
+             in degrees clockwise from North
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    major = eigenvectors[:, 1]
+    return {
+        'semi_major': scale * math.sqrt(max(float(eigenvalues[1]), 0.0)),
+        'semi_minor': scale * math.sqrt(max(float(eigenvalues[0]), 0.0)),
+        'orientation': math.degrees(math.atan2(major[1], major[0])) % 180,
+    }
+
+
+def confidence_scale(confidence):
+    """
+    @param confidence: The probability covered by an ellipse of a bivariate normal distribution
+    @return: The number of standard deviations of that ellipse
+    """
+    return math.sqrt(-2 * math.log(1 - confidence))
+
+
+def summarize(north, east, percentiles=(), contour_points=36):
+    """
+    Describes the spread of the impact points
+
+    @param north: The northward offsets of the impacts from the firing position, in metres
+    @param east: The eastward offsets of the impacts from the firing position, in metres
+    @param percentiles: The percentages of impacts the contours must enclose
+    @param contour_points: The number of vertices of each contour
+    @return: The mean impact, the covariance, the CEP (radius around the mean impact enclosing half of
+             the impacts) and, for each percentile, the (north, east) vertices of the ellipse of the same shape
+             as the covariance enclosing that share of impacts
+    """
+    points = np.column_stack((north, east))
+    mean = points.mean(axis=0)
+    offsets = points - mean
+    covariance = np.cov(offsets, rowvar=False) if len(points) > 1 else np.zeros((2, 2))
+
+    contours = {}
+    if percentiles:
+        # Mahalanobis distances, so that the contours follow the shape of the spread
+        inverse = np.linalg.pinv(covariance)
+        distances = np.sqrt(np.maximum(np.einsum('ij,jk,ik->i', offsets, inverse, offsets), 0.0))
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        angles = np.linspace(0, 2 * math.pi, contour_points, endpoint=False)
+        circle = np.column_stack((np.cos(angles), np.sin(angles)))
+        unit = circle * np.sqrt(np.maximum(eigenvalues, 0.0)) @ eigenvectors.T
+        for percentile in percentiles:
+            radius = float(np.percentile(distances, percentile))
+            contours[percentile] = mean + unit * radius
+
+    return {
+        'mean': mean,
+        'covariance': covariance,
+        'cep': float(np.median(np.hypot(offsets[:, 0], offsets[:, 1]))),
+        'contours': contours,
+    }
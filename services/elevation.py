@@ -0,0 +1,285 @@
+import math
+import os
+from functools import partial
+
+import numpy as np
+
+from services import upstream
+from services.cache import TTLCache
+from services.metrics import timed
+
+# Size of a DEM cell in degrees (GEBCO is distributed on a 15 arc-second grid)
+ELEVATION_GRID_RESOLUTION = float(os.getenv('ELEVATION_GRID_RESOLUTION', 15)) / 3600
+
+# Maximum number of locations sent to the Elevation API in a single call
+ELEVATION_BATCH_SIZE = int(os.getenv('ELEVATION_BATCH_SIZE', 100))
+
+# Spacing in metres of the samples of a ground profile (half a DEM cell by default)
+GROUND_PROFILE_STEP = float(os.getenv('GROUND_PROFILE_STEP', ELEVATION_GRID_RESOLUTION * 111320 / 2))
+
+# Altitudes are cached per DEM cell, so repeated lookups inside the same cell never reach the service;
+# expired altitudes are still served while they are refreshed in the background
+elevation_cache = TTLCache(
+    maxsize=int(os.getenv('ELEVATION_CACHE_SIZE', 200000)),
+    ttl=float(os.getenv('ELEVATION_CACHE_TTL', 86400)),
+    stale_ttl=float(os.getenv('ELEVATION_STALE_TTL', 7 * 86400)),
+)
+
+
+class AltitudeUnavailable(upstream.UpstreamError):
+    """
+    An altitude without fallback could not be fetched, and was never cached
+    """
+
+
+def snap_to_grid(latitude, longitude, resolution=ELEVATION_GRID_RESOLUTION):
+    """
+    Snaps a position to the DEM cell that contains it
+
+    @param latitude: The latitude of the position
+    @param longitude: The longitude of the position
+    @param resolution: The size of a DEM cell in degrees
+    @return: The (row, column) indices of the cell, counted from the equator and the prime meridian
+    """
+    return math.floor(latitude / resolution), math.floor(longitude / resolution)
+
+
+def cell_center(row, col, resolution=ELEVATION_GRID_RESOLUTION):
+    """
+    Returns the coordinates of the centre of a DEM cell
+
+    @param row: The row index of the cell
+    @param col: The column index of the cell
+    @param resolution: The size of a DEM cell in degrees
+    @return: The latitude and longitude of the centre of the cell
+    """
+    return (row + 0.5) * resolution, (col + 0.5) * resolution
+
+
+class HttpElevationBackend:
+    """
+    Queries an OpenTopodata-compatible Elevation API
+    """
+
+    # Every lookup is a network round trip, so results are cached per DEM cell
+    cached = True
+
+    def dataset(self):
+        """
+        @return: The identity of the dataset the altitudes are read from
+        """
+        return f"http:{os.getenv('ELEVATION_DATASET')}"
+
+    def altitudes(self, latitudes, longitudes):
+        """
+        Gets the altitudes of several positions in a single call
+
+        @param latitudes: A sequence of latitudes
+        @param longitudes: A sequence of longitudes
+        @return: The altitudes of the positions, in the same order
+        @raise UpstreamError: If the API cannot be reached or answers with an error
+        """
+        url = f"{os.getenv('ELEVATION_API_URL')}/{os.getenv('ELEVATION_DATASET')}"
+        params = {'locations': '|'.join(f"{latitude},{longitude}" for latitude, longitude in zip(latitudes, longitudes))}
+        response = upstream.get('elevation', url, params=params)
+        if response.status_code == 200:
+            data = response.json()
+            return [result['elevation'] for result in data['results']]
+        else:
+            raise upstream.UpstreamError(f"Errore nell'API: {response.status_code}, {response.text}")
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    Returns the elevation backend selected by the ELEVATION_BACKEND variable ('http' or 'geotiff')
+
+    @return: The elevation backend, created on first use
+    """
+    global _backend
+    if _backend is None:
+        name = os.getenv('ELEVATION_BACKEND', 'http')
+        if name == 'http':
+            _backend = HttpElevationBackend()
+        elif name == 'geotiff':
+            from services.geotiff import GeoTiffElevationBackend
+            _backend = GeoTiffElevationBackend(os.getenv('ELEVATION_TILES_DIR'),
+                                               tile_size=int(os.getenv('ELEVATION_TILE_SIZE', 90)))
+        else:
+            raise ValueError(f"Unknown elevation backend: {name}")
+    return _backend
+
+
+def fetch_altitudes(locations):
+    """
+    Gets the altitudes of several positions from the elevation backend, bypassing the cache
+
+    @param locations: A list of (latitude, longitude) pairs
+    @return: The altitudes of the positions, in the same order
+    @raise UpstreamError: If the backend cannot be reached, or has no altitude for some of the positions
+                          (outside the dataset, or next to a pixel without data)
+    """
+    latitudes = [latitude for latitude, _ in locations]
+    longitudes = [longitude for _, longitude in locations]
+    with timed('elevation'):
+        altitudes = [math.nan if altitude is None else float(altitude)
+                     for altitude in get_backend().altitudes(latitudes, longitudes)]
+    if any(math.isnan(altitude) for altitude in altitudes):
+        raise upstream.UpstreamError("The elevation dataset has no altitude for some of the positions")
+    return altitudes
+
+
+def fetch_cells(keys):
+    """
+    Fetches the altitudes of DEM cells in batches and caches them
+
+    @param keys: A list of (row, column) cell indices
+    @return: A dictionary of the altitudes by cell
+    @raise UpstreamError: If the elevation backend cannot be reached
+    """
+    altitudes = {}
+    for i in range(0, len(keys), ELEVATION_BATCH_SIZE):
+        batch = keys[i:i + ELEVATION_BATCH_SIZE]
+        for key, altitude in zip(batch, fetch_altitudes([cell_center(*key) for key in batch])):
+            elevation_cache.set(key, altitude)
+            altitudes[key] = altitude
+    return altitudes
+
+
+def get_altitudes(locations, default=0.0):
+    """
+    Gets the altitudes of several positions, fetching the DEM cells missing from the cache in batches.
+    Expired cells are served while they are refreshed in the background, and the cells that cannot be
+    fetched take a default altitude; either way the answer is marked as degraded.
+
+    @param locations: A list of (latitude, longitude) pairs
+    @param default: The altitude of the positions that cannot be fetched (flat terrain), or None if there is none
+    @return: The altitudes of the positions, in the same order
+    @raise AltitudeUnavailable: If the default is None and a position could not be fetched
+    """
+    if not get_backend().cached:
+        try:
+            return fetch_altitudes(locations)
+        except upstream.UpstreamError:
+            upstream.mark_degraded('elevation_unavailable')
+            if default is None:
+                raise AltitudeUnavailable("The elevation dataset has no altitude for the position")
+            return [default] * len(locations)
+
+    keys = [snap_to_grid(latitude, longitude) for latitude, longitude in locations]
+    altitudes = {}
+    missing = []
+    stale = []
+    for key in dict.fromkeys(keys):
+        cached = elevation_cache.get_stale(key)
+        if cached is None:
+            missing.append(key)
+        else:
+            altitudes[key], fresh = cached
+            if not fresh:
+                stale.append(key)
+
+    if stale:
+        upstream.mark_degraded('elevation_stale')
+        upstream.refresh_in_background(('elevation', tuple(stale)), partial(fetch_cells, stale))
+
+    if missing:
+        try:
+            altitudes.update(fetch_cells(missing))
+        except upstream.UpstreamError:
+            upstream.mark_degraded('elevation_unavailable')
+            for key in missing:
+                # The batches fetched before the failure are in the cache, and these keys were already counted as misses
+                altitudes.setdefault(key, elevation_cache.peek(key, default))
+            if default is None and None in altitudes.values():
+                raise AltitudeUnavailable("The elevation service could not be reached and the altitude is not cached")
+
+    return [altitudes[key] for key in keys]
+
+
+def get_altitude(latitude, longitude, default=0.0):
+    """
+    Gets the altitude of a given position, querying a remote elevation backend only once per DEM cell
+
+    @param latitude: The latitude of the position
+    @param longitude: The longitude of the position
+    @param default: The altitude used if it cannot be fetched, or None to raise instead
+    @return: The altitude of the position
+    @raise AltitudeUnavailable: If the default is None and the altitude could not be fetched
+    """
+    return str(get_altitudes([(latitude, longitude)], default)[0])
+
+
+class GroundProfile:
+    """
+    Terrain altitudes sampled at a fixed spacing along the ground track of a shot.
+
+    The profile is fetched in a few batched calls before the simulation starts and is
+    extended on demand if the projectile flies further than expected.
+    """
+
+    def __init__(self, locate, distance=0.0, step=GROUND_PROFILE_STEP, samples=None):
+        """
+        @param locate: A function returning the latitudes and longitudes of the points at an array of distances
+                       along the track, such as LocalFrame.along
+        @param distance: The distance in metres covered by the initial fetch
+        @param step: The spacing in metres between two samples
+        @param samples: The altitudes of the first samples, if they are already known (read in place, so that
+                        a memory-mapped profile is never copied)
+        """
+        self.locate = locate
+        self.step = step
+        # Whether some samples are flat-terrain fallbacks for altitudes that could not be fetched
+        self.degraded = False
+        self.altitudes = np.empty(0) if samples is None else np.asarray(samples)
+        self.distances = np.arange(len(self.altitudes)) * step
+        self.extend(distance)
+
+    def extend(self, distance):
+        """
+        Fetches the samples needed to cover the track up to a given distance
+
+        @param distance: The distance in metres the profile must reach
+        """
+        count = int(math.ceil(distance / self.step)) + 1
+        if count <= len(self.distances):
+            return
+
+        distances = np.arange(len(self.distances), count) * self.step
+        latitudes, longitudes = self.locate(distances)
+        with upstream.degradations() as reasons:
+            # Samples that cannot be fetched continue the terrain at the last known altitude
+            altitudes = get_altitudes(list(zip(latitudes.tolist(), longitudes.tolist())),
+                                      default=float(self.altitudes[-1]) if len(self.altitudes) else 0.0)
+        self.degraded = self.degraded or 'elevation_unavailable' in reasons
+        self.distances = np.concatenate((self.distances, distances))
+        self.altitudes = np.concatenate((self.altitudes, np.asarray(altitudes, dtype=float)))
+
+    def altitude_at(self, distance):
+        """
+        Interpolates the terrain altitude at one or more distances along the track
+
+        @param distance: A distance in metres, or an array of distances
+        @return: The interpolated altitude, or an array of altitudes
+        """
+        # The samples are evenly spaced, so only the two samples around each distance are read
+        if isinstance(distance, float) and distance >= 0.0:
+            position = distance / self.step
+            i = int(position)
+            if i + 1 < len(self.altitudes):
+                below = self.altitudes.item(i)
+                return below + (self.altitudes.item(i + 1) - below) * (position - i)
+
+        farthest = float(np.max(distance))
+        if farthest > self.distances[-1]:
+            # Grow by at least a full batch so that a long flight only triggers a few extra fetches
+            last = self.distances[-1]
+            self.extend(max(farthest, last * 1.5, last + ELEVATION_BATCH_SIZE * self.step))
+
+        last = len(self.altitudes) - 1
+        position = np.clip(np.asarray(distance, dtype=float) / self.step, 0.0, last)
+        i = position.astype(int)
+        below = self.altitudes[i].astype(float)
+        return below + (self.altitudes[np.minimum(i + 1, last)] - below) * (position - i)
@@ -0,0 +1,251 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+
+import numpy as np
+
+from services.trajectory import DRAG_COEFFICIENT, FRONTAL_AREA, GRAVITY, simulate_batch
+
+# Grid over which the tables are computed
+TABLE_ANGLES = np.radians(np.arange(0.5, 90.0, 0.5))
+TABLE_DENSITIES = np.round(np.arange(0.9, 1.4 + 1e-9, 0.025), 3)
+TABLE_DT = 0.01
+
+# Directory where the tables are stored, next to the database in the instance folder
+FIRING_TABLES_DIR = os.getenv(
+    'FIRING_TABLES_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'firing_tables')
+)
+
+# Tables prepared at startup, as "mass:muzzle_speed" pairs separated by commas (e.g. "5:300,40:800")
+FIRING_TABLES = [
+    tuple(float(value) for value in pair.split(':'))
+    for pair in os.getenv('FIRING_TABLES', '').split(',') if pair.strip()
+]
+
+# Altitude of the flat terrain the tables are computed on (only the height above it matters)
+FLAT_ALTITUDE = 1000.0
+
+
+class FlatTerrain:
+    """
+    A terrain profile at constant altitude
+    """
+
+    step = math.inf
+
+    def __init__(self, altitude):
+        self.altitude = altitude
+
+    def altitude_at(self, distance):
+        return np.full(np.shape(distance), self.altitude)
+
+
+def drag_fingerprint():
+    """
+    Identifies the drag model and the grid the tables are computed with, so that stale tables are rebuilt
+
+    @return: A short hexadecimal digest
+    """
+    digest = hashlib.sha1(repr((GRAVITY, DRAG_COEFFICIENT, FRONTAL_AREA, TABLE_DT)).encode())
+    digest.update(TABLE_ANGLES.tobytes())
+    digest.update(TABLE_DENSITIES.tobytes())
+    return digest.hexdigest()[:16]
+
+
+def table_key(m, v0):
+    """
+    @param m: The mass of the projectile
+    @param v0: The muzzle speed of the projectile
+    @return: The key identifying the table of a projectile
+    """
+    return round(float(m), 3), round(float(v0), 1)
+
+
+class FiringTable:
+    """
+    Range, apex and time of flight of a projectile on flat terrain without wind, over a grid
+    of vertical angles and air densities
+    """
+
+    def __init__(self, m, v0, ranges, apexes, times, fingerprint):
+        """
+        @param m: The mass of the projectile
+        @param v0: The muzzle speed of the projectile
+        @param ranges: The horizontal distances traveled (angles x densities)
+        @param apexes: The maximum heights above the starting altitude (angles x densities)
+        @param times: The flight times (angles x densities)
+        @param fingerprint: The drag_fingerprint the table was computed with
+        """
+        self.m = m
+        self.v0 = v0
+        self.ranges = ranges
+        self.apexes = apexes
+        self.times = times
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, m, v0):
+        """
+        Computes a table with the vectorized engine, one shot per grid point
+
+        @param m: The mass of the projectile
+        @param v0: The muzzle speed of the projectile
+        @return: The new table
+        """
+        angles, densities = np.meshgrid(TABLE_ANGLES, TABLE_DENSITIES, indexing='ij')
+        air_data = {'density': densities.ravel(), 'wind_speed': 0.0, 'wind_deg': 0.0}
+        _, max_heights, distances, times = simulate_batch(
+            m, v0, angles.ravel(), 0.0, FLAT_ALTITUDE, air_data, FlatTerrain(FLAT_ALTITUDE), dt=TABLE_DT
+        )
+        shape = angles.shape
+        return cls(m, v0,
+                   distances.reshape(shape).astype(np.float32),
+                   (max_heights - FLAT_ALTITUDE).reshape(shape).astype(np.float32),
+                   times.reshape(shape).astype(np.float32),
+                   drag_fingerprint())
+
+    @staticmethod
+    def path(m, v0):
+        m, v0 = table_key(m, v0)
+        return os.path.join(FIRING_TABLES_DIR, f"{m:g}kg_{v0:g}ms.npz")
+
+    @classmethod
+    def load(cls, m, v0):
+        """
+        Reads a table from disk
+
+        @param m: The mass of the projectile
+        @param v0: The muzzle speed of the projectile
+        @return: The table, or None if it was never saved
+        """
+        try:
+            with np.load(cls.path(m, v0)) as data:
+                return cls(m, v0, data['ranges'], data['apexes'], data['times'], str(data['fingerprint']))
+        except FileNotFoundError:
+            return None
+
+    def save(self):
+        """
+        Writes the table to disk, replacing the previous version atomically
+        """
+        os.makedirs(FIRING_TABLES_DIR, exist_ok=True)
+        path = self.path(self.m, self.v0)
+        temporary = path + '.tmp.npz'
+        np.savez_compressed(temporary, ranges=self.ranges, apexes=self.apexes, times=self.times,
+                            fingerprint=np.array(self.fingerprint))
+        os.replace(temporary, path)
+
+    def lookup(self, vertical_angle, density):
+        """
+        Interpolates the table bilinearly
+
+        @param vertical_angle: The angle of departure (relative to the horizontal) in radians
+        @param density: The air density in kg/m^3
+        @return: The horizontal distance, the apex above the starting altitude and the flight time,
+                 or None if the point lies outside the grid
+        """
+        a = (vertical_angle - TABLE_ANGLES[0]) / (TABLE_ANGLES[1] - TABLE_ANGLES[0])
+        d = (density - TABLE_DENSITIES[0]) / (TABLE_DENSITIES[1] - TABLE_DENSITIES[0])
+        if not (0 <= a <= len(TABLE_ANGLES) - 1 and 0 <= d <= len(TABLE_DENSITIES) - 1):
+            return None
+
+        i = min(int(a), len(TABLE_ANGLES) - 2)
+        j = min(int(d), len(TABLE_DENSITIES) - 2)
+        wa = a - i
+        wd = d - j
+
+        def interpolate(values):
+            return float((values[i, j] * (1 - wa) + values[i + 1, j] * wa) * (1 - wd)
+                         + (values[i, j + 1] * (1 - wa) + values[i + 1, j + 1] * wa) * wd)
+
+        return interpolate(self.ranges), interpolate(self.apexes), interpolate(self.times)
+
+
+_tables = {}
+_pending = set()
+_pending_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def load_or_build(key, fingerprint):
+    """
+    Reads a table from disk, rebuilding and saving it if it is missing or the drag model changed
+
+    @param key: The key of the table, as returned by table_key
+    @param fingerprint: The current drag_fingerprint
+    @return: The table
+    """
+    table = FiringTable.load(*key)
+    if table is None or table.fingerprint != fingerprint:
+        table = FiringTable.build(*key)
+        table.save()
+    return table
+
+
+def prepare_in_background(key):
+    """
+    Loads or builds a table on a daemon thread, unless it is already being prepared
+
+    @param key: The key of the table, as returned by table_key
+    """
+    with _pending_lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+
+    def run():
+        try:
+            _tables[key] = load_or_build(key, drag_fingerprint())
+            logger.info("Firing table ready: %g kg at %g m/s", *key)
+        except Exception:
+            logger.exception("The firing table for %g kg at %g m/s could not be prepared", *key)
+        finally:
+            with _pending_lock:
+                _pending.discard(key)
+
+    threading.Thread(target=run, name='firing-table', daemon=True).start()
+
+
+def get_table(m, v0, build=False):
+    """
+    Returns the table of a projectile. Shots never wait for a table: a configured table that is not in memory
+    yet is loaded, or rebuilt if the drag model changed, in the background, and the shot is simulated meanwhile.
+
+    @param m: The mass of the projectile
+    @param v0: The muzzle speed of the projectile
+    @param build: Whether to load or build the table at once, even if it is not one of the configured FIRING_TABLES
+    @return: The table, or None if it is not ready
+    """
+    key = table_key(m, v0)
+    fingerprint = drag_fingerprint()
+    table = _tables.get(key)
+    if table is not None and table.fingerprint == fingerprint:
+        return table
+
+    if build:
+        table = _tables[key] = load_or_build(key, fingerprint)
+        return table
+    if key in {table_key(*pair) for pair in FIRING_TABLES}:
+        prepare_in_background(key)
+    return None
+
+
+def build_tables():
+    """
+    Builds or refreshes the configured FIRING_TABLES, skipping the ones already up to date
+
+    @return: The keys of the tables available
+    """
+    return [table_key(*pair) for pair in FIRING_TABLES if get_table(*pair, build=True) is not None]
+
+
+def build_tables_in_background():
+    """
+    Starts preparing the configured FIRING_TABLES, so that they are ready before the first shots need them
+    """
+    for pair in FIRING_TABLES:
+        prepare_in_background(table_key(*pair))
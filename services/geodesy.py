@@ -0,0 +1,75 @@
+import numpy as np
+
+EARTH_RADIUS = 6371000  # Earth's radius in meters
+
+
+def destination(lat, lon, distance, bearing):
+    """
+    Moves from positions along great circles. Every argument may be a scalar or an array, and they are broadcast.
+
+    @param lat: The initial latitudes in degrees
+    @param lon: The initial longitudes in degrees
+    @param distance: The distances to move, in metres
+    @param bearing: The initial bearings in radians, clockwise from the North
+    @return: The arrays of the new latitudes and longitudes in degrees
+    """
+    lat_rad = np.radians(lat)
+    delta = np.asarray(distance, dtype=float) / EARTH_RADIUS
+    sin_lat, cos_lat = np.sin(lat_rad), np.cos(lat_rad)
+    sin_delta, cos_delta = np.sin(delta), np.cos(delta)
+
+    sin_new_lat = np.clip(sin_lat * cos_delta + cos_lat * sin_delta * np.cos(bearing), -1.0, 1.0)
+    d_lon = np.arctan2(np.sin(bearing) * sin_delta * cos_lat, cos_delta - sin_lat * sin_new_lat)
+    return np.degrees(np.arcsin(sin_new_lat)), np.asarray(lon, dtype=float) + np.degrees(d_lon)
+
+
+def to_geographic(lat, lon, north, east):
+    """
+    Converts local (north, east) offsets from positions to geographic coordinates, laying each offset out along
+    the great circle leaving its origin with the same bearing (an azimuthal equidistant projection).
+    Origins and offsets are broadcast, so the impacts of a whole batch are converted in one pass.
+
+    @param lat: The latitudes of the origins in degrees
+    @param lon: The longitudes of the origins in degrees
+    @param north: The northward offsets in metres
+    @param east: The eastward offsets in metres
+    @return: The arrays of the latitudes and longitudes in degrees
+    """
+    north = np.asarray(north, dtype=float)
+    east = np.asarray(east, dtype=float)
+    return destination(lat, lon, np.hypot(north, east), np.arctan2(east, north))
+
+
+class LocalFrame:
+    """
+    The local frame of a shot: x points North, z points East and y is the altitude, as in the simulations.
+    Whole arrays of positions are converted in one vectorized pass.
+    """
+
+    def __init__(self, lat, lon):
+        """
+        @param lat: The latitude of the origin in degrees
+        @param lon: The longitude of the origin in degrees
+        """
+        self.lat = lat
+        self.lon = lon
+
+    def along(self, distances, bearing):
+        """
+        Locates points at several distances along the same bearing, e.g. the samples of a ground profile
+
+        @param distances: A distance in metres, or an array of distances
+        @param bearing: The bearing in radians, clockwise from the North
+        @return: The latitudes and longitudes in degrees
+        """
+        return destination(self.lat, self.lon, distances, bearing)
+
+    def to_geographic(self, x, z):
+        """
+        Converts positions of the simulation to geographic coordinates
+
+        @param x: The northward offsets in metres (scalar or array)
+        @param z: The eastward offsets in metres (scalar or array)
+        @return: The latitudes and longitudes in degrees
+        """
+        return to_geographic(self.lat, self.lon, x, z)
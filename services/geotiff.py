@@ -0,0 +1,256 @@
+import glob
+import hashlib
+import os
+import re
+import struct
+import threading
+
+import numpy as np
+
+# TIFF tags read by the parser
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+TILE_WIDTH = 322
+SAMPLE_FORMAT = 339
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+GDAL_NODATA = 42113
+
+# TIFF field type -> (struct format, size in bytes)
+FIELD_TYPES = {
+    1: ('B', 1), 2: ('c', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+    6: ('b', 1), 7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8),
+    11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8),
+}
+
+# (SampleFormat, BitsPerSample) -> numpy type
+SAMPLE_TYPES = {
+    (1, 8): 'u1', (1, 16): 'u2', (1, 32): 'u4',
+    (2, 8): 'i1', (2, 16): 'i2', (2, 32): 'i4',
+    (3, 32): 'f4', (3, 64): 'f8',
+}
+
+# Tile names used by OpenTopodata, e.g. N00E000 for the tile whose south-west corner is 0°N 0°E
+TILE_NAME = re.compile(r'^([NS])(\d{2})([EW])(\d{3})$')
+
+
+def read_tags(path):
+    """
+    Reads the tags of the first image of a TIFF or BigTIFF file
+
+    @param path: The path of the file
+    @return: The byte order of the file and a dictionary mapping each tag to its values
+    """
+    with open(path, 'rb') as f:
+        header = f.read(16)
+        order = {b'II': '<', b'MM': '>'}.get(header[:2])
+        if order is None:
+            raise ValueError(f"{path} is not a TIFF file")
+
+        version = struct.unpack(order + 'H', header[2:4])[0]
+        if version == 42:
+            ifd_offset = struct.unpack(order + 'I', header[4:8])[0]
+            count_format, entry_format, entry_size, inline_size = 'H', 'HHI', 12, 4
+        elif version == 43:
+            ifd_offset = struct.unpack(order + 'Q', header[8:16])[0]
+            count_format, entry_format, entry_size, inline_size = 'Q', 'HHQ', 20, 8
+        else:
+            raise ValueError(f"{path} is not a TIFF file")
+
+        f.seek(ifd_offset)
+        count_size = struct.calcsize(count_format)
+        entry_count = struct.unpack(order + count_format, f.read(count_size))[0]
+        entries = f.read(entry_count * entry_size)
+
+        tags = {}
+        for i in range(entry_count):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            tag, field_type, count = struct.unpack(order + entry_format, entry[:entry_size - inline_size])
+            if field_type not in FIELD_TYPES:
+                continue
+
+            value_format, value_size = FIELD_TYPES[field_type]
+            raw = entry[entry_size - inline_size:]
+            if value_size * count > inline_size:
+                f.seek(struct.unpack(order + ('I' if version == 42 else 'Q'), raw)[0])
+                raw = f.read(value_size * count)
+
+            if field_type == 2:
+                tags[tag] = raw[:count].rstrip(b'\0').decode('ascii')
+            else:
+                tags[tag] = struct.unpack(order + value_format * count, raw[:value_size * count])
+
+    return order, tags
+
+
+class GeoTiffTile:
+    """
+    A single-band GeoTIFF tile whose pixels are read through a lazily opened memory map
+    """
+
+    def __init__(self, path, bounds=None):
+        """
+        @param path: The path of the tile
+        @param bounds: The (south, west, north, east) bounds of the tile, read from the file if not given
+        """
+        self.path = path
+        self.bounds = bounds
+        self._data = None
+        self._lock = threading.Lock()
+        if bounds is None:
+            self._open()
+
+    def _open(self):
+        """
+        Parses the header of the tile and maps its pixels into memory
+        """
+        order, tags = read_tags(self.path)
+        if TILE_WIDTH in tags:
+            raise ValueError(f"{self.path} is tiled, only strip-based GeoTIFFs can be memory-mapped")
+        if tags.get(COMPRESSION, (1,))[0] != 1:
+            raise ValueError(f"{self.path} is compressed, only uncompressed GeoTIFFs can be memory-mapped")
+        if tags.get(SAMPLES_PER_PIXEL, (1,))[0] != 1:
+            raise ValueError(f"{self.path} has more than one band")
+
+        width = tags[IMAGE_WIDTH][0]
+        height = tags[IMAGE_LENGTH][0]
+        bits = tags[BITS_PER_SAMPLE][0]
+        dtype = np.dtype(order + SAMPLE_TYPES[(tags.get(SAMPLE_FORMAT, (1,))[0], bits)])
+
+        # The strips must follow each other so that the whole raster is a single array on disk
+        offsets = tags[STRIP_OFFSETS]
+        rows_per_strip = tags.get(ROWS_PER_STRIP, (height,))[0]
+        strip_size = rows_per_strip * width * dtype.itemsize
+        if any(offset != offsets[0] + i * strip_size for i, offset in enumerate(offsets)):
+            raise ValueError(f"{self.path} does not store its strips contiguously")
+
+        self.width = width
+        self.height = height
+        self.nodata = float(tags[GDAL_NODATA]) if GDAL_NODATA in tags else None
+        if MODEL_TIEPOINT in tags and MODEL_PIXEL_SCALE in tags:
+            i, j, _, x, y, _ = tags[MODEL_TIEPOINT][:6]
+            scale_x, scale_y = tags[MODEL_PIXEL_SCALE][:2]
+            west = x - i * scale_x
+            north = y + j * scale_y
+            self.bounds = (north - height * scale_y, west, north, west + width * scale_x)
+
+        self._data = np.memmap(self.path, dtype=dtype, mode='r', offset=offsets[0], shape=(height, width))
+
+    @property
+    def data(self):
+        """
+        The pixels of the tile, mapped into memory on first access
+        """
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    self._open()
+        return self._data
+
+    def contains(self, latitudes, longitudes):
+        """
+        Tells which of the given positions fall inside the tile
+
+        @param latitudes: An array of latitudes
+        @param longitudes: An array of longitudes
+        @return: A boolean mask
+        """
+        south, west, north, east = self.bounds
+        return (latitudes >= south) & (latitudes <= north) & (longitudes >= west) & (longitudes <= east)
+
+    def sample(self, latitudes, longitudes):
+        """
+        Bilinearly interpolates the raster at the given positions
+
+        @param latitudes: An array of latitudes inside the tile
+        @param longitudes: An array of longitudes inside the tile
+        @return: An array of interpolated values (NaN where a neighbouring pixel has no data)
+        """
+        data = self.data
+        south, west, north, east = self.bounds
+
+        # Fractional pixel coordinates, measured from the centre of the top-left pixel
+        col = (longitudes - west) / (east - west) * self.width - 0.5
+        row = (north - latitudes) / (north - south) * self.height - 0.5
+        col0 = np.clip(np.floor(col).astype(np.intp), 0, max(self.width - 2, 0))
+        row0 = np.clip(np.floor(row).astype(np.intp), 0, max(self.height - 2, 0))
+        col1 = np.minimum(col0 + 1, self.width - 1)
+        row1 = np.minimum(row0 + 1, self.height - 1)
+        wx = np.clip(col - col0, 0.0, 1.0)
+        wy = np.clip(row - row0, 0.0, 1.0)
+
+        corners = [data[r, c].astype(float) for r, c in ((row0, col0), (row0, col1), (row1, col0), (row1, col1))]
+        if self.nodata is not None:
+            for corner in corners:
+                corner[corner == self.nodata] = np.nan
+
+        top_left, top_right, bottom_left, bottom_right = corners
+        top = top_left * (1 - wx) + top_right * wx
+        bottom = bottom_left * (1 - wx) + bottom_right * wx
+        return top * (1 - wy) + bottom * wy
+
+
+class GeoTiffElevationBackend:
+    """
+    Reads terrain altitudes directly from a directory of GeoTIFF tiles, such as the GEBCO
+    tiles downloaded by elevation_vm/opentopodata-setup.sh
+    """
+
+    # Local lookups are cheap, so they are not worth caching per DEM cell
+    cached = False
+
+    def __init__(self, directory, tile_size=90):
+        """
+        @param directory: The directory containing the .tif tiles
+        @param tile_size: The size in degrees of the tiles named after their south-west corner
+        """
+        self.tiles = []
+        for path in sorted(glob.glob(os.path.join(directory, '*.tif'))):
+            match = TILE_NAME.match(os.path.splitext(os.path.basename(path))[0])
+            if match:
+                lat_sign, lat, lon_sign, lon = match.groups()
+                south = int(lat) * (-1 if lat_sign == 'S' else 1)
+                west = int(lon) * (-1 if lon_sign == 'W' else 1)
+                self.tiles.append(GeoTiffTile(path, (south, west, south + tile_size, west + tile_size)))
+            else:
+                self.tiles.append(GeoTiffTile(path))
+
+        if not self.tiles:
+            raise ValueError(f"No GeoTIFF tiles found in {directory}")
+
+    def dataset(self):
+        """
+        @return: The identity of the dataset: the name, size and modification time of every tile
+        """
+        digest = hashlib.sha1()
+        for tile in self.tiles:
+            status = os.stat(tile.path)
+            digest.update(f"{os.path.basename(tile.path)}:{status.st_size}:{status.st_mtime_ns};".encode())
+        return f"geotiff:{digest.hexdigest()}"
+
+    def altitudes(self, latitudes, longitudes):
+        """
+        Gets the altitudes of an array of positions
+
+        @param latitudes: An array of latitudes
+        @param longitudes: An array of longitudes
+        @return: An array of altitudes (NaN outside the tiles)
+        """
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        result = np.full(latitudes.shape, np.nan)
+        pending = np.ones(latitudes.shape, dtype=bool)
+        for tile in self.tiles:
+            mask = pending & tile.contains(latitudes, longitudes)
+            if mask.any():
+                result[mask] = tile.sample(latitudes[mask], longitudes[mask])
+                pending &= ~mask
+            if not pending.any():
+                break
+        return result
@@ -0,0 +1,158 @@
+import os
+import queue
+import threading
+import time
+import uuid
+
+from services.cache import TTLCache
+
+# Threads running the jobs and maximum number of jobs waiting for one of them
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 100))
+
+# Seconds a finished job is kept for polling
+JOB_RESULT_TTL = float(os.getenv('JOB_RESULT_TTL', 3600))
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted while the queue is full
+    """
+
+
+class Job:
+    """
+    A unit of work run by the JobQueue, with its status and result
+    """
+
+    def __init__(self, function, args):
+        self.id = uuid.uuid4().hex
+        self.function = function
+        self.args = args
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobQueue:
+    """
+    A bounded queue of jobs run by a fixed pool of worker threads.
+    Submissions are rejected once the queue is full, so that load is shed instead of piling up.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_depth=JOB_QUEUE_SIZE, result_ttl=JOB_RESULT_TTL):
+        """
+        @param workers: The number of worker threads
+        @param max_depth: The maximum number of jobs waiting to run
+        @param result_ttl: The number of seconds a job is kept after it was submitted
+        """
+        self.workers = workers
+        self.max_depth = max_depth
+        self.jobs = TTLCache(maxsize=max(max_depth * 100, 1000), ttl=result_ttl)
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.started_at = time.time()
+            job.status = 'running'
+            wait_time = job.started_at - job.submitted_at
+            with self._lock:
+                self.running += 1
+                self.wait_time_total += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+            try:
+                job.result = job.function(*job.args)
+                job.status = 'done'
+            except Exception as e:
+                job.error = str(e)
+                job.status = 'failed'
+            job.finished_at = time.time()
+            with self._lock:
+                self.running -= 1
+                if job.status == 'done':
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            self._queue.task_done()
+
+    def submit(self, function, *args):
+        """
+        Queues a function call
+
+        @param function: The function to run
+        @param args: The arguments of the function
+        @return: The new job
+        @raise QueueFull: If the queue has reached its maximum depth
+        """
+        self._start()
+        job = Job(function, args)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull(f"The job queue is full ({self.max_depth} jobs waiting)")
+        self.jobs.set(job.id, job)
+        return job
+
+    def get(self, job_id):
+        """
+        @param job_id: The ID of a job
+        @return: The job, or None if it is unknown or expired
+        """
+        return self.jobs.get(job_id)
+
+    def stats(self):
+        """
+        Returns the queue depth, the number of jobs by outcome and the time jobs waited before running
+
+        @return: A dictionary with the queue statistics
+        """
+        with self._lock:
+            started = self.completed + self.failed + self.running
+            return {
+                'workers': self.workers,
+                'max_depth': self.max_depth,
+                'depth': self._queue.qsize(),
+                'running': self.running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'wait_time_avg': self.wait_time_total / started if started else 0.0,
+                'wait_time_max': self.wait_time_max,
+            }
+
+
+job_queue = JobQueue()
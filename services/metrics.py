@@ -0,0 +1,332 @@
+import contextvars
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter as Tally
+from contextlib import contextmanager
+
+# Whether responses carry a Server-Timing header with the time spent in each stage
+SERVER_TIMING = os.getenv('SERVER_TIMING', '0').lower() in ('1', 'true', 'yes')
+
+# Whether the sampling profiler may be started through the API
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', '0').lower() in ('1', 'true', 'yes')
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    """
+    A monotonically increasing value, one per combination of labels
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Histogram:
+    """
+    A distribution of observed values over cumulative buckets, one per combination of labels
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._values = {}  # labels -> [bucket counts, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', key + (('le', format_value(bound)),), cumulative))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, cumulative))
+        return samples
+
+
+class Registry:
+    """
+    The metrics of the application, rendered in the Prometheus text format.
+    Besides counters and histograms, collectors can report gauges read at scrape time (e.g. cache sizes).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation):
+        metric = Counter(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, function):
+        """
+        Registers a function returning gauges as (name, documentation, [(labels dict, value), ...]) tuples
+
+        @param function: The function, called at every scrape
+        @return: The function, so that this can be used as a decorator
+        """
+        self._collectors.append(function)
+        return function
+
+    def render(self):
+        """
+        @return: All the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        for function in self._collectors:
+            for name, documentation, samples in function():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} gauge')
+                for labels, value in samples:
+                    lines.append(f'{name}{format_labels(tuple(sorted(labels.items())))} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram('ballistics_stage_seconds', 'Time spent in each stage of the pipeline')
+REQUEST_SECONDS = registry.histogram('ballistics_request_seconds', 'Duration of the API requests')
+UPSTREAM_CALLS = registry.counter('ballistics_upstream_calls_total', 'Calls made to the upstream services')
+UPSTREAM_CALLS_PER_REQUEST = registry.histogram('ballistics_upstream_calls_per_request',
+                                                'Upstream calls made while serving an API request',
+                                                buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 32, 64))
+INTEGRATION_STEPS = registry.histogram('ballistics_integration_steps', 'Steps taken to integrate a trajectory',
+                                       buckets=(10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000))
+
+
+class Trace:
+    """
+    The time spent in each stage, and the events counted, while serving one request
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counts = Tally()
+        self._lock = threading.Lock()
+
+    def add(self, stage, elapsed):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + elapsed
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counts[name] += amount
+
+    def server_timing(self):
+        """
+        @return: The value of a Server-Timing header, with the durations in milliseconds
+        """
+        with self._lock:
+            entries = [f'{stage};dur={elapsed * 1000:.1f}' for stage, elapsed in self.stages.items()]
+        entries.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(entries)
+
+
+_trace = contextvars.ContextVar('trace', default=None)
+
+
+def start_trace():
+    """
+    Starts tracing the current request
+
+    @return: The new trace
+    """
+    trace = Trace()
+    _trace.set(trace)
+    return trace
+
+
+def current_trace():
+    """
+    @return: The trace of the current request, or None outside of a traced request
+    """
+    return _trace.get()
+
+
+@contextmanager
+def timed(stage):
+    """
+    Measures the time spent in a stage, for the metrics and for the trace of the current request
+
+    @param stage: The name of the stage
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace = _trace.get()
+        if trace is not None:
+            trace.add(stage, elapsed)
+
+
+def count_upstream_call(service, outcome):
+    """
+    Counts a call to an upstream service
+
+    @param service: The name of the service
+    @param outcome: 'ok', 'error' (unexpected status), 'failed' (no response) or 'rejected' (circuit open)
+    """
+    UPSTREAM_CALLS.inc(service=service, outcome=outcome)
+    trace = _trace.get()
+    if trace is not None:
+        trace.count('upstream_calls')
+
+
+# Innermost frames of threads waiting for work, left out of the profiles
+IDLE_FRAMES = {'threading.py:wait', 'selectors.py:select', 'thread.py:_worker', 'queue.py:get', 'socket.py:accept'}
+
+
+class SamplingProfiler:
+    """
+    A statistical profiler sampling the stacks of all threads at a fixed interval.
+    It can be started and stopped while the server runs, and reports the samples as collapsed stacks
+    (one 'frame;frame;frame count' line per distinct stack), the input format of flame graph tools.
+    Threads idling in the pools are not reported.
+    """
+
+    def __init__(self):
+        self.interval = None
+        self.started_at = None
+        self.samples = 0
+        self._stacks = Tally()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=0.005):
+        """
+        Starts sampling, discarding the samples of the previous run
+
+        @param interval: The time between two samples in seconds
+        @return: False if the profiler was already running
+        """
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self.interval = interval
+            self.started_at = time.time()
+            self.samples = 0
+            self._stacks = Tally()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        """
+        Stops sampling, keeping the samples for report()
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            sampled = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                if stack[0] not in IDLE_FRAMES:
+                    sampled.append(';'.join(reversed(stack)))
+            # The stacks are walked outside the lock, so that readers only wait for the update
+            with self._lock:
+                self._stacks.update(sampled)
+                self.samples += 1
+
+    def state(self):
+        """
+        @return: Whether the profiler is running, its interval, the time it was started and the samples taken
+        """
+        with self._lock:
+            return {
+                'running': self._thread is not None,
+                'interval': self.interval,
+                'started_at': self.started_at,
+                'samples': self.samples,
+            }
+
+    def report(self, limit=None):
+        """
+        @param limit: The maximum number of stacks reported, the most sampled first
+        @return: The collapsed stacks, one per line
+        """
+        with self._lock:
+            stacks = Tally(self._stacks)
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common(limit))
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,107 @@
+import heapq
+import os
+
+import numpy as np
+
+# Largest number of points a client may ask for in a trajectory
+TRAJECTORY_MAX_POINTS = int(os.getenv('TRAJECTORY_MAX_POINTS', 2000))
+
+
+class TrajectoryRecorder:
+    """
+    Records the states of a simulation into a preallocated array, grown by doubling when full,
+    so that recording a step costs a row assignment rather than new Python objects
+    """
+
+    def __init__(self, capacity=4096):
+        """
+        @param capacity: The number of states allocated up front
+        """
+        self._buffer = np.empty((capacity, 4))
+        self.size = 0
+
+    def append(self, t, x, y, z):
+        """
+        Records a state
+
+        @param t: The time since the shot
+        @param x: The x-coordinate of the projectile
+        @param y: The altitude of the projectile
+        @param z: The z-coordinate of the projectile
+        """
+        if self.size == len(self._buffer):
+            grown = np.empty((2 * len(self._buffer), 4))
+            grown[:self.size] = self._buffer
+            self._buffer = grown
+        self._buffer[self.size] = (t, x, y, z)
+        self.size += 1
+
+    def points(self):
+        """
+        @return: A view of the recorded states, one (t, x, y, z) row per state
+        """
+        return self._buffer[:self.size]
+
+
+def segment_distances(points, start, end):
+    """
+    Computes the distances of points from a segment
+
+    @param points: An array of points, one per row
+    @param start: The first end of the segment
+    @param end: The second end of the segment
+    @return: The distance of each point from the closest point of the segment
+    """
+    direction = end - start
+    length2 = float(direction @ direction)
+    if length2 == 0:
+        return np.linalg.norm(points - start, axis=1)
+    fraction = np.clip((points - start) @ direction / length2, 0.0, 1.0)
+    return np.linalg.norm(points - (start + fraction[:, None] * direction), axis=1)
+
+
+def simplify(points, max_points):
+    """
+    Downsamples a polyline with the Ramer–Douglas–Peucker algorithm under a point budget: the segment whose
+    farthest point deviates the most is split first, until the budget is spent. The shape is therefore kept as
+    well as the budget allows, without having to choose a distance tolerance.
+
+    @param points: An array of points, one per row
+    @param max_points: The maximum number of points kept (at least 2)
+    @return: The sorted indices of the points kept, always including the first and the last one
+    """
+    n = len(points)
+    if n <= max_points:
+        return np.arange(n)
+
+    keep = [0, n - 1]
+    queue = []
+
+    def push(first, last):
+        if last - first < 2:
+            return
+        distances = segment_distances(points[first + 1:last], points[first], points[last])
+        farthest = int(np.argmax(distances))
+        heapq.heappush(queue, (-distances[farthest], first, first + 1 + farthest, last))
+
+    push(0, n - 1)
+    while queue and len(keep) < max_points:
+        _, first, index, last = heapq.heappop(queue)
+        keep.append(index)
+        push(first, index)
+        push(index, last)
+    return np.sort(keep)
+
+
+def to_polyline(points, frame, max_points):
+    """
+    Downsamples recorded states and converts them to geographic coordinates in one vectorized pass
+
+    @param points: The (t, x, y, z) rows of a TrajectoryRecorder
+    @param frame: The LocalFrame of the shot
+    @param max_points: The maximum number of points returned
+    @return: A list of [latitude, longitude, altitude, time] points
+    """
+    kept = points[simplify(points[:, 1:], max_points)]
+    lats, lons = frame.to_geographic(kept[:, 1], kept[:, 3])
+    return np.column_stack((lats, lons, kept[:, 2], kept[:, 0])).tolist()
@@ -0,0 +1,249 @@
+import hashlib
+import logging
+import math
+import os
+import shutil
+import threading
+from functools import partial
+
+import numpy as np
+
+from services.elevation import ELEVATION_GRID_RESOLUTION, GROUND_PROFILE_STEP, GroundProfile, cell_center, \
+    get_backend, snap_to_grid
+from services.cache import TTLCache
+from services.geodesy import LocalFrame
+
+# Whether terrain profiles are kept on disk, so that they are shared by the workers and survive restarts
+GROUND_PROFILE_STORE = os.getenv('GROUND_PROFILE_STORE', '0') == '1'
+
+# Directory of the stored profiles, next to the database in the instance folder
+GROUND_PROFILE_DIR = os.getenv(
+    'GROUND_PROFILE_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'ground_profiles')
+)
+
+# Shots fired from the same origin cell (in arc-seconds) along the same azimuth bin (in degrees) share a profile
+GROUND_PROFILE_ORIGIN_RESOLUTION = float(os.getenv('GROUND_PROFILE_ORIGIN_RESOLUTION', 1)) / 3600
+GROUND_PROFILE_AZIMUTH_BIN = float(os.getenv('GROUND_PROFILE_AZIMUTH_BIN', 0.05))
+
+# Profiles fetched at startup, as "latitude:longitude:azimuth:range" quadruples separated by commas
+# (decimal degrees, degrees clockwise from the North and metres, e.g. "45.97:8.87:30:20000")
+GROUND_PROFILE_POSITIONS = [
+    tuple(float(value) for value in position.split(':'))
+    for position in os.getenv('GROUND_PROFILE_POSITIONS', '').split(',') if position.strip()
+]
+
+# Bumped by hand when the elevation dataset is updated in place under the same name
+ELEVATION_DATASET_VERSION = os.getenv('ELEVATION_DATASET_VERSION', '')
+
+# Stored profiles kept mapped by each process, so that the shots of a battery do not reopen the same file
+mapped_profiles = TTLCache(maxsize=int(os.getenv('GROUND_PROFILE_MAPPED', 1024)))
+
+logger = logging.getLogger(__name__)
+
+_fingerprint = None
+_counters = {'hits': 0, 'misses': 0, 'writes': 0}
+_counters_lock = threading.Lock()
+
+
+def dataset_fingerprint():
+    """
+    Identifies the elevation dataset and the sampling the profiles are stored with, so that the profiles
+    of another dataset are never read
+
+    @return: A short hexadecimal digest, computed once per process
+    """
+    global _fingerprint
+    if _fingerprint is None:
+        digest = hashlib.sha1(repr((get_backend().dataset(), ELEVATION_DATASET_VERSION, ELEVATION_GRID_RESOLUTION,
+                                    GROUND_PROFILE_STEP)).encode())
+        _fingerprint = digest.hexdigest()[:16]
+    return _fingerprint
+
+
+def profile_key(lat, lon, bearing):
+    """
+    @param lat: The latitude of the firing position
+    @param lon: The longitude of the firing position
+    @param bearing: The azimuth of the shot in radians, clockwise from the North
+    @return: The (row, column, bin) key of the origin cell and azimuth bin of the shot
+    """
+    row, col = snap_to_grid(lat, lon, GROUND_PROFILE_ORIGIN_RESOLUTION)
+    bins = round(360 / GROUND_PROFILE_AZIMUTH_BIN)
+    return row, col, round(math.degrees(bearing) / GROUND_PROFILE_AZIMUTH_BIN) % bins
+
+
+def profile_path(key):
+    """
+    @param key: The key of the profile, as returned by profile_key
+    @return: The path of the profile in the store, under the fingerprint of the elevation dataset
+    """
+    return os.path.join(GROUND_PROFILE_DIR, dataset_fingerprint(), '{}_{}_{}.npy'.format(*key))
+
+
+def count(counter):
+    """
+    @param counter: The name of the counter to increment: 'hits', 'misses' or 'writes'
+    """
+    with _counters_lock:
+        _counters[counter] += 1
+
+
+def load_samples(path):
+    """
+    Maps the altitudes of a stored profile in memory
+
+    @param path: The path of the profile
+    @return: A read-only float32 array, or None if the profile was never stored
+    """
+    try:
+        return np.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.warning("Ignoring the unreadable ground profile %s", path)
+        return None
+
+
+def mapped_samples(key, distance):
+    """
+    Gets the stored altitudes of a profile from the profiles mapped by the process. The file is mapped again
+    when the mapped samples do not cover the distance, since another process may have extended it.
+
+    @param key: The key of the profile, as returned by profile_key
+    @param distance: The distance in metres the profile must cover
+    @return: A read-only float32 array, or None if the profile was never stored
+    """
+    samples = mapped_profiles.get(key)
+    if samples is None or (len(samples) - 1) * GROUND_PROFILE_STEP < distance:
+        samples = load_samples(profile_path(key))
+        if samples is not None:
+            mapped_profiles.set(key, samples)
+    return samples
+
+
+def save_samples(path, altitudes):
+    """
+    Writes the altitudes of a profile as float32, replacing the previous version atomically
+
+    @param path: The path of the profile
+    @param altitudes: The altitudes of the samples
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, 'wb') as file:
+        np.save(file, np.asarray(altitudes, dtype=np.float32))
+    os.replace(temporary, path)
+    count('writes')
+
+
+class StoredProfile(GroundProfile):
+    """
+    A ground profile starting from the samples of the store, which writes back the samples it fetches beyond them.
+    Profiles holding fallback altitudes are never written.
+    """
+
+    def __init__(self, key, locate, distance, samples=None):
+        """
+        @param key: The key of the profile in the store, as returned by profile_key
+        @param locate: A function returning the latitudes and longitudes of the points along the track
+        @param distance: The distance in metres the profile must cover
+        @param samples: The stored altitudes, if any
+        """
+        self.key = key
+        self.path = profile_path(key)
+        self.stored = 0 if samples is None else len(samples)
+        super().__init__(locate, distance, samples=samples)
+
+    def extend(self, distance):
+        super().extend(distance)
+        if len(self.altitudes) > self.stored and not self.degraded:
+            save_samples(self.path, self.altitudes)
+            self.stored = len(self.altitudes)
+            mapped_profiles.set(self.key, load_samples(self.path))
+
+
+def get_profile(lat, lon, bearing, distance):
+    """
+    Gets the terrain profile along the azimuth of a shot. With the store enabled, the profile starts from
+    the centre of the origin cell along the centre of the azimuth bin, so that every shot of a battery
+    firing from a fixed position reads the same stored samples.
+
+    @param lat: The latitude of the firing position
+    @param lon: The longitude of the firing position
+    @param bearing: The azimuth of the shot in radians, clockwise from the North
+    @param distance: The distance in metres the profile must cover
+    @return: A GroundProfile
+    """
+    if not GROUND_PROFILE_STORE:
+        return GroundProfile(partial(LocalFrame(lat, lon).along, bearing=bearing), distance)
+
+    key = profile_key(lat, lon, bearing)
+    origin = cell_center(key[0], key[1], GROUND_PROFILE_ORIGIN_RESOLUTION)
+    locate = partial(LocalFrame(*origin).along, bearing=math.radians(key[2] * GROUND_PROFILE_AZIMUTH_BIN))
+    samples = mapped_samples(key, distance)
+    count('misses' if samples is None or (len(samples) - 1) * GROUND_PROFILE_STEP < distance else 'hits')
+    return StoredProfile(key, locate, distance, samples)
+
+
+def warm_up():
+    """
+    Fetches and stores the profiles of the configured GROUND_PROFILE_POSITIONS, skipping the ones already
+    stored, and deletes the profiles of other elevation datasets
+
+    @return: The number of profiles ready
+    """
+    prune()
+    ready = 0
+    for lat, lon, azimuth, distance in GROUND_PROFILE_POSITIONS:
+        profile = get_profile(lat, lon, math.radians(azimuth), distance)
+        if not profile.degraded:
+            ready += 1
+    return ready
+
+
+def warm_up_in_background():
+    """
+    Starts the warm up on a daemon thread, so that the workers start serving at once
+    """
+    if not (GROUND_PROFILE_STORE and GROUND_PROFILE_POSITIONS):
+        return
+
+    def run():
+        try:
+            logger.info("%d ground profiles ready", warm_up())
+        except Exception:
+            logger.exception("The warm up of the ground profiles failed")
+
+    threading.Thread(target=run, name='ground-profiles', daemon=True).start()
+
+
+def prune():
+    """
+    Deletes the profiles stored for other elevation datasets
+
+    @return: The number of directories deleted
+    """
+    fingerprint = dataset_fingerprint()
+    deleted = 0
+    if os.path.isdir(GROUND_PROFILE_DIR):
+        for name in os.listdir(GROUND_PROFILE_DIR):
+            if name != fingerprint:
+                shutil.rmtree(os.path.join(GROUND_PROFILE_DIR, name), ignore_errors=True)
+                deleted += 1
+    return deleted
+
+
+def stats():
+    """
+    @return: Whether the store is enabled, the dataset fingerprint, the profiles read without and with
+             fetching, the profiles written and the profiles mapped by the process
+    """
+    with _counters_lock:
+        counters = dict(_counters)
+    return {
+        'enabled': GROUND_PROFILE_STORE,
+        'fingerprint': dataset_fingerprint() if GROUND_PROFILE_STORE else None,
+        **counters,
+        'mapped': len(mapped_profiles),
+    }
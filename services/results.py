@@ -0,0 +1,112 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from models.conn import db
+from models.models import CachedResult
+from services.cache import TTLCache
+from services.firing_tables import drag_fingerprint
+from services.weather import weather_cache
+
+# Results are reused within the same weather epoch, by default as long as the weather itself is cached
+RESULT_CACHE_EPOCH = float(os.getenv('RESULT_CACHE_EPOCH', weather_cache.ttl or 600))
+
+# Results kept in memory, in front of the cached_result table
+result_cache = TTLCache(
+    maxsize=int(os.getenv('RESULT_CACHE_SIZE', 10000)),
+    ttl=RESULT_CACHE_EPOCH,
+)
+
+_stored = {'hits': 0, 'misses': 0}
+_stored_lock = threading.Lock()
+
+
+def result_key(shot, terrain_accurate, now=None):
+    """
+    Hashes the normalized inputs of a shot, so that identical shots share their result.
+    The weather epoch is part of the key, since the drag depends on the weather at the time of the shot.
+
+    @param shot: The shot, as returned by parse_shot
+    @param terrain_accurate: Whether the shot follows the terrain or may use the firing tables
+    @param now: The time of the shot (defaults to the current time)
+    @return: A hexadecimal SHA-256 digest
+    """
+    epoch = int((time.time() if now is None else now) // RESULT_CACHE_EPOCH)
+    inputs = {
+        'lat': round(shot['lat'], 7),
+        'lon': round(shot['lon'], 7),
+        'v0': round(shot['v0'], 3),
+        'vertical_angle': round(math.degrees(shot['vertical_angle']), 6),
+        'horizontal_angle': round(math.degrees(shot['horizontal_angle']), 6),
+        'm': round(shot['m'], 4),
+        'integrator': shot['integrator'],
+        'terrain_accurate': bool(terrain_accurate),
+        'trajectory_points': shot.get('trajectory_points', 0),
+        'model': drag_fingerprint(),
+        'epoch': epoch,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def lookup(key):
+    """
+    Looks a result up in memory, then in the cached_result table
+
+    @param key: The key returned by result_key
+    @return: A copy of the response body, or None on a miss
+    """
+    cached = result_cache.get(key)
+    if cached is None:
+        row = db.session.execute(
+            db.select(CachedResult.response).where(CachedResult.key == key).limit(1)
+        ).scalar()
+        with _stored_lock:
+            _stored['hits' if row is not None else 'misses'] += 1
+        if row is None:
+            return None
+        cached = row
+        result_cache.set(key, cached)
+    return json.loads(cached)
+
+
+def remember(key, response):
+    """
+    Keeps a result in memory and builds the row that stores it in the cached_result table
+
+    @param key: The key returned by result_key
+    @param response: The response body
+    @return: The CachedResult, to be saved with the history
+    """
+    encoded = json.dumps(response)
+    result_cache.set(key, encoded)
+    return CachedResult(key=key, response=encoded, created_at=datetime.now())
+
+
+def prune(max_age=None):
+    """
+    Deletes the stored results older than a given age
+
+    @param max_age: The age in seconds (defaults to one weather epoch, after which no key can match)
+    @return: The number of rows deleted
+    """
+    max_age = RESULT_CACHE_EPOCH if max_age is None else max_age
+    deleted = db.session.execute(
+        db.delete(CachedResult).where(CachedResult.created_at < datetime.now() - timedelta(seconds=max_age))
+    ).rowcount
+    db.session.commit()
+    return deleted
+
+
+def stats():
+    """
+    @return: The statistics of the in-memory cache, with the hits and misses of the table behind it
+    """
+    with _stored_lock:
+        stored = dict(_stored)
+    lookups = stored['hits'] + stored['misses']
+    stored['hit_ratio'] = stored['hits'] / lookups if lookups else 0.0
+    return dict(result_cache.stats(), epoch=RESULT_CACHE_EPOCH, stored=stored)
@@ -0,0 +1,229 @@
+import math
+import os
+
+import numpy as np
+
+from services.cache import TTLCache
+from services.elevation import snap_to_grid
+from services.weather import geohash
+
+MIN_ANGLE = math.radians(0.1)
+MAX_ANGLE = math.radians(89.9)
+
+# Elevations simulated to bracket the solutions when no nearby solution is known, about 4° apart and
+# covering the whole range of the solutions, so that flat shots at short range are bracketed too
+SCAN_ANGLES = np.linspace(MIN_ANGLE, MAX_ANGLE, 23)
+
+# Maximum number of times the azimuth of a solution is corrected for the drift of its impact
+AZIMUTH_TURNS = int(os.getenv('AZIMUTH_TURNS', 6))
+
+# Solutions are reused as starting points for targets within the same geohash cell (6 characters is about 1 km)
+SOLUTION_CACHE_PRECISION = int(os.getenv('SOLUTION_CACHE_PRECISION', 6))
+
+solution_cache = TTLCache(
+    maxsize=int(os.getenv('SOLUTION_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('SOLUTION_CACHE_TTL', 3600)),
+)
+
+
+def solution_key(lat, lon, target_lat, target_lon, v0, m, integrator):
+    """
+    Builds the key under which the solutions for a target are remembered
+
+    @param lat: The latitude of the firing position
+    @param lon: The longitude of the firing position
+    @param target_lat: The latitude of the target
+    @param target_lon: The longitude of the target
+    @param v0: The muzzle speed of the projectile
+    @param m: The mass of the projectile
+    @param integrator: The integration scheme
+    @return: A hashable key shared by nearby targets fired at from the same DEM cell
+    """
+    return (snap_to_grid(lat, lon), geohash(target_lat, target_lon, SOLUTION_CACHE_PRECISION),
+            round(v0, 1), round(m, 3), integrator)
+
+
+def refine(evaluate, target_distance, lo, f_lo, hi, f_hi, tolerance, max_iterations):
+    """
+    Refines a bracketed elevation with the Illinois variant of regula falsi
+
+    @param evaluate: A function simulating a shot at a given elevation
+    @param target_distance: The horizontal distance to reach
+    @param lo: An elevation on one side of the solution
+    @param f_lo: The miss distance at lo (range minus target distance)
+    @param hi: An elevation on the other side of the solution
+    @param f_hi: The miss distance at hi
+    @param tolerance: The acceptable miss distance in metres
+    @param max_iterations: The maximum number of simulations
+    @return: The elevation, its simulation result and the number of simulations run
+    """
+    angle, result = None, None
+    side = 0
+    for iteration in range(1, max_iterations + 1):
+        angle = (lo * f_hi - hi * f_lo) / (f_hi - f_lo)
+        result = evaluate(angle)
+        f = result[2] - target_distance
+        if abs(f) <= tolerance:
+            return angle, result, iteration
+
+        if (f < 0) == (f_lo < 0):
+            lo, f_lo = angle, f
+            if side == -1:
+                f_hi /= 2
+            side = -1
+        else:
+            hi, f_hi = angle, f
+            if side == 1:
+                f_lo /= 2
+            side = 1
+    return angle, result, max_iterations
+
+
+def bracket_from(evaluate, target_distance, angle, rising, lower, upper, step=math.radians(0.5)):
+    """
+    Looks for a bracket around a previous solution, stepping away from it with growing steps
+
+    @param evaluate: A function simulating a shot at a given elevation
+    @param target_distance: The horizontal distance to reach
+    @param angle: The elevation to start from
+    @param rising: True if the range grows with the elevation on this branch of the solutions
+    @param lower: The lowest elevation of the branch
+    @param upper: The highest elevation of the branch
+    @param step: The first step in radians
+    @return: (lo, f_lo, hi, f_hi, simulations), or None if no bracket was found inside the branch
+    """
+    angle = min(max(angle, lower), upper)
+    f = evaluate(angle)[2] - target_distance
+    simulations = 1
+    # Move towards larger ranges if the shot falls short, towards smaller ones if it flies over
+    direction = 1 if (f < 0) == rising else -1
+    while simulations < 8:
+        other = min(max(angle + direction * step, lower), upper)
+        if other == angle:
+            return None
+        f_other = evaluate(other)[2] - target_distance
+        simulations += 1
+        if (f_other < 0) != (f < 0):
+            return angle, f, other, f_other, simulations
+        angle, f = other, f_other
+        step *= 2
+    return None
+
+
+def solve_elevations(evaluate, scan, target_distance, warm=None, tolerance=1.0, max_iterations=30):
+    """
+    Finds the low-angle and high-angle elevations reaching a target distance
+
+    @param evaluate: A function simulating a shot at a given elevation, returning the calculate_with_drag tuple
+    @param scan: A function simulating shots at an array of elevations, returning one tuple per elevation
+    @param target_distance: The horizontal distance to reach
+    @param warm: A previous solution for a nearby target, used as starting point
+    @param tolerance: The acceptable miss distance in metres
+    @param max_iterations: The maximum number of simulations spent refining each solution
+    @return: A dictionary with the 'low' and 'high' solutions as (elevation, result) pairs or None,
+             the elevation of maximum range ('apex_angle') and the number of 'simulations' run
+    """
+    solutions = {'low': None, 'high': None, 'apex_angle': None, 'simulations': 0}
+
+    if warm is not None:
+        apex_angle = warm['apex_angle']
+        branches = {'low': (True, MIN_ANGLE, apex_angle), 'high': (False, apex_angle, MAX_ANGLE)}
+        brackets = {}
+        for name, (rising, lower, upper) in branches.items():
+            if warm.get(name) is None:
+                break
+            found = bracket_from(evaluate, target_distance, warm[name], rising, lower, upper)
+            if found is None:
+                break
+            brackets[name] = found[:4]
+            solutions['simulations'] += found[4]
+        else:
+            solutions['apex_angle'] = apex_angle
+            for name, (lo, f_lo, hi, f_hi) in brackets.items():
+                angle, result, count = refine(evaluate, target_distance, lo, f_lo, hi, f_hi, tolerance, max_iterations)
+                solutions[name] = (angle, result)
+                solutions['simulations'] += count
+            return solutions
+
+    # Cold start: bracket both solutions with one scan over the elevations
+    results = scan(SCAN_ANGLES)
+    solutions['simulations'] += len(SCAN_ANGLES)
+    misses = np.array([result[2] for result in results]) - target_distance
+    best = int(np.argmax(misses))
+    solutions['apex_angle'] = float(SCAN_ANGLES[best])
+    if misses[best] < 0:
+        return solutions  # Target out of range
+
+    if misses[best] <= tolerance:
+        solutions['low'] = solutions['high'] = (float(SCAN_ANGLES[best]), results[best])
+        return solutions
+
+    for name, indices in (('low', range(best, 0, -1)), ('high', range(best, len(SCAN_ANGLES) - 1))):
+        for i in indices:
+            j = i - 1 if name == 'low' else i + 1
+            if misses[j] < 0 <= misses[i]:
+                angle, result, count = refine(evaluate, target_distance, float(SCAN_ANGLES[j]), misses[j],
+                                              float(SCAN_ANGLES[i]), misses[i], tolerance, max_iterations)
+                solutions[name] = (angle, result)
+                solutions['simulations'] += count
+                break
+    return solutions
+
+
+def lateral_miss(result, target_distance, bearing):
+    """
+    @param result: The calculate_with_drag tuple of a shot, whose final position has x pointing North and z East
+    @param target_distance: The horizontal distance of the target
+    @param bearing: The bearing of the target in radians, clockwise from the North
+    @return: The distance in metres between the impact and the target, in the frame of the firing position
+    """
+    x, _, z = result[0]
+    return math.hypot(x - target_distance * math.cos(bearing), z - target_distance * math.sin(bearing))
+
+
+def correct_azimuth(azimuth, bearing, result):
+    """
+    @param azimuth: The azimuth the shot was fired at, in radians
+    @param bearing: The bearing of the target in radians
+    @param result: The calculate_with_drag tuple of the shot
+    @return: The azimuth turned by the angle between the impact and the target, as seen from the firing position
+    """
+    x, _, z = result[0]
+    return (azimuth + (bearing - math.atan2(z, x) + math.pi) % (2 * math.pi) - math.pi) % (2 * math.pi)
+
+
+def refine_azimuth(evaluate_at, target_distance, bearing, solution, rising, lower, upper, tolerance=1.0,
+                   max_iterations=30, max_turns=AZIMUTH_TURNS):
+    """
+    Turns the azimuth of a solution found along the bearing of the target until the impact, drifted by the
+    crosswind, falls on the target. After each correction of the azimuth the elevation is bracketed again
+    from the previous one and refined, so that the range keeps matching the distance of the target.
+
+    @param evaluate_at: A function returning the function simulating a shot at a given elevation, for an azimuth
+    @param target_distance: The horizontal distance of the target
+    @param bearing: The bearing of the target in radians, clockwise from the North
+    @param solution: The (elevation, result) pair found along the bearing
+    @param rising: True if the range grows with the elevation on the branch of the solution
+    @param lower: The lowest elevation of the branch
+    @param upper: The highest elevation of the branch
+    @param tolerance: The acceptable miss distance in metres
+    @param max_iterations: The maximum number of simulations spent refining each elevation
+    @param max_turns: The maximum number of corrections of the azimuth
+    @return: The azimuth, the elevation, its simulation result and the number of simulations run
+    """
+    azimuth = bearing
+    angle, result = solution
+    simulations = 0
+    for _ in range(max_turns):
+        if lateral_miss(result, target_distance, bearing) <= tolerance:
+            break
+        turned = correct_azimuth(azimuth, bearing, result)
+        evaluate = evaluate_at(turned)
+        found = bracket_from(evaluate, target_distance, angle, rising, lower, upper)
+        if found is None:
+            break
+        simulations += found[4]
+        angle, result, count = refine(evaluate, target_distance, *found[:4], tolerance, max_iterations)
+        simulations += count
+        azimuth = turned
+    return azimuth, angle, result, simulations
@@ -0,0 +1,328 @@
+import math
+
+import numpy as np
+
+from services.metrics import INTEGRATION_STEPS
+
+GRAVITY = 9.81  # Gravitational acceleration (m/s^2)
+DRAG_COEFFICIENT = 0.47  # Resistance coefficient for a sphere
+FRONTAL_AREA = 0.01  # Frontal area of the projectile (m^2)
+DEFAULT_AIR_DENSITY = 1.225  # Air density at sea level in the standard atmosphere (kg/m^3)
+
+
+def terrain_altitudes(profiles, profile_ids, distances):
+    """
+    Looks up the terrain altitude under a set of shots
+
+    @param profiles: The distinct terrain profiles of the batch (empty for flat terrain at sea level)
+    @param profile_ids: For each shot, the index of its profile in profiles
+    @param distances: For each shot, the horizontal distance travelled
+    @return: An array of terrain altitudes
+    """
+    if not profiles:
+        return np.zeros_like(distances)
+    if len(profiles) == 1:
+        return np.asarray(profiles[0].altitude_at(distances), dtype=float)
+
+    altitudes = np.empty_like(distances)
+    for i, profile in enumerate(profiles):
+        mask = profile_ids == i
+        if mask.any():
+            altitudes[mask] = profile.altitude_at(distances[mask])
+    return altitudes
+
+
+def simulate_batch(m, v0, angle_vertical, angle_horizontal, alt, air_data, profile=None, dt=0.01):
+    """
+    Integrates many projectile trajectories at once, with the same drag model and explicit Euler
+    scheme as calculate_with_drag. Every argument may be a scalar shared by all the shots or an
+    array with one value per shot; shots that hit the ground are removed from the working set.
+
+    @param m: The masses of the projectiles
+    @param v0: The muzzle speeds of the projectiles
+    @param angle_vertical: The angles of departure (relative to the horizontal) in radians
+    @param angle_horizontal: The angles of departure (relative to the North) in radians
+    @param alt: The starting altitudes
+    @param air_data: A dictionary containing the air density, wind speed and wind direction (scalars or arrays)
+    @param profile: A terrain profile shared by all the shots, a sequence with one profile per shot,
+                    or None for flat terrain at sea level
+    @param dt: The time step for the simulation
+    @return: The final positions (an n x 3 array of x, y, z), the maximum heights reached,
+             the horizontal distances traveled and the flight times of the shots.
+    """
+    density = air_data.get('density')
+    if density is None:
+        density = DEFAULT_AIR_DENSITY
+    density = np.where(np.asarray(density, dtype=float) > 0, density, DEFAULT_AIR_DENSITY)
+
+    m, v0, angle_vertical, angle_horizontal, alt, density, wind_speed, wind_deg = (
+        np.array(a, dtype=float) for a in np.broadcast_arrays(
+            m, v0, angle_vertical, angle_horizontal, alt, density, air_data['wind_speed'], air_data['wind_deg']
+        )
+    )
+    m, v0, angle_vertical, angle_horizontal, alt, density, wind_speed, wind_deg = (
+        a.reshape(-1) for a in (m, v0, angle_vertical, angle_horizontal, alt, density, wind_speed, wind_deg)
+    )
+    n = len(m)
+
+    # Distinct terrain profiles and the profile used by each shot
+    if profile is None:
+        profiles, profile_ids = [], np.zeros(n, dtype=np.intp)
+    elif hasattr(profile, 'altitude_at'):
+        profiles, profile_ids = [profile], np.zeros(n, dtype=np.intp)
+    else:
+        positions = {}
+        profiles = []
+        for p in profile:
+            if id(p) not in positions:
+                positions[id(p)] = len(profiles)
+                profiles.append(p)
+        profile_ids = np.array([positions[id(p)] for p in profile], dtype=np.intp)
+
+    # Wind components
+    wind_deg = np.radians(wind_deg)
+    wind_vx = wind_speed * np.cos(angle_horizontal - wind_deg)
+    wind_vz = wind_speed * np.sin(angle_horizontal - wind_deg)
+
+    # Drag factor: F_drag / (m * v^2)
+    k = 0.5 * DRAG_COEFFICIENT * density * FRONTAL_AREA / m
+
+    # Initial speeds
+    vx = v0 * np.cos(angle_vertical) * np.cos(angle_horizontal)
+    vy = v0 * np.sin(angle_vertical)
+    vz = v0 * np.cos(angle_vertical) * np.sin(angle_horizontal)
+
+    # Initial positions
+    x = np.zeros(n)
+    y = alt.copy()
+    z = np.zeros(n)
+    t = np.zeros(n)
+    max_height = y.copy()
+
+    # Results of every shot, filled in as the shots land
+    final = np.column_stack((x, y, z))
+    final_max_height = max_height.copy()
+    final_t = t.copy()
+
+    # Working set of the shots still in flight
+    index = np.flatnonzero(y > 0)
+    state = [a[index] for a in (x, y, z, vx, vy, vz, t, max_height, wind_vx, wind_vz, k, profile_ids)]
+
+    steps = 0
+    while len(index):
+        steps += 1
+        x, y, z, vx, vy, vz, t, max_height, wind_vx, wind_vz, k, profile_ids = state
+
+        # Obtain terrain altitude
+        terrain_altitude = terrain_altitudes(profiles, profile_ids, np.sqrt(x ** 2 + z ** 2))
+
+        # Velocity relative to the fluid (wind)
+        rel_vx = vx - wind_vx
+        rel_vz = vz - wind_vz
+        v = np.sqrt(rel_vx ** 2 + vy ** 2 + rel_vz ** 2)
+
+        # Accelerations (the drag force is k * m * v^2, directed against the relative velocity)
+        drag = k * v
+        ax = -drag * rel_vx
+        ay = -GRAVITY - drag * vy
+        az = -drag * rel_vz
+
+        # Speed update
+        vx = vx + ax * dt
+        vy = vy + ay * dt
+        vz = vz + az * dt
+
+        # Positions update
+        x = x + vx * dt
+        y = y + vy * dt
+        z = z + vz * dt
+
+        # Update maximum height
+        max_height = np.maximum(max_height, y)
+
+        # Shots that hit the ground stop without advancing the clock, the others fly on until y <= 0
+        hit = y <= terrain_altitude
+        t = np.where(hit, t, t + dt)
+        done = hit | (y <= 0)
+
+        if done.any():
+            finished = index[done]
+            final[finished] = np.column_stack((x[done], y[done], z[done]))
+            final_max_height[finished] = max_height[done]
+            final_t[finished] = t[done]
+
+            flying = ~done
+            index = index[flying]
+            state = [a[flying] for a in (x, y, z, vx, vy, vz, t, max_height, wind_vx, wind_vz, k, profile_ids)]
+        else:
+            state = [x, y, z, vx, vy, vz, t, max_height, wind_vx, wind_vz, k, profile_ids]
+
+    INTEGRATION_STEPS.observe(steps, integrator='batch')
+
+    # Calculate horizontal distances
+    horizontal_distance = np.sqrt(final[:, 0] ** 2 + final[:, 2] ** 2)
+
+    return final, final_max_height, horizontal_distance, final_t
+
+
+# Dormand–Prince 5(4) coefficients
+DP_A = (
+    (),
+    (1 / 5,),
+    (3 / 40, 9 / 40),
+    (44 / 45, -56 / 15, 32 / 9),
+    (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+    (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+    (35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84),
+)
+DP_B = (35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0.0)
+DP_E = (71 / 57600, 0.0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40)
+
+
+def hermite(p0, v0, p1, v1, h, theta):
+    """
+    Interpolates a position inside a step with the cubic Hermite polynomial through its end points
+
+    @param p0: The position at the start of the step
+    @param v0: The velocity at the start of the step
+    @param p1: The position at the end of the step
+    @param v1: The velocity at the end of the step
+    @param h: The length of the step in seconds
+    @param theta: The fraction of the step, between 0 and 1
+    @return: The interpolated position
+    """
+    theta2 = theta * theta
+    theta3 = theta2 * theta
+    return ((2 * theta3 - 3 * theta2 + 1) * p0 + (theta3 - 2 * theta2 + theta) * h * v0
+            + (-2 * theta3 + 3 * theta2) * p1 + (theta3 - theta2) * h * v1)
+
+
+def simulate_adaptive(m, v0, angle_vertical, angle_horizontal, alt, air_data, profile=None,
+                      rtol=1e-6, atol=1e-3, max_time=3600.0, recorder=None):
+    """
+    Calculates the trajectory of a projectile with the drag model of calculate_with_drag, integrated with
+    an adaptive Dormand–Prince 5(4) scheme. The ground impact is located by root-finding on the
+    interpolated last step, so the result does not depend on a fixed time step.
+
+    @param m: The mass of the projectile
+    @param v0: The muzzle speed of the projectile
+    @param angle_vertical: The angle of departure (relative to the horizontal) in radians
+    @param angle_horizontal: The angle of departure (relative to the North) in radians
+    @param alt: The starting altitude
+    @param air_data: A dictionary containing the air density, wind speed and direction
+    @param profile: The terrain profile along the firing azimuth, or None for flat terrain at sea level
+    @param rtol: The relative tolerance of the local error
+    @param atol: The absolute tolerance of the local error
+    @param max_time: The flight time after which the integration is abandoned
+    @param recorder: A TrajectoryRecorder receiving the position at the end of every step
+    @return: The final position of the projectile, the maximum height reached,
+             the horizontal distance traveled, and the flight time.
+    """
+    air_density = float(air_data.get('density') or DEFAULT_AIR_DENSITY)
+    k = 0.5 * DRAG_COEFFICIENT * air_density * FRONTAL_AREA / m
+
+    # Wind components
+    wind_deg = math.radians(air_data['wind_deg'])
+    wind_vx = air_data['wind_speed'] * math.cos(angle_horizontal - wind_deg)
+    wind_vz = air_data['wind_speed'] * math.sin(angle_horizontal - wind_deg)
+
+    def derivative(s):
+        rel_vx = s[3] - wind_vx
+        rel_vz = s[5] - wind_vz
+        drag = k * math.sqrt(rel_vx ** 2 + s[4] ** 2 + rel_vz ** 2)
+        return s[3], s[4], s[5], -drag * rel_vx, -GRAVITY - drag * s[4], -drag * rel_vz
+
+    def clearance(s):
+        # Height above the surface: the terrain, or the sea level where the terrain is below it
+        surface = 0.0
+        if profile is not None:
+            surface = max(surface, float(profile.altitude_at(math.hypot(s[0], s[2]))))
+        return s[1] - surface
+
+    # State: position (x, y, z) and velocity (vx, vy, vz)
+    state = (0.0, float(alt), 0.0,
+             v0 * math.cos(angle_vertical) * math.cos(angle_horizontal),
+             v0 * math.sin(angle_vertical),
+             v0 * math.cos(angle_vertical) * math.sin(angle_horizontal))
+    t = 0.0
+    max_height = state[1]
+    if recorder is not None:
+        recorder.append(t, state[0], state[1], state[2])
+    if clearance(state) <= 0:
+        # The origin lies on or under the surface (e.g. under the interpolated terrain): the shot never flies
+        return (state[0], state[1], state[2]), max_height, 0.0, t
+
+    h = 0.01
+    k1 = derivative(state)
+    steps = rejected = 0
+    while t < max_time:
+        # Steps never jump over more than one terrain sample, so that ridges are not missed
+        if profile is not None:
+            h = min(h, profile.step / max(math.hypot(state[3], state[5]), 1.0))
+
+        stages = [k1]
+        for i in range(1, 7):
+            stage_state = tuple(state[j] + h * sum(a * stages[n][j] for n, a in enumerate(DP_A[i])) for j in range(6))
+            stages.append(derivative(stage_state))
+        new_state = tuple(state[j] + h * sum(b * stages[n][j] for n, b in enumerate(DP_B)) for j in range(6))
+
+        # Local error estimate from the embedded 4th order solution
+        error = math.sqrt(sum(
+            (h * sum(e * stages[n][j] for n, e in enumerate(DP_E)) / (atol + rtol * max(abs(state[j]), abs(new_state[j])))) ** 2
+            for j in range(6)
+        ) / 6)
+        if error > 1.0:
+            h *= max(0.2, 0.9 * error ** -0.2)
+            rejected += 1
+            continue
+        steps += 1
+
+        # Apex inside the step, where the vertical speed changes sign
+        if state[4] > 0 >= new_state[4]:
+            theta = state[4] / (state[4] - new_state[4])
+            max_height = max(max_height, hermite(state[1], state[4], new_state[1], new_state[4], h, theta))
+        max_height = max(max_height, new_state[1])
+
+        g_lo, g_hi = clearance(state), clearance(new_state)
+        if g_lo > 0 >= g_hi:
+            # Regula falsi (Illinois variant) on the clearance along the interpolated step, which changes sign
+            def point(theta):
+                return tuple(hermite(state[j], state[j + 3], new_state[j], new_state[j + 3], h, theta) for j in range(3))
+
+            lo, hi = 0.0, 1.0
+            theta = hi
+            side = 0
+            for _ in range(50):
+                theta = (lo * g_hi - hi * g_lo) / (g_hi - g_lo)
+                p = point(theta)
+                g = clearance((p[0], p[1], p[2]))
+                if abs(g) < 1e-6 or hi - lo < 1e-12:
+                    break
+                if g > 0:
+                    lo, g_lo = theta, g
+                    if side == -1:
+                        g_hi /= 2
+                    side = -1
+                else:
+                    hi, g_hi = theta, g
+                    if side == 1:
+                        g_lo /= 2
+                    side = 1
+
+            x, y, z = point(theta)
+            if recorder is not None:
+                recorder.append(t + theta * h, x, y, z)
+            INTEGRATION_STEPS.observe(steps, integrator='adaptive')
+            INTEGRATION_STEPS.observe(rejected, integrator='adaptive_rejected')
+            return (x, y, z), max_height, math.hypot(x, z), t + theta * h
+
+        t += h
+        state = new_state
+        if recorder is not None:
+            recorder.append(t, state[0], state[1], state[2])
+        k1 = stages[6]  # First same as last
+        h *= min(5.0, 0.9 * max(error, 1e-10) ** -0.2)
+
+    INTEGRATION_STEPS.observe(steps, integrator='adaptive')
+    INTEGRATION_STEPS.observe(rejected, integrator='adaptive_rejected')
+    return (state[0], state[1], state[2]), max_height, math.hypot(state[0], state[2]), t
@@ -0,0 +1,304 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from services.metrics import count_upstream_call
+
+# Keep-alive connections kept open towards each upstream service
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 16))
+
+# Connect and read timeouts in seconds of a single upstream call
+UPSTREAM_TIMEOUT = (float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 2)), float(os.getenv('UPSTREAM_READ_TIMEOUT', 5)))
+
+# Seconds a call may take overall, retries included
+UPSTREAM_DEADLINE = float(os.getenv('UPSTREAM_DEADLINE', 8))
+
+# Consecutive failures that open the circuit of a service, and seconds before a trial call is let through
+UPSTREAM_BREAKER_THRESHOLD = int(os.getenv('UPSTREAM_BREAKER_THRESHOLD', 5))
+UPSTREAM_BREAKER_COOLDOWN = float(os.getenv('UPSTREAM_BREAKER_COOLDOWN', 30))
+
+# Maximum number of retries of a single call, and share of the calls that may be retried overall
+UPSTREAM_RETRIES = int(os.getenv('UPSTREAM_RETRIES', 2))
+UPSTREAM_RETRY_RATIO = float(os.getenv('UPSTREAM_RETRY_RATIO', 0.2))
+
+# Threads used to run independent upstream fetches concurrently
+UPSTREAM_WORKERS = int(os.getenv('UPSTREAM_WORKERS', 16))
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+logger = logging.getLogger(__name__)
+
+_sessions = {}
+_budgets = {}
+_breakers = {}
+_sessions_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix='upstream')
+
+# Keys of the background refreshes in progress
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+# Reasons why the answer of the current request is degraded
+_degradations = contextvars.ContextVar('degradations', default=None)
+
+
+class UpstreamError(Exception):
+    """
+    An upstream service could not be reached or did not answer as expected
+    """
+
+
+class CircuitOpenError(UpstreamError):
+    """
+    A call was not attempted because the circuit of the service is open
+    """
+
+
+class RetryBudget:
+    """
+    Limits retries to a share of the calls made, so that a failing upstream is not hit by a retry storm.
+    Every call deposits a fraction of a token and every retry withdraws a whole one.
+    """
+
+    def __init__(self, ratio, initial=10.0, maximum=100.0):
+        """
+        @param ratio: The number of tokens deposited by every call
+        @param initial: The number of tokens available at start
+        @param maximum: The maximum number of tokens that can be saved up
+        """
+        self.ratio = ratio
+        self.tokens = initial
+        self.maximum = maximum
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """
+        Adds the share of a token earned by a call
+        """
+        with self._lock:
+            self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """
+        Takes a token for a retry
+
+        @return: True if a retry is allowed
+        """
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class CircuitBreaker:
+    """
+    Stops calling a service after consecutive failures, so that requests fail fast instead of waiting
+    for timeouts. After a cooldown a single trial call is let through: its success closes the circuit,
+    its failure opens it again.
+    """
+
+    def __init__(self, threshold=UPSTREAM_BREAKER_THRESHOLD, cooldown=UPSTREAM_BREAKER_COOLDOWN):
+        """
+        @param threshold: The number of consecutive failures that opens the circuit
+        @param cooldown: The number of seconds the circuit stays open before a trial call
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        @return: True if a call may be attempted
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = 'half_open'
+                return True
+            return False
+
+    def record(self, success):
+        """
+        Records the outcome of a call
+
+        @param success: Whether the service answered
+        """
+        with self._lock:
+            if success:
+                self.state = 'closed'
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.threshold:
+                if self.state != 'open':
+                    self.trips += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        """
+        @return: The state of the circuit, the current run of failures and the number of times it opened
+        """
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures, 'trips': self.trips}
+
+
+def get_session(name):
+    """
+    Returns the pooled HTTP session used for an upstream service
+
+    @param name: The name of the upstream service
+    @return: A requests session keeping connections alive between calls
+    """
+    session = _sessions.get(name)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(name)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _budgets[name] = RetryBudget(UPSTREAM_RETRY_RATIO)
+                _breakers[name] = CircuitBreaker()
+                _sessions[name] = session
+    return session
+
+
+def get(name, url, **kwargs):
+    """
+    Performs a GET request towards an upstream service, on a pooled connection, with a timeout
+    and retries on connection errors and transient statuses as long as the retry budget and the
+    deadline allow. Calls are refused at once while the circuit of the service is open.
+
+    @param name: The name of the upstream service
+    @param url: The URL to request
+    @param kwargs: Further arguments passed to requests
+    @return: The response of the last attempt
+    @raise CircuitOpenError: If the circuit of the service is open
+    @raise UpstreamError: If the service could not be reached
+    """
+    session = get_session(name)
+    budget = _budgets[name]
+    breaker = _breakers[name]
+    if not breaker.allow():
+        count_upstream_call(name, 'rejected')
+        raise CircuitOpenError(f"The circuit of the {name} service is open")
+    budget.deposit()
+    connect_timeout, read_timeout = kwargs.pop('timeout', UPSTREAM_TIMEOUT)
+    deadline = time.monotonic() + UPSTREAM_DEADLINE
+
+    attempt = 0
+    response = None
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise requests.Timeout(f"deadline of {UPSTREAM_DEADLINE}s exceeded")
+                response = session.get(url, timeout=(min(connect_timeout, remaining), min(read_timeout, remaining)),
+                                       **kwargs)
+                count_upstream_call(name, 'ok' if response.ok else 'error')
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response = None
+                count_upstream_call(name, 'failed')
+                if attempt >= UPSTREAM_RETRIES or time.monotonic() >= deadline or not budget.withdraw():
+                    raise UpstreamError(f"The {name} service could not be reached: {e}") from e
+            else:
+                if attempt >= UPSTREAM_RETRIES or time.monotonic() >= deadline or not budget.withdraw():
+                    return response
+            attempt += 1
+    finally:
+        # Client errors still prove that the service is up
+        breaker.record(response is not None and response.status_code < 500 and response.status_code != 429)
+
+
+def breaker_stats():
+    """
+    @return: The state of the circuit of each upstream service
+    """
+    return {name: breaker.stats() for name, breaker in list(_breakers.items())}
+
+
+def refresh_in_background(key, function):
+    """
+    Runs a refresh on the upstream threads, unless the same refresh is already in progress.
+    Failures are only logged: the caller has already answered with the stale value.
+
+    @param key: The identity of the refresh, starting with the kind of data, e.g. ('weather', cell)
+    @param function: A function without arguments performing the refresh
+    """
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def refresh():
+        try:
+            function()
+        except UpstreamError as e:
+            logger.warning("Background refresh of the %s data failed: %s", key[0], e)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    # A fresh context, so that the refresh is not accounted to the request that triggered it
+    _executor.submit(contextvars.Context().run, refresh)
+
+
+@contextmanager
+def degradations():
+    """
+    Collects the reasons why the answer being computed is degraded (stale or substituted upstream data).
+    Lookups running through run_concurrently share the collection of their caller.
+
+    @return: A set, filled with the reasons once the block has run
+    """
+    reasons = set()
+    token = _degradations.set(reasons)
+    try:
+        yield reasons
+    finally:
+        _degradations.reset(token)
+        # The reasons also degrade the answer the block is part of
+        outer = _degradations.get()
+        if outer is not None:
+            outer.update(reasons)
+
+
+def mark_degraded(reason):
+    """
+    Records that upstream data was replaced by a fallback while computing the current answer
+
+    @param reason: A short identifier, e.g. 'weather_stale'
+    """
+    reasons = _degradations.get()
+    if reasons is not None:
+        reasons.add(reason)
+
+
+def run_concurrently(*calls):
+    """
+    Runs independent upstream fetches at the same time, so that the total latency is that of the slowest one.
+    Each call runs in a copy of the caller's context, so that it is accounted to the trace of the request.
+
+    @param calls: Functions without arguments (e.g. functools.partial objects)
+    @return: The results of the calls, in the same order
+    """
+    futures = [_executor.submit(contextvars.copy_context().run, call) for call in calls]
+    return [future.result() for future in futures]
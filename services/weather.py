@@ -0,0 +1,151 @@
+import os
+from functools import partial
+
+from services import upstream
+from services.cache import TTLCache
+from services.metrics import timed
+from services.trajectory import DEFAULT_AIR_DENSITY
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Length of the geohash identifying a weather cell (5 characters is roughly 5 km x 5 km)
+WEATHER_CACHE_PRECISION = int(os.getenv('WEATHER_CACHE_PRECISION', 5))
+
+# The weather of a cell is fetched at most once per time-to-live, and served for a while longer
+# while it is refreshed in the background (e.g. during an outage of OpenWeatherMap)
+weather_cache = TTLCache(
+    maxsize=int(os.getenv('WEATHER_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('WEATHER_CACHE_TTL', 600)),
+    stale_ttl=float(os.getenv('WEATHER_STALE_TTL', 3600)),
+)
+
+# Air data used when no weather is available: the standard atmosphere at sea level, without wind
+STANDARD_ATMOSPHERE = {
+    'temperature': 15.0,
+    'pressure': 101325.0,
+    'wind_speed': 0.0,
+    'wind_deg': 0.0,
+    'density': DEFAULT_AIR_DENSITY,
+}
+
+
+def geohash(lat, lon, precision=WEATHER_CACHE_PRECISION):
+    """
+    Encodes a position as a geohash, whose prefixes identify nested grid cells
+
+    @param lat: latitude of the position
+    @param lon: longitude of the position
+    @param precision: number of characters of the geohash
+    @return: the geohash of the position
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # Bits alternate between longitude and latitude, starting with longitude
+    while len(chars) < precision:
+        value, interval = (lon, lon_range) if even else (lat, lat_range)
+        mid = (interval[0] + interval[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            interval[0] = mid
+        else:
+            bits = bits * 2
+            interval[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+def get_weather_data(lat, lon):
+    """
+    Gets weather data from the OpenWeatherMap API
+
+    @param lat: latitude of the position
+    @param lon: longitude of the position
+    @return: a JSON object containing the weather data
+    @raise UpstreamError: if the API cannot be reached or answers with an error
+    """
+
+    api_key = os.getenv('OPENWEATHER_API_KEY')
+    url = f"{os.getenv('OPENWEATHER_URL')}/{os.getenv('OPENWEATHER_VERSION')}/weather?lat={lat}&lon={lon}&appid={api_key}&units=metric"
+    with timed('weather'):
+        response = upstream.get('weather', url)
+    if response.status_code == 200:
+        return response.json()
+    else:
+        raise upstream.UpstreamError(f"Errore nell'API: {response.status_code}, {response.text}")
+
+
+def get_weather_and_density(lat, lon):
+    """
+    Gets weather data from the OpenWeatherMap API and calculates the air density.
+    The result is cached per geohash cell, so nearby requests within the time-to-live share it.
+    An expired result is still served while it is refreshed in the background, and the standard
+    atmosphere is used when no weather can be had; either way the answer is marked as degraded.
+
+    @param lat: latitude of the position
+    @param lon: longitude of the position
+    @return: a dictionary containing the weather data and the calculated air density
+    """
+    cell = geohash(lat, lon)
+    cached = weather_cache.get_stale(cell)
+    if cached is not None:
+        air_data, fresh = cached
+        if not fresh:
+            upstream.mark_degraded('weather_stale')
+            upstream.refresh_in_background(('weather', cell), partial(fetch_weather_and_density, lat, lon, cell))
+        return dict(air_data)
+
+    try:
+        return dict(fetch_weather_and_density(lat, lon, cell))
+    except upstream.UpstreamError:
+        upstream.mark_degraded('weather_unavailable')
+        return dict(STANDARD_ATMOSPHERE)
+
+
+def fetch_weather_and_density(lat, lon, cell):
+    """
+    Fetches the weather of a position, calculates the air density and caches them
+
+    @param lat: latitude of the position
+    @param lon: longitude of the position
+    @param cell: geohash of the weather cell of the position
+    @return: a dictionary containing the weather data and the calculated air density
+    @raise UpstreamError: if the weather cannot be fetched
+    """
+    weather_data = get_weather_data(lat, lon)
+    temperature = weather_data['main']['temp']
+    pressure = weather_data['main']['pressure'] * 100
+    wind_speed = weather_data['wind']['speed']
+    wind_deg = weather_data['wind']['deg']
+
+    density = calculate_air_density(pressure, temperature)
+
+    air_data = {
+        'temperature': temperature,
+        'pressure': pressure,
+        'wind_speed': wind_speed,
+        'wind_deg': wind_deg,
+        'density': density,
+    }
+    weather_cache.set(cell, air_data)
+    return air_data
+
+
+def calculate_air_density(pressure, temperature):
+    """
+    Calculates the air density using the ideal gas law
+
+    @param pressure: atmospheric pressure in pascals
+    @param temperature: air temperature in degrees Celsius
+    @return: air density in kg/m^3
+    """
+    R = 287.05  # Specific gas constant for dry air in J/(kg·K)
+    temperature_kelvin = temperature + 273.15  # Convert temperature from Celsius to Kelvin
+    return pressure / (R * temperature_kelvin)  # Apply the ideal gas law to calculate density
@@ -0,0 +1,41 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Processes running CPU-bound simulations outside of the request threads
+SIMULATION_WORKERS = int(os.getenv('SIMULATION_WORKERS', os.cpu_count() or 1))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """
+    Returns the process pool running the simulations, started on first use.
+    Workers are spawned rather than forked, since the parent holds threads and connection pools.
+
+    @return: A ProcessPoolExecutor
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=SIMULATION_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def map_in_processes(function, items):
+    """
+    Applies a function to every item on the process pool, or inline when a pool would not pay off
+
+    @param function: A module-level function taking a single argument
+    @param items: A list of arguments
+    @return: The results, in the same order
+    """
+    if SIMULATION_WORKERS <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    chunksize = max(1, len(items) // (SIMULATION_WORKERS * 4))
+    return list(get_process_pool().map(function, items, chunksize=chunksize))
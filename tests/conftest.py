@@ -0,0 +1,48 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The application reads its configuration from the environment when it is imported
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def flask_app():
+    from app import app
+    from models.conn import db
+
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(flask_app):
+    return flask_app.test_client()
+
+
+# Altitude of the flat terrain seen by the shots of the offline fixture
+TERRAIN_ALTITUDE = 100.0
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    """
+    Replaces the elevation and weather services with flat terrain and calm air, and simulates inline
+    """
+    from blueprints import api
+    from services import workers
+    from services.firing_tables import FlatTerrain
+
+    monkeypatch.setattr(api, 'get_altitude', lambda lat, lon, default=0.0: str(TERRAIN_ALTITUDE))
+    monkeypatch.setattr(api, 'get_altitudes', lambda locations, default=0.0: [TERRAIN_ALTITUDE] * len(locations))
+    monkeypatch.setattr(api, 'get_weather_and_density',
+                        lambda lat, lon: {'density': 1.225, 'wind_speed': 0.0, 'wind_deg': 0.0})
+    monkeypatch.setattr(api, 'get_ground_profile',
+                        lambda lat, lon, angle_horizontal, distance: FlatTerrain(TERRAIN_ALTITUDE))
+    monkeypatch.setattr(workers, 'SIMULATION_WORKERS', 1)
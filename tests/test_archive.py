@@ -0,0 +1,23 @@
+import numpy as np
+
+from blueprints import api
+from models.models import Response, TrajectoryArchive
+from services.archive import read_index, read_points
+
+SHOT = {"latitude": "45°58'25.068\"N", "longitude": "8°52'35.1552\"E", "muzzle_speed": 300, "vertical_angle": 45,
+        "horizontal_angle": 30, "projectile_weight": 5}
+
+
+def test_batch_shots_are_archived(client, offline, monkeypatch):
+    monkeypatch.setattr(api, 'TRAJECTORY_ARCHIVE', True)
+
+    response = client.post('/api/calculate/projectile_ballistics/batch',
+                           json=[SHOT, {**SHOT, 'vertical_angle': 30}])
+
+    assert response.status_code == 200
+    assert TrajectoryArchive.query.count() == 2
+    for result, row in zip(response.get_json()['results'], Response.query.order_by(Response.id)):
+        archive_id, index = read_index(row.id)
+        points = np.concatenate(list(read_points(archive_id, index)))
+        assert points[0, 0] == 0.0
+        assert np.isclose(np.hypot(points[-1, 1], points[-1, 3]), result['horizontal_distance'], rtol=1e-5)
@@ -0,0 +1,39 @@
+from blueprints import api
+
+SHOT = {"latitude": "45°58'25.068\"N", "longitude": "8°52'35.1552\"E", "muzzle_speed": 300, "vertical_angle": 45,
+        "horizontal_angle": 30, "projectile_weight": 5}
+
+
+class FixedTable:
+    """
+    A firing table answering every lookup with the same range, apex and time of flight
+    """
+
+    def lookup(self, vertical_angle, density):
+        return 1234.0, 321.0, 20.0
+
+
+def test_batch_returns_the_requested_trajectories(client, offline):
+    response = client.post('/api/calculate/projectile_ballistics/batch',
+                           json=[{**SHOT, 'trajectory_points': 10}, SHOT])
+
+    assert response.status_code == 200
+    first, second = response.get_json()['results']
+    assert 2 <= len(first['trajectory']) <= 10
+    assert first['trajectory'][-1][:2] == [first['final_position']['latitude'], first['final_position']['longitude']]
+    assert 'trajectory' not in second
+
+
+def test_batch_uses_the_firing_tables_when_allowed(client, offline, monkeypatch):
+    monkeypatch.setattr(api, 'get_table', lambda m, v0: FixedTable())
+
+    response = client.post('/api/calculate/projectile_ballistics/batch',
+                           json=[{**SHOT, 'terrain_accurate': False}, SHOT])
+
+    assert response.status_code == 200
+    approximate, simulated = response.get_json()['results']
+    assert approximate['approximate'] is True
+    assert approximate['horizontal_distance'] == 1234.0
+    assert approximate['max_height_relative'] == 321.0
+    assert 'approximate' not in simulated
+    assert simulated['horizontal_distance'] != 1234.0
@@ -0,0 +1,86 @@
+import struct
+
+import numpy as np
+import pytest
+
+from services import elevation, upstream
+from services.geotiff import GeoTiffElevationBackend
+
+NODATA = -32768
+
+
+def write_tile(path, pixels, nodata=NODATA):
+    """
+    Writes a minimal uncompressed single-strip GeoTIFF of int16 pixels
+    """
+    height, width = pixels.shape
+    nodata_text = f'{nodata}\0'.encode('ascii')
+    entries = [(256, 3, 1, width), (257, 3, 1, height), (258, 3, 1, 16), (259, 3, 1, 1), (273, 4, 1, 0),
+               (277, 3, 1, 1), (278, 3, 1, height), (279, 4, 1, pixels.size * 2), (339, 3, 1, 2),
+               (42113, 2, len(nodata_text), 0)]
+    ifd_size = 2 + len(entries) * 12 + 4
+    nodata_offset = 8 + ifd_size
+    data_offset = nodata_offset + len(nodata_text)
+    ifd = struct.pack('<H', len(entries))
+    for tag, field_type, count, value in entries:
+        if tag == 273:
+            value = data_offset
+        elif tag == 42113:
+            value = nodata_offset
+        ifd += struct.pack('<HHI', tag, field_type, count)
+        ifd += struct.pack('<HH', value, 0) if field_type == 3 else struct.pack('<I', value)
+    ifd += struct.pack('<I', 0)
+    with open(path, 'wb') as file:
+        file.write(b'II*\0' + struct.pack('<I', 8) + ifd + nodata_text + pixels.astype('<i2').tobytes())
+
+
+@pytest.fixture
+def geotiff(tmp_path, monkeypatch):
+    pixels = np.full((4, 4), 500, dtype=np.int16)
+    pixels[0, 0] = NODATA
+    write_tile(tmp_path / 'N45E008.tif', pixels)
+    monkeypatch.setattr(elevation, '_backend', GeoTiffElevationBackend(str(tmp_path), tile_size=1))
+
+
+def test_altitude_inside_the_tile(geotiff):
+    with upstream.degradations() as degraded:
+        assert float(elevation.get_altitude(45.5, 8.5)) == 500.0
+    assert not degraded
+
+
+def test_altitude_outside_the_tiles_is_a_failure(geotiff):
+    with pytest.raises(upstream.UpstreamError):
+        elevation.fetch_altitudes([(47.5, 8.5)])
+
+    with upstream.degradations() as degraded:
+        assert float(elevation.get_altitude(47.5, 8.5, default=123.0)) == 123.0
+    assert degraded == {'elevation_unavailable'}
+
+    with pytest.raises(elevation.AltitudeUnavailable):
+        elevation.get_altitude(47.5, 8.5, default=None)
+
+
+def test_altitude_next_to_nodata_is_a_failure(geotiff):
+    with upstream.degradations() as degraded:
+        assert float(elevation.get_altitude(45.99, 8.01, default=0.0)) == 0.0
+    assert degraded == {'elevation_unavailable'}
+
+
+def test_failed_fetch_counts_each_miss_once(monkeypatch):
+    monkeypatch.setattr(elevation, '_backend', elevation.HttpElevationBackend())
+    elevation.elevation_cache.clear()
+    fetched, lost = elevation.snap_to_grid(45.5, 8.5), elevation.snap_to_grid(46.5, 9.5)
+
+    def fetch_cells(keys):
+        # The first batch is cached before the service goes down
+        elevation.elevation_cache.set(fetched, 500.0)
+        raise upstream.UpstreamError("The elevation service could not be reached")
+
+    monkeypatch.setattr(elevation, 'fetch_cells', fetch_cells)
+    with upstream.degradations() as degraded:
+        assert elevation.get_altitudes([(45.5, 8.5), (46.5, 9.5)], default=0.0) == [500.0, 0.0]
+    assert degraded == {'elevation_unavailable'}
+
+    stats = elevation.elevation_cache.stats()
+    assert (stats['hits'], stats['stale_hits'], stats['misses']) == (0, 0, 2)
+    elevation.elevation_cache.clear()
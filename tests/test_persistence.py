@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from models.conn import db
+from models.models import Request, Response
+from models.persistence import HistoryWriter
+
+
+def pair(sender='127.0.0.1'):
+    request_row = Request(latitude="45°58'25.068\"N", longitude="8°52'35.1552\"E", muzzle_speed=300,
+                          vertical_angle=45, horizontal_angle=30, projectile_weight=5, timestamp=datetime.now(),
+                          sender=sender)
+    response_row = Response(final_position_lat=45.99, final_position_lon=8.89, final_position_alt=150.0,
+                            horizontal_distance=2256.9, max_height=1052.4, max_height_relative=904.1, flight_time=10)
+    return request_row, response_row
+
+
+@pytest.fixture
+def writer(flask_app):
+    writer = HistoryWriter(mode='write_behind', interval=3600, max_attempts=2)
+    writer.init_app(flask_app)
+    yield writer
+    writer._stopped.set()
+    writer._wakeup.set()
+
+
+def test_rows_are_rebuilt_after_a_failed_commit(writer, monkeypatch):
+    writer.save([pair()])
+    commit = db.session.commit
+
+    def fail_after_flush():
+        # The rows get their keys from the flush before the transaction is lost
+        db.session.flush()
+        monkeypatch.setattr(db.session, 'commit', commit)
+        raise OperationalError('COMMIT', {}, Exception('database is locked'))
+
+    monkeypatch.setattr(db.session, 'commit', fail_after_flush)
+    assert writer.flush() == 0
+    assert writer.stats()['pending'] == 1
+
+    assert writer.flush() == 1
+    assert Request.query.count() == 1
+    assert Response.query.one().request_id == Request.query.one().id
+    assert writer.stats() == {'mode': 'write_behind', 'pending': 0, 'written': 1, 'flushes': 1, 'failures': 1,
+                              'dropped': 0}
+
+
+def test_a_faulty_row_is_dropped_without_holding_back_the_others(writer):
+    writer.save([pair()])
+    # The sender is mandatory, so this save can never be written
+    writer.save([pair(sender=None)])
+    writer.save([pair()])
+
+    assert writer.flush() == 2
+    assert writer.stats()['pending'] == 1
+    assert writer.flush() == 0
+
+    stats = writer.stats()
+    assert stats['pending'] == 0
+    assert stats['dropped'] == 1
+    assert stats['written'] == 2
+    assert Request.query.count() == 2
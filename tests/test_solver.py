@@ -0,0 +1,39 @@
+import math
+
+from services.solver import MIN_ANGLE, solve_elevations
+
+SPEED = 300.0
+GRAVITY = 9.81
+
+
+def vacuum_shot(angle):
+    """
+    The range of a shot without drag, laid out like the result of calculate_with_drag
+    """
+    distance = SPEED ** 2 * math.sin(2 * angle) / GRAVITY
+    return (distance, 0.0, 0.0), 0.0, distance, 2 * SPEED * math.sin(angle) / GRAVITY
+
+
+def solve(distance):
+    return solve_elevations(vacuum_shot, lambda angles: [vacuum_shot(angle) for angle in angles], distance,
+                            tolerance=0.1)
+
+
+def test_short_range_target_has_a_flat_solution():
+    # About 0.5° above the horizon: below the first elevation of the old scan
+    distance = vacuum_shot(math.radians(0.5))[2]
+    solutions = solve(distance)
+
+    low_angle, low_result = solutions['low']
+    high_angle, high_result = solutions['high']
+    assert MIN_ANGLE <= low_angle < math.radians(1.0)
+    assert abs(low_result[2] - distance) <= 0.1
+    assert high_angle > math.radians(89.0)
+    assert abs(high_result[2] - distance) <= 0.1
+
+
+def test_target_closer_than_the_flattest_shot_has_no_solution():
+    solutions = solve(vacuum_shot(MIN_ANGLE)[2] / 2)
+
+    assert solutions['low'] is None
+    assert solutions['high'] is None
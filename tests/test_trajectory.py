@@ -0,0 +1,26 @@
+import math
+
+from services.firing_tables import FlatTerrain
+from services.trajectory import simulate_adaptive
+
+CALM = {'density': 1.225, 'wind_speed': 0.0, 'wind_deg': 0.0}
+
+
+def test_adaptive_origin_below_terrain_does_not_fly():
+    final_position, max_height, distance, flight_time = simulate_adaptive(
+        5, 300, math.radians(45), 0.0, 50.0, CALM, FlatTerrain(100.0))
+
+    assert final_position == (0.0, 50.0, 0.0)
+    assert max_height == 50.0
+    assert distance == 0.0
+    assert flight_time == 0.0
+
+
+def test_adaptive_impact_lies_on_the_terrain():
+    final_position, max_height, distance, flight_time = simulate_adaptive(
+        5, 300, math.radians(45), 0.0, 150.0, CALM, FlatTerrain(100.0))
+
+    assert abs(final_position[1] - 100.0) < 1e-3
+    assert max_height > 150.0
+    assert distance > 0.0
+    assert flight_time > 0.0